@@ -0,0 +1,120 @@
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+import numpy
+import pandas as pd
+
+# Streaming reader for the cyclic_data_* breadcrumb TSVs
+# Yields typed chunks in which every trip is complete, so per-trip work (projection, repair, scoring) can run on one
+# chunk at a time in bounded memory instead of concatenating the whole month up front.
+
+DEFAULT_CHUNKSIZE = 500000  # rows parsed per read; a yielded chunk is this plus the tail of one trip at most
+DEFAULT_PREFETCH = 2  # chunks parsed ahead on a background thread while the caller works on the current one
+GPS_COLUMNS = ['GPS_LONGITUDE', 'GPS_LATITUDE', 'EVENT_NO_TRIP']
+BREADCRUMB_DTYPES = {'OPD_DATE': str,
+                     'EVENT_NO_TRIP': 'float64',  # read as float because some rows have no trip
+                     'VEHICLE_ID': 'float64',
+                     'GPS_LATITUDE': 'float64',
+                     'GPS_LONGITUDE': 'float64'}
+
+
+# @Return the breadcrumb files to read, given either a directory of *.tsv files or a list of file names
+def breadcrumb_files(source) -> list:
+    if isinstance(source, (str, Path)) and Path(source).is_dir():
+        return sorted(Path(source).glob("*.tsv"))
+    if isinstance(source, (str, Path)):
+        return [Path(source)]
+    return [Path(f) for f in source]
+
+
+# Drops readings with no position or trip (the same cleanup every script did after loading) and makes trips ints
+def clean_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk = chunk.dropna(subset=GPS_COLUMNS)
+    return chunk.astype({'EVENT_NO_TRIP': 'int64'})
+
+
+def _split_last_trip(chunk: pd.DataFrame):
+    trips = chunk['EVENT_NO_TRIP'].to_numpy(dtype='float64')
+    others = numpy.flatnonzero(trips != trips[-1])
+    split = others[-1] + 1 if len(others) else 0
+    return chunk.iloc[:split], chunk.iloc[split:]
+
+
+# Records the trips of a chunk about to be yielded, and reports those already yielded in an earlier chunk
+# A trip that comes back after its chunk went out would be split in two, so chunked per-trip work would be wrong
+def _check_trips(chunk: pd.DataFrame, emitted: set, strict: bool):
+    trips = pd.unique(chunk['EVENT_NO_TRIP'].dropna())
+    again = [trip for trip in trips.tolist() if trip in emitted]
+    if len(again):
+        message = (str(len(again)) + " trip(s) are not contiguous in the breadcrumb files and were split across "
+                   "chunks, e.g. trip " + str(int(again[0])))
+        if strict:
+            raise ValueError(message)
+        print("Warning: " + message)
+    emitted.update(trips.tolist())
+
+
+def _read_chunks(files, chunksize, clean, columns, strict):
+    carry = None  # rows of the last trip seen, held back until we know the trip has ended
+    emitted = set()  # trips already yielded
+    for filename in files:
+        reader = pd.read_csv(filename, sep='\t', header=0, chunksize=chunksize, usecols=columns,
+                             dtype={k: v for k, v in BREADCRUMB_DTYPES.items() if columns is None or k in columns})
+        for chunk in reader:
+            if clean:
+                chunk = clean_chunk(chunk)
+            if carry is not None and len(carry):
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            if len(chunk) == 0:
+                continue
+            done, carry = _split_last_trip(chunk)
+            if len(done):
+                _check_trips(done, emitted, strict)
+                yield done.sort_values('EVENT_NO_TRIP', kind='stable', ignore_index=True)
+    if carry is not None and len(carry):
+        _check_trips(carry, emitted, strict)
+        yield carry.reset_index(drop=True)
+
+
+def _prefetched(chunks, prefetch):
+    queue = Queue(maxsize=prefetch)
+    done = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                queue.put(chunk)
+            queue.put(done)
+        except BaseException as e:
+            queue.put(e)
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+# Yields breadcrumb chunks grouped by trip, with every trip complete within a single chunk
+# Trips are expected to be contiguous in the source files; rows keep their file order within a trip
+# A trip that shows up again after its chunk was yielded raises ValueError, or only prints a warning if not strict
+# With prefetch > 0 the next chunks are parsed on a background thread, so callers start before all files are read
+def iter_breadcrumb_chunks(source, chunksize: int = DEFAULT_CHUNKSIZE, prefetch: int = DEFAULT_PREFETCH,
+                           clean: bool = True, columns: list = None, strict: bool = True):
+    chunks = _read_chunks(breadcrumb_files(source), chunksize, clean, columns, strict)
+    if prefetch > 0:
+        return _prefetched(chunks, prefetch)
+    return chunks
+
+
+# Convenience for scripts that still want one frame: reads every chunk and concatenates once at the end
+# Trips split across chunks only get a warning here, since the whole frame holds all of their rows anyway
+def read_breadcrumbs(source, clean: bool = True, columns: list = None) -> pd.DataFrame:
+    chunks = list(iter_breadcrumb_chunks(source, clean=clean, columns=columns, strict=False))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, axis=0, ignore_index=True)
@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import hashlib
+import shutil
+import pandas as pd
+
+import timestamps
+
+try:
+    import fcntl
+except ImportError:  # Windows: files that are still mapped cannot be deleted there anyway
+    fcntl = None
+
+# Build-once columnar cache of cleaned, joined input frames
+# Each cached frame is a Parquet file named after a hash of the source files it was built from, so editing or adding
+# a source file changes the key and the frame is rebuilt; otherwise reruns skip all of the CSV/TSV parsing and joins.
+# Parquet support comes from pyarrow (pip install pyarrow).
+
+CACHE_DIR = Path().joinpath('..', 'data', 'cache')
+HASH_BLOCK = 1 << 20  # bytes read at a time while hashing source files
+HASH_LENGTH = 16  # hex digits of source_hash
+STORE_LOCK = '.lock'  # lock file in a cached store directory, held (shared) by every process that has it mapped
+INT32_COLUMNS = ['EVENT_NO_TRIP', 'trip_id', 'VEHICLE_ID', 'ACT_TIME', 'shapeID', 'vehicle_number', 'route_number',
+                 'route_index', 'shape_index', 'shape_pt_sequence', 'route_short_name']
+
+
+# @Return hex digest over the names and contents of the source files, in the order given
+def source_hash(sources) -> str:
+    digest = hashlib.sha1()
+    for source in sources:
+        source = Path(source)
+        digest.update(source.name.encode())
+        with open(source, 'rb') as fil:
+            for block in iter(lambda: fil.read(HASH_BLOCK), b''):
+                digest.update(block)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+# Shrinks a frame to compact dtypes before it is cached
+# IDs become int32 (nullable Int32 where a join left holes), dates become categories, and a real TIMESTAMP column is
+# added wherever OPD_DATE/ACT_TIME are present. Coordinates stay float64: float32 would lose ~0.5 m at this latitude.
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    for col in INT32_COLUMNS:
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype('Int32' if df[col].isna().any() else 'int32')
+    if 'OPD_DATE' in df.columns and 'ACT_TIME' in df.columns and 'TIMESTAMP' not in df.columns:
+        df['TIMESTAMP'] = timestamps.crumb_datetimes(df['OPD_DATE'], df['ACT_TIME']).to_numpy()
+    if 'OPD_DATE' in df.columns and df['OPD_DATE'].dtype != 'category':
+        df['OPD_DATE'] = df['OPD_DATE'].astype('category')
+    return df
+
+
+_held_stores = {}  # store directory -> its open lock file, held until this process exits
+
+
+# Marks a cached store directory (a directory of memory-mapped arrays) as in use by this process, so that other
+# processes do not remove it as stale while its arrays are mapped here
+def hold_store(store_dir: Path):
+    if fcntl is None or str(store_dir) in _held_stores:
+        return
+    fil = open(Path(store_dir).joinpath(STORE_LOCK), 'a')
+    fcntl.flock(fil, fcntl.LOCK_SH)
+    _held_stores[str(store_dir)] = fil
+
+
+# Removes the cached store directories name-<hash> other than keep, skipping any that another process holds
+# Called once the current store is in place, so a failed build never leaves the cache without one; a store skipped
+# because it was in use goes on a later call
+def remove_stale_stores(cache_dir: Path, name: str, keep: Path):
+    for stale in Path(cache_dir).glob(name + '-' + '[0-9a-f]' * HASH_LENGTH):
+        if stale == Path(keep) or not stale.is_dir():
+            continue
+        if fcntl is None or not stale.joinpath(STORE_LOCK).is_file():
+            shutil.rmtree(stale, ignore_errors=True)
+            continue
+        with open(stale.joinpath(STORE_LOCK), 'a') as fil:
+            try:
+                fcntl.flock(fil, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue  # mapped by another process; a later run removes it
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+# Returns the frame cached under name for these sources, building and saving it with build() on a miss
+# Older cache files for the same name are removed when a new one is written
+def cached_frame(name: str, sources, build, cache_dir: Path = CACHE_DIR, rebuild: bool = False) -> pd.DataFrame:
+    sources = list(sources)
+    cache_dir = Path(cache_dir)
+    path = cache_dir.joinpath(name + '-' + source_hash(sources) + '.parquet')
+    if path.is_file() and not rebuild:
+        print("Loading cached " + name + " from " + str(path))
+        return pd.read_parquet(path)
+
+    df = compact_dtypes(build())
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale in cache_dir.glob(name + '-*.parquet'):
+        stale.unlink()
+    df.to_parquet(path)
+    print("Cached " + name + " to " + str(path))
+    return df
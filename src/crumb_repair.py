@@ -0,0 +1,100 @@
+from bisect import bisect_right
+
+import numpy
+
+# Out-of-order crumb repair
+# A crumb is out of order when its distance along the shape (SHAPE_DEVIATION_DIST) goes backwards relative to the
+# rest of its trip. This is the rule is_exactly_n_behind/is_exactly_n_ahead used to encode with a bounded number of
+# shifted passes; here every trip is handled in one pass over its grouped distance array, however far a crumb is out of
+# order. The crumbs kept in order are the longest run whose distances never go backwards; when several runs are that
+# long, the one whose crumbs come earliest wins, so crumbs that fall behind the trip's earlier positions are the ones
+# moved, as with the shifted passes.
+
+TOLERANCE = -0.0000001  # Floats within this amount of one another are considered equal
+
+
+# @Return index of the first row of each trip, plus a final entry for the end of the array
+# Assumes the crumbs of a trip are contiguous and in time order, as the shifted comparisons always did
+def trip_boundaries(trip_ids: numpy.ndarray) -> numpy.ndarray:
+    trip_ids = numpy.asarray(trip_ids)
+    starts = numpy.flatnonzero(trip_ids[1:] != trip_ids[:-1]) + 1
+    return numpy.concatenate(([0], starts, [len(trip_ids)]))
+
+
+# @Return for each crumb, the length of the longest run of crumbs up to and including it whose distances never go
+# backwards; patience sorting, a single O(n log n) pass
+def run_lengths(dist: numpy.ndarray) -> numpy.ndarray:
+    tails = []  # smallest tail distance of an in-order run of each length
+    lengths = numpy.zeros(len(dist), dtype=numpy.int64)
+    for i, d in enumerate(dist):
+        pos = bisect_right(tails, d - TOLERANCE)
+        if pos == len(tails):
+            tails.append(d)
+        else:
+            tails[pos] = d
+        lengths[i] = pos + 1
+    return lengths
+
+
+# Finds the largest set of crumbs in a single trip whose distances never go backwards, preferring earlier crumbs
+# among sets of the same size
+# @Return boolean array, True for crumbs that are in order
+def in_order_mask(dist: numpy.ndarray) -> numpy.ndarray:
+    dist = numpy.asarray(dist, dtype=numpy.float64)
+    keep = numpy.zeros(len(dist), dtype=bool)
+    if len(dist) == 0:
+        return keep
+    # longest in-order run starting at each crumb: the same pass over the trip backwards with negated distances
+    ahead = run_lengths(-dist[::-1])[::-1]
+    need = ahead.max()
+    last = -numpy.inf
+    # take the earliest crumb that can still start a run of the remaining length, left to right
+    for i in range(len(dist)):
+        if ahead[i] == need and dist[i] - last >= TOLERANCE:
+            keep[i] = True
+            last = dist[i]
+            need -= 1
+            if need == 0:
+                break
+    return keep
+
+
+# Reassigns every out-of-order crumb to the midpoint of its nearest in-order neighbours within the trip
+# An out-of-order run at either end of a trip takes the distance of its one in-order neighbour instead
+# @Return (repaired distances, boolean array of crumbs that were moved)
+def repair_out_of_order(trip_ids, dist):
+    trip_ids = numpy.asarray(trip_ids)
+    dist = numpy.asarray(dist, dtype=numpy.float64)
+    n = len(dist)
+    keep = numpy.ones(n, dtype=bool)
+    if n == 0:
+        return dist.copy(), ~keep
+
+    bounds = trip_boundaries(trip_ids)
+    # Only trips that actually go backwards somewhere need the per-trip pass
+    backwards = (dist[1:] - dist[:-1] < TOLERANCE) & (trip_ids[1:] == trip_ids[:-1])
+    trip_of_row = numpy.repeat(numpy.arange(len(bounds) - 1), numpy.diff(bounds))
+    for t in numpy.unique(trip_of_row[1:][backwards]):
+        lo, hi = bounds[t], bounds[t + 1]
+        keep[lo:hi] = in_order_mask(dist[lo:hi])
+
+    moved = ~keep
+    if not moved.any():
+        return dist.copy(), moved
+
+    idx = numpy.arange(n)
+    row_start = bounds[trip_of_row]
+    row_end = bounds[trip_of_row + 1] - 1
+    prev_kept = numpy.maximum.accumulate(numpy.where(keep, idx, -1))
+    next_kept = numpy.minimum.accumulate(numpy.where(keep, idx, n)[::-1])[::-1]
+    has_prev = prev_kept >= row_start
+    has_next = next_kept <= row_end
+
+    prev_dist = dist[numpy.clip(prev_kept, 0, n - 1)]
+    next_dist = dist[numpy.clip(next_kept, 0, n - 1)]
+    midpoint = numpy.where(has_prev & has_next, (prev_dist + next_dist) / 2,
+                           numpy.where(has_prev, prev_dist, next_dist))
+
+    repaired = dist.copy()
+    repaired[moved] = midpoint[moved]
+    return repaired, moved
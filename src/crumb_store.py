@@ -0,0 +1,122 @@
+from collections import namedtuple
+from pathlib import Path
+
+import json
+import os
+import shutil
+import numpy
+import pandas as pd
+
+import crumb_cache
+
+# Trip-indexed (CSR) store of breadcrumb readings
+# Readings are sorted by trip and time and kept column by column, one .npy array per column, with the sorted trip IDs
+# and an offsets array: trip trip_ids[i] is rows offsets[i]:offsets[i + 1] of every column. Opening a store maps the
+# arrays instead of reading them, so any trip's readings are a binary search and a slice with nothing copied, and
+# per-trip aggregates are one ufunc.reduceat over a column instead of a filter of the whole table per trip.
+
+META_FILE = 'columns.json'  # column names in order, so a store opens without knowing what it holds
+
+# trip_ids: sorted trip IDs; offsets: len(trip_ids) + 1 row offsets; columns: column name -> array of all readings
+CrumbStore = namedtuple('CrumbStore', ['trip_ids', 'offsets', 'columns'])
+
+
+# numpy array of a frame column that saves to a plain .npy: strings become fixed width, nullable numbers float
+def column_array(values: pd.Series) -> numpy.ndarray:
+    if pd.api.types.is_extension_array_dtype(values.dtype) and pd.api.types.is_numeric_dtype(values.dtype):
+        return values.astype('float64').to_numpy()
+    if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(str).to_numpy(dtype=str)
+    return values.to_numpy()
+
+
+# Builds a store from a frame of readings, sorted by trip_column then time_column (ties keep the frame's order)
+# columns defaults to every column but the trip column
+def build_store(df: pd.DataFrame, trip_column: str, time_column: str, columns: list = None) -> CrumbStore:
+    if columns is None:
+        columns = [c for c in df.columns if c != trip_column]
+    trips = df[trip_column].to_numpy(dtype=numpy.int64)
+    order = numpy.lexsort((column_array(df[time_column]), trips))
+    trip_ids, starts = numpy.unique(trips[order], return_index=True)
+    offsets = numpy.append(starts, len(trips)).astype(numpy.int64)
+    return CrumbStore(trip_ids, offsets, {c: column_array(df[c])[order] for c in columns})
+
+
+# Writes a store to store_dir, replacing whatever store was there
+def write_store(store: CrumbStore, store_dir: Path):
+    store_dir = Path(store_dir)
+    tmp = store_dir.with_name(store_dir.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    numpy.save(tmp.joinpath('trip_ids.npy'), store.trip_ids)
+    numpy.save(tmp.joinpath('offsets.npy'), store.offsets)
+    for n, (name, values) in enumerate(store.columns.items()):
+        numpy.save(tmp.joinpath('column-' + str(n) + '.npy'), values)
+    tmp.joinpath(META_FILE).write_text(json.dumps(list(store.columns)))
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp, store_dir)
+
+
+# Maps a store written by write_store; the arrays are read-only views of the files
+def open_store(store_dir: Path) -> CrumbStore:
+    store_dir = Path(store_dir)
+    names = json.loads(store_dir.joinpath(META_FILE).read_text())
+    return CrumbStore(numpy.load(store_dir.joinpath('trip_ids.npy'), mmap_mode='r'),
+                      numpy.load(store_dir.joinpath('offsets.npy'), mmap_mode='r'),
+                      {name: numpy.load(store_dir.joinpath('column-' + str(n) + '.npy'), mmap_mode='r')
+                       for n, name in enumerate(names)})
+
+
+# @Return the store cached under name for these sources, building it from the frame build() returns on a miss
+# Like crumb_cache.cached_frame, the directory is named after a hash of the sources; older ones are removed unless
+# another process has them mapped
+def cached_store(name: str, sources, build, trip_column: str, time_column: str, columns: list = None,
+                 cache_dir: Path = crumb_cache.CACHE_DIR, rebuild: bool = False) -> CrumbStore:
+    sources = list(sources)
+    store_dir = Path(cache_dir).joinpath(name + '-' + crumb_cache.source_hash(sources))
+    if rebuild or not store_dir.joinpath(META_FILE).is_file():
+        store = build_store(build(), trip_column, time_column, columns)
+        write_store(store, store_dir)
+        print("Cached " + name + " store to " + str(store_dir))
+    crumb_cache.remove_stale_stores(cache_dir, name, store_dir)
+    crumb_cache.hold_store(store_dir)
+    return open_store(store_dir)
+
+
+# @Return position of trip in the store, or -1 when the store does not have it
+def trip_position(store: CrumbStore, trip) -> int:
+    i = int(numpy.searchsorted(store.trip_ids, trip))
+    return i if i < len(store.trip_ids) and store.trip_ids[i] == trip else -1
+
+
+def has_trip(store: CrumbStore, trip) -> bool:
+    return trip_position(store, trip) >= 0
+
+
+# @Return the rows of a trip's readings; KeyError for an unknown trip
+def trip_slice(store: CrumbStore, trip) -> slice:
+    i = trip_position(store, trip)
+    if i < 0:
+        raise KeyError(trip)
+    return slice(int(store.offsets[i]), int(store.offsets[i + 1]))
+
+
+# @Return a trip's readings as a frame of the given columns (default all), in time order
+def trip_frame(store: CrumbStore, trip, columns: list = None) -> pd.DataFrame:
+    rows = trip_slice(store, trip)
+    return pd.DataFrame({c: store.columns[c][rows] for c in (columns or store.columns)})
+
+
+# @Return the number of readings of every trip, in trip_ids order
+def trip_lengths(store: CrumbStore) -> numpy.ndarray:
+    return numpy.diff(store.offsets)
+
+
+# @Return every trip's first value of a column (its earliest reading), in trip_ids order
+def first_values(store: CrumbStore, column: str) -> numpy.ndarray:
+    return store.columns[column][store.offsets[:-1]]
+
+
+# @Return ufunc reduced over each trip's values of a column, e.g. numpy.maximum for every trip's maximum
+def reduce_trips(store: CrumbStore, column: str, ufunc) -> numpy.ndarray:
+    return ufunc.reduceat(store.columns[column], store.offsets[:-1])
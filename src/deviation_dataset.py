@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Partitioned Parquet dataset of corrected breadcrumbs
+# Layout: <dataset>/serviceDay=YYYYMMDD/routeID=<route>/shapeID=<shape>/<part>.parquet (hive-style partitions)
+# Each shape/service-day partition is written by whichever worker computed it, so nothing is ever consolidated in
+# memory. Rows are sorted by tripID inside each file, so row-group statistics let readers skip data on tripID and
+# distance filters, and the partition directories let them skip whole files on serviceDay/routeID/shapeID.
+
+DATASET_DIR = Path().joinpath('..', 'out', 'deviations', 'dataset')
+PARTITION_COLUMNS = ['serviceDay', 'routeID', 'shapeID']
+# @SpecNotes column order of the corrected breadcrumb records, as in the original deviation_breadcrumbs.csv
+OUTPUT_COLUMNS = ['tripID', 'timestamp', 'vehicleID',
+                  'origLatitude', 'origLongitude', 'shapeID',
+                  'routeID', 'plannedTripID', 'correctedLatitude',
+                  'correctedLongitude', 'distance', 'angle']
+# Arrow type of every output column: every part file gets this schema, whichever mode or chunk wrote it
+OUTPUT_TYPES = {'tripID': pa.int32(), 'timestamp': pa.float64(), 'vehicleID': pa.int32(),
+                'origLatitude': pa.float64(), 'origLongitude': pa.float64(), 'shapeID': pa.int64(),
+                'routeID': pa.int64(), 'plannedTripID': pa.int64(), 'correctedLatitude': pa.float64(),
+                'correctedLongitude': pa.float64(), 'distance': pa.float64(), 'angle': pa.int64()}
+INTEGER_COLUMNS = [c for c in OUTPUT_COLUMNS if pa.types.is_integer(OUTPUT_TYPES[c])]
+FILE_SCHEMA = pa.schema([(c, OUTPUT_TYPES[c]) for c in OUTPUT_COLUMNS if c not in PARTITION_COLUMNS])
+ROW_GROUP_SIZE = 65536
+MISSING_ROUTE = -1  # partition value for crumbs whose shape has no route
+
+
+def partition_dir(service_day: str, route, shape, dataset_dir: Path = DATASET_DIR) -> Path:
+    return Path(dataset_dir).joinpath('serviceDay=' + str(service_day), 'routeID=' + str(route),
+                                      'shapeID=' + str(shape))
+
+
+# Removes every file of one shape/service-day partition, whatever route directory it was written under
+# Directories left empty are removed too, so a dropped service day or route does not linger in the layout
+def remove_partition(service_day: str, shape, dataset_dir: Path = DATASET_DIR):
+    for path in Path(dataset_dir).glob('serviceDay=' + str(service_day) + '/routeID=*/shapeID=' + str(shape) +
+                                       '/*.parquet'):
+        path.unlink()
+        for parent in [path.parent, path.parent.parent, path.parent.parent.parent]:
+            if any(parent.iterdir()):
+                break
+            parent.rmdir()
+
+
+# Writes one shape/service-day partition of corrected crumbs (columns OUTPUT_COLUMNS)
+# Crumbs are split by route, since a shape can be shared by several routes. Columns are cast to FILE_SCHEMA (missing
+# values become nulls) and no pandas metadata is kept, so files read back the same whatever dtypes the frame had.
+# @Return the files written
+def write_partition(crumbs: pd.DataFrame, service_day: str, shape, part_name: str = 'part-0',
+                    dataset_dir: Path = DATASET_DIR) -> list:
+    files = []
+    routes = crumbs['routeID'].fillna(MISSING_ROUTE).astype('int64')
+    for route, part in crumbs.groupby(routes, sort=True):
+        out_dir = partition_dir(service_day, route, shape, dataset_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        part = part.sort_values('tripID', kind='stable')
+        table = pa.Table.from_pandas(part[FILE_SCHEMA.names], schema=FILE_SCHEMA, preserve_index=False)
+        path = out_dir.joinpath(part_name + '.parquet')
+        pq.write_table(table.replace_schema_metadata(None), path, row_group_size=ROW_GROUP_SIZE)
+        files.append(str(path))
+    return files
+
+
+# @Return every data file of the dataset, in a stable order, for scans that work one file at a time
+def partition_files(dataset_dir: Path = DATASET_DIR) -> list:
+    return sorted(Path(dataset_dir).glob('serviceDay=*/routeID=*/shapeID=*/*.parquet'))
+
+
+# @Return (service day, shape) of every shape/service-day partition that has files, as strings
+def partitions(dataset_dir: Path = DATASET_DIR) -> set:
+    found = set()
+    for path in partition_files(dataset_dir):
+        values = dict(part.split('=', 1) for part in path.parent.parts if '=' in part)
+        found.add((values['serviceDay'], values['shapeID']))
+    return found
+
+
+# Reads one data file of the dataset (from partition_files) in OUTPUT_COLUMNS order, partition columns included
+# Partition values come from the file's directories, so the frame looks like the same rows of read_deviations
+def read_partition_file(path: Path, columns: list = None) -> pd.DataFrame:
+    if columns is None:
+        columns = OUTPUT_COLUMNS + ['serviceDay']
+    values = dict(part.split('=', 1) for part in Path(path).parent.parts if '=' in part)
+    df = pq.read_table(path, columns=[c for c in columns if c not in PARTITION_COLUMNS]).to_pandas()
+    for col in PARTITION_COLUMNS:
+        if col in columns:
+            df[col] = int(values[col])
+    return df[columns]
+
+
+# Reads the corrected crumbs back as one frame in OUTPUT_COLUMNS order (plus serviceDay)
+# filters use pyarrow's form, e.g. [('routeID', '=', 4), ('distance', '>', 60)], and are pushed down to the files
+def read_deviations(dataset_dir: Path = DATASET_DIR, columns: list = None, filters: list = None) -> pd.DataFrame:
+    if columns is None:
+        columns = OUTPUT_COLUMNS + ['serviceDay']
+    table = pq.read_table(dataset_dir, columns=columns, filters=filters, partitioning='hive')
+    df = table.to_pandas()
+    for col in PARTITION_COLUMNS:
+        if col in df.columns and df[col].dtype.name == 'category':
+            df[col] = df[col].astype(str).astype('int64')
+    return df[columns]
@@ -0,0 +1,165 @@
+from collections import namedtuple
+from pathlib import Path
+
+import argparse
+import datetime
+import json
+import os
+import numpy
+import pyarrow.parquet as pq
+
+import deviation_dataset
+import deviation_manifest
+import trip_summary
+
+# Fleet-wide deviation heatmap
+# Every corrected crumb in the deviation dataset is binned by its original position into a fixed grid of roughly
+# 100 m cells. Each cell keeps its reading count, the sum and maximum of their deviation distances and how many are
+# above DISTANCE_THRESHOLD. Cells are addressed by absolute grid row/column, so grids computed from any subset of the
+# data line up and merge by adding (and taking the maximum); a partial grid is kept per service day and only days
+# whose dataset files changed are rescanned.
+#
+# usage: python deviation_heatmap.py [--force]
+#   writes ../out/heatmap/heatmap.json, which "python tripViz.py --serve PORT --heatmap <file>" draws as one layer
+
+HEATMAP_DIR = Path().joinpath('..', 'out', 'heatmap')
+HEATMAP_FILE = 'heatmap.json'
+CELL_DEGREES = (0.0009, 0.0013)  # latitude, longitude; about 100 m x 100 m at 45.63 degrees latitude
+DISTANCE_THRESHOLD = trip_summary.DISTANCE_THRESHOLD  # meters, as sort_by_suspicion_level.py scores trips
+READ_COLUMNS = ['origLatitude', 'origLongitude', 'distance']
+KEY_OFFSET = 1 << 30  # grid rows and columns are shifted non-negative and packed into one int64 key
+
+HeatGrid = namedtuple('HeatGrid', ['cells', 'count', 'total', 'maximum', 'over'])
+
+
+def empty_grid() -> HeatGrid:
+    return HeatGrid(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0), numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64))
+
+
+def cell_keys(lats, lons) -> numpy.ndarray:
+    rows = numpy.floor(numpy.asarray(lats, dtype=numpy.float64) / CELL_DEGREES[0]).astype(numpy.int64)
+    cols = numpy.floor(numpy.asarray(lons, dtype=numpy.float64) / CELL_DEGREES[1]).astype(numpy.int64)
+    return ((rows + KEY_OFFSET) << 32) | (cols + KEY_OFFSET)
+
+
+# @Return (grid rows, grid columns) of packed cell keys
+def cell_rows_cols(keys):
+    return (keys >> 32) - KEY_OFFSET, (keys & 0xffffffff) - KEY_OFFSET
+
+
+# Bins readings into a grid; readings with no position or distance are left out
+def aggregate(lats, lons, distances, threshold: float = DISTANCE_THRESHOLD) -> HeatGrid:
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    distances = numpy.asarray(distances, dtype=numpy.float64)
+    ok = ~(numpy.isnan(lats) | numpy.isnan(lons) | numpy.isnan(distances))
+    lats, lons, distances = lats[ok], lons[ok], distances[ok]
+    if len(lats) == 0:
+        return empty_grid()
+    cells, inverse = numpy.unique(cell_keys(lats, lons), return_inverse=True)
+    maximum = numpy.full(len(cells), -numpy.inf)
+    numpy.maximum.at(maximum, inverse, distances)
+    return HeatGrid(cells, numpy.bincount(inverse, minlength=len(cells)),
+                    numpy.bincount(inverse, weights=distances, minlength=len(cells)), maximum,
+                    numpy.bincount(inverse, weights=distances > threshold, minlength=len(cells)).astype(numpy.int64))
+
+
+# Combines grids of disjoint sets of readings into the grid of all of them
+def merge(grids) -> HeatGrid:
+    grids = [g for g in grids if len(g.cells)]
+    if not grids:
+        return empty_grid()
+    cells, inverse = numpy.unique(numpy.concatenate([g.cells for g in grids]), return_inverse=True)
+    maximum = numpy.full(len(cells), -numpy.inf)
+    numpy.maximum.at(maximum, inverse, numpy.concatenate([g.maximum for g in grids]))
+
+    def add(field):
+        return numpy.bincount(inverse, weights=numpy.concatenate([getattr(g, field) for g in grids]),
+                              minlength=len(cells))
+    return HeatGrid(cells, add('count').astype(numpy.int64), add('total'), maximum, add('over').astype(numpy.int64))
+
+
+def save_grid(path: Path, grid: HeatGrid):
+    tmp = Path(path).with_suffix('.tmp.npz')
+    numpy.savez(tmp, **grid._asdict())
+    os.replace(tmp, path)
+
+
+def load_grid(path: Path) -> HeatGrid:
+    with numpy.load(path) as data:
+        return HeatGrid(**{name: data[name] for name in HeatGrid._fields})
+
+
+# @Return the grid of every reading in the given dataset files, read one file at a time
+def files_grid(files, threshold: float = DISTANCE_THRESHOLD) -> HeatGrid:
+    grids = []
+    for f in files:
+        table = pq.read_table(f, columns=READ_COLUMNS)
+        grids.append(aggregate(*(table.column(c).to_numpy() for c in READ_COLUMNS), threshold=threshold))
+    return merge(grids)
+
+
+# @Return service day -> its data files in the deviation dataset
+def day_files(dataset_dir: Path = deviation_dataset.DATASET_DIR) -> dict:
+    days = {}
+    for f in deviation_dataset.partition_files(dataset_dir):
+        day = f.relative_to(dataset_dir).parts[0].split('=', 1)[1]
+        days.setdefault(day, []).append(f)
+    return days
+
+
+# Fingerprint of a day's files: names, sizes and modification times, enough to notice a rewritten partition
+def files_fingerprint(files, threshold: float) -> dict:
+    stats = [[str(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+    return {'files': deviation_manifest.value_hash(stats), 'threshold': threshold, 'cell': list(CELL_DEGREES)}
+
+
+# Writes the merged grid as JSON for the viewer: one [row, column, count, mean, max, over] entry per cell
+def write_heatmap_json(path: Path, grid: HeatGrid, threshold: float):
+    rows, cols = cell_rows_cols(grid.cells)
+    mean = grid.total / numpy.maximum(grid.count, 1)
+    cells = [[int(r), int(c), int(n), round(float(m), 2), round(float(x), 2), int(o)]
+             for r, c, n, m, x, o in zip(rows, cols, grid.count, mean, grid.maximum, grid.over)]
+    with open(path, 'w') as fil:
+        json.dump({'cellDegrees': list(CELL_DEGREES), 'threshold': threshold, 'cells': cells}, fil)
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threshold", default=DISTANCE_THRESHOLD, type=float,
+                        help="readings deviating more than this many meters are counted per cell")
+    parser.add_argument("--force", default=False, action="store_true",
+                        help="rescan every service day, even those whose dataset files did not change")
+    return parser.parse_args()
+
+
+def main():
+    args = initialize()
+    print("Computing deviation heatmap! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+    partial_dir = HEATMAP_DIR.joinpath('days')
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {} if args.force else deviation_manifest.load_manifest(HEATMAP_DIR)
+
+    days = day_files()
+    for day in [d for d in manifest if d not in days]:
+        # the day is gone from the dataset, so its partial grid goes too
+        for f in manifest.pop(day).get('files', []):
+            Path(f).unlink(missing_ok=True)
+    stale = {day: files for day, files in days.items()
+             if deviation_manifest.is_stale(manifest, day, files_fingerprint(files, args.threshold))}
+    print(str(len(stale)) + " of " + str(len(days)) + " service days to scan")
+    for day, files in sorted(stale.items()):
+        path = partial_dir.joinpath('serviceDay=' + day + '.npz')
+        save_grid(path, files_grid(files, args.threshold))
+        manifest[day] = {'inputs': files_fingerprint(files, args.threshold), 'files': [str(path)]}
+        deviation_manifest.save_manifest(HEATMAP_DIR, manifest)
+
+    grid = merge([load_grid(entry['files'][0]) for day, entry in sorted(manifest.items())])
+    write_heatmap_json(HEATMAP_DIR.joinpath(HEATMAP_FILE), grid, args.threshold)
+    print("Heatmap of " + str(int(grid.count.sum())) + " readings in " + str(len(grid.cells)) + " cells written to " +
+          str(HEATMAP_DIR.joinpath(HEATMAP_FILE)) + ". Ended at: " + datetime.datetime.now().strftime("%H:%M:%S"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import hashlib
+import json
+import os
+import pandas as pd
+
+# Manifest of per-shape, per-service-day deviation outputs
+# Every output partition records fingerprints of what it was computed from: its input crumbs, the shape geometry,
+# the trip2shape rows of its trips and the algorithm constants. A rerun only recomputes partitions whose fingerprint
+# changed (or whose files are gone), so adding a day of breadcrumbs costs one day of compute.
+
+MANIFEST_NAME = '_manifest.json'  # leading underscore: Parquet dataset readers skip it
+CRUMB_INPUT_COLUMNS = ['trip_id', 'OPD_DATE', 'ACT_TIME', 'VEHICLE_ID', 'GPS_LATITUDE', 'GPS_LONGITUDE',
+                       'vehicle_number', 'route_number']
+TRIP2SHAPE_COLUMNS = ['trip_id', 'shapeID', 'plannedTripID']
+
+
+# @Return short hex digest of a frame's values, independent of its index
+def frame_hash(df: pd.DataFrame) -> str:
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha1(hashes.tobytes()).hexdigest()[:16]
+
+
+# @Return short hex digest of any JSON-serializable value, e.g. a dict of algorithm constants
+def value_hash(value) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def partition_key(shape, service_day: str) -> str:
+    return str(shape) + '/' + service_day
+
+
+# @Return (shape, service day) of a partition key, both as strings
+def split_key(key: str):
+    shape, service_day = key.split('/', 1)
+    return shape, service_day
+
+
+# @Return the fingerprint of one partition of crumbs; shape_hash and constants_hash are shared by the whole shape
+def partition_fingerprint(crumbs: pd.DataFrame, shape_hash: str, constants_hash: str) -> dict:
+    crumb_cols = [c for c in CRUMB_INPUT_COLUMNS if c in crumbs.columns]
+    mapping_cols = [c for c in TRIP2SHAPE_COLUMNS if c in crumbs.columns]
+    return {'crumbs': frame_hash(crumbs[crumb_cols]),
+            'shape': shape_hash,
+            'trip2shape': frame_hash(crumbs[mapping_cols].drop_duplicates()),
+            'constants': constants_hash}
+
+
+def load_manifest(out_dir: Path) -> dict:
+    path = Path(out_dir).joinpath(MANIFEST_NAME)
+    if not path.is_file():
+        return {}
+    with open(path) as fil:
+        return json.load(fil)
+
+
+# Written to a temporary file first, so an interrupted run never leaves a half-written manifest behind
+def save_manifest(out_dir: Path, manifest: dict):
+    path = Path(out_dir).joinpath(MANIFEST_NAME)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as fil:
+        json.dump(manifest, fil, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+# @Return True when the partition must be recomputed
+def is_stale(manifest: dict, key: str, fingerprint: dict) -> bool:
+    entry = manifest.get(key)
+    if entry is None or entry.get('inputs') != fingerprint:
+        return True
+    return not all(Path(f).is_file() for f in entry.get('files', []))
@@ -0,0 +1,5 @@
+# Deviation thresholds shared by the scoring, heatmap and viewer scripts, in meters
+# Kept free of imports so that light tools (tripViz.py) can share them without loading the dataset libraries
+
+DISTANCE_THRESHOLD = 60  # Portland city blocks are about 60 m wide; crumbs farther off their shape are deviations
+SUSPICIOUSLY_TOO_FAR = 1000  # trips whose mean deviation is at least this far are set aside as 'bad'
@@ -1,17 +1,14 @@
 from pathlib import Path
+import numpy
 import pandas as pd
-import datetime
 import matplotlib.pyplot as plt
 
-path = Path().joinpath('OriginalData', 'cyclic_data_20200224_0320_wkd')
-files = path.glob("*.tsv")
-li = []
-
-for filename in files:
-    df = pd.read_csv(filename, sep='\t', header=0)
-    li.append(df)
+import breadcrumb_reader
+import crumb_store
+import timestamps
 
-crumbs = pd.concat(li, axis=0, ignore_index=True)
+path = Path().joinpath('OriginalData', 'cyclic_data_20200224_0320_wkd')
+crumbs = breadcrumb_reader.read_breadcrumbs(path, clean=False)  # keep every reading so the counts below are unchanged
 cad_avl = pd.read_csv(Path().joinpath('OriginalData', 'C-Tran_CAD_AVL_trips_Feb+Mar2020', 'C-Tran_CAD_AVL_trips_Feb'
                                                                                           '+Mar2020.csv'))
 # Set up joins
@@ -56,16 +53,8 @@ cad_avl_datatypes = cad_avl.dtypes
 # b) Produce a copy of the breadcrumb data with the fields
 # OPD_DATE and ACT_TIME reduced to a single field called TIMESTAMP
 df2 = df.copy()
-df2.insert(9, 'TIMESTAMP', float)
-prog = 0
-for index, row in df2.iterrows():
-    ts = datetime.datetime
-    ts = ts.strptime(row['OPD_DATE'], '%d-%b-%y') + datetime.timedelta(seconds=row['ACT_TIME'])
-    df2.at[index, 'TIMESTAMP'] = ts.timestamp()
-    if prog % 80000 == 0:  # About 8 mil records total
-        print(str(prog) + ' records processed (of ' + str(df2['OPD_DATE'].size)
-              + '): currently ' + str(df2.at[index, 'TIMESTAMP']))
-    prog += 1
+epoch_seconds, _ = timestamps.crumb_timestamps(df2['OPD_DATE'], df2['ACT_TIME'])
+df2.insert(9, 'TIMESTAMP', epoch_seconds)
 
 del df2['OPD_DATE']
 del df2['ACT_TIME']
@@ -82,17 +71,17 @@ num_trips = df.query('route_number == 78').drop_duplicates(['OPD_DATE', 'trip_id
 # Is it the same number of trips each day? No - this route only appears to have run for four days
 
 # Compute the time taken for each trip and summarize these times as follows:
+# The readings are indexed by trip once (see crumb_store.py), so every trip's duration comes out of one pass over
+# ACT_TIME instead of a query of the whole table per trip
+trip_crumbs = crumb_store.cached_store('explore-trips', breadcrumb_reader.breadcrumb_files(path),
+                                       lambda: crumbs.dropna(subset=['EVENT_NO_TRIP']), 'EVENT_NO_TRIP', 'ACT_TIME',
+                                       ['ACT_TIME'], cache_dir=Path().joinpath('data', 'cache'))
+durations = pd.Series(crumb_store.reduce_trips(trip_crumbs, 'ACT_TIME', numpy.fmax) -
+                      crumb_store.reduce_trips(trip_crumbs, 'ACT_TIME', numpy.fmin), index=trip_crumbs.trip_ids)
+
 trips = pd.DataFrame(df.query('route_number == 78')['EVENT_NO_TRIP'].unique())
-trips.insert(1, "trip_duration", int)
-trips.columns = ['trip_number', 'trip_duration']
-prog = 0
-for index, row in trips.iterrows():
-    a_trip = df.query('EVENT_NO_TRIP == @row["trip_number"]')
-    trips.at[index, 'trip_duration'] = a_trip['ACT_TIME'].max() - a_trip['ACT_TIME'].min()
-    if prog % 100 == 0:  # about 2k rows to be processed total
-        print(str(prog) + ' records processed (of ' + str(trips['trip_number'].size)
-              + '): currently ' + str(trips.at[index, 'trip_duration']))
-    prog += 1
+trips.columns = ['trip_number']
+trips['trip_duration'] = durations.reindex(trips['trip_number']).to_numpy()
 
 # Minimum trip time? 116 seconds
 min_trip_time = trips['trip_duration'].min()
@@ -109,16 +98,8 @@ std_trip_time = trips['trip_duration'].std
 # 8. Plot
 # The probability distribution of trip times for the route with route_short_name=‘67’
 trips = pd.DataFrame(df.query('route_number == 67')['EVENT_NO_TRIP'].unique())
-trips.insert(1, "trip_duration", int)
-trips.columns = ['trip_number', 'trip_duration']
-prog = 0
-for index, row in trips.iterrows():
-    a_trip = df.query('EVENT_NO_TRIP == @row["trip_number"]')
-    trips.at[index, 'trip_duration'] = a_trip['ACT_TIME'].max() - a_trip['ACT_TIME'].min()
-    if prog % 100 == 0:  # about 2k rows to be processed total
-        print(str(prog) + ' records processed (of ' + str(trips['trip_number'].size)
-              + '): currently ' + str(trips.at[index, 'trip_duration']))
-    prog += 1
+trips.columns = ['trip_number']
+trips['trip_duration'] = durations.reindex(trips['trip_number']).to_numpy()
 
 trips['trip_duration'].plot.density()
 plt.show()
@@ -0,0 +1,351 @@
+from collections import deque
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import os
+import sys
+import time
+import numpy
+import pandas as pd
+
+import crumb_cache
+import crumb_repair
+import deviation_dataset
+import matchTripToShape as mt
+import shape_index
+import shape_store
+import timestamps
+import trip2shape_cache
+import variance_calculator as vc
+
+# live_corrector.py: correct breadcrumb positions as vehicles report them
+#
+# Reads breadcrumb rows in the cyclic_data_* TSV format (a header line, then one reading per line) from stdin, a file
+# that is still being written (--follow), or a local TCP socket (--port), and writes one corrected record per reading
+# as CSV in the deviation_breadcrumbs column order.
+#
+# Each reading is projected onto its trip's shape with the same segment index the batch pipeline uses, and checked
+# for being out of order with the same repair rule (see crumb_repair.py), applied to a bounded look-back window of the
+# trip's last --window distances. With --delay N a reading is held until N later readings of its trip arrive, so a
+# reading that turns out to be out of order is placed between its neighbours exactly like in batch; with the default
+# of 0 it is emitted right away and an out-of-order reading takes the distance of the last in-order one.
+#
+# Trips are looked up in the trip2shape mapping already cached for the feed (see trip2shape_cache.py), if any; no
+# mapping run is started. A trip the mapping does not cover is matched to a shape as it arrives, the way
+# matchTripToShape.py does: its CAD/AVL route gives the candidate shapes, and when there are several its readings are
+# held until --match-readings of them have come in (or the trip ends) and the closest shape wins. The result is kept
+# for the rest of the trip. Unlike a batch run, which samples the whole trip, only those first readings are compared.
+# Trips missing from the CAD/AVL file have no route, so they cannot be matched: their readings are counted as
+# unmapped, apart from the readings skipped for having no GPS fix.
+#
+# examples:
+#   python replay_breadcrumbs.py -r 500 ../data/original/cyclic_data_20200224_0320_wkd | python live_corrector.py
+#   python live_corrector.py --port 9000 --delay 3
+#   python live_corrector.py --follow live_feed.tsv -o corrected.csv
+
+DEFAULT_WINDOW = 30  # earlier distances kept per trip; should exceed the most places a reading is out of order by
+DEFAULT_DELAY = 0
+DEFAULT_MATCH_READINGS = mt.TRAJECTORY_POINTS  # readings of an unmapped trip compared with its candidate shapes
+DEFAULT_IDLE_TIMEOUT = 300.0  # seconds of silence before a trip's held readings are flushed and its state dropped
+FOLLOW_POLL = 0.2  # seconds between checks for new lines in --follow mode
+
+trip_states = {}  # trip ID -> per-trip state, see new_trip_state()
+vehicle_trips = {}  # vehicle ID -> its current trip ID
+shape_indexes = {}  # shape ID -> shape_index.ShapeIndex, built the first time a shape is seen
+trip2shape = {}  # trip ID -> (shape ID, planned trip ID), or None for a trip that could not be matched
+unresolved = {}  # trip ID -> state of a trip being matched to a shape, see start_matching()
+matched = {}  # trip ID -> time of the last reading of a trip in trip2shape because it was matched here, not cached
+shape_routes = {}  # shape ID -> route ID
+shape_vertices = {}  # shape ID -> vertex array in meters
+out = sys.stdout
+stats = {'read': 0, 'emitted': 0, 'skipped': 0, 'unmapped': 0, 'latency': 0.0}
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-f", "--follow", default=None,
+                        help="tail this file for new breadcrumb rows instead of reading stdin")
+    source.add_argument("-p", "--port", default=None, type=int,
+                        help="accept breadcrumb rows on this localhost TCP port instead of reading stdin")
+    parser.add_argument("-o", "--output", default=None, help="write corrected records here instead of stdout")
+    parser.add_argument("-w", "--window", default=DEFAULT_WINDOW, type=int,
+                        help="number of earlier distances per trip kept for the out-of-order check")
+    parser.add_argument("-d", "--delay", default=DEFAULT_DELAY, type=int,
+                        help="readings to hold back per trip so out-of-order ones can be placed between neighbours")
+    parser.add_argument("--idle-timeout", default=DEFAULT_IDLE_TIMEOUT, type=float,
+                        help="seconds of silence after which a trip is flushed and forgotten")
+    parser.add_argument("-m", "--match-readings", default=DEFAULT_MATCH_READINGS, type=int,
+                        help="readings of a trip missing from the trip2shape mapping used to pick its shape")
+    return parser.parse_args()
+
+
+# Loads the cached trip2shape mapping, if any, and shape geometry once; segment indexes are built lazily per shape
+# The GTFS feed and CAD/AVL trips are also indexed for matching the trips the mapping does not cover
+def load_lookups():
+    mapping_file = trip2shape_cache.latest_mapping_file(vc.GTFS_DIR, vc.CAD_AVL_FILE)
+    if mapping_file is not None:
+        tripToShape = pd.read_csv(mapping_file).dropna(subset=['shapeID'])
+        for trip, row in zip(tripToShape['tripID'], tripToShape[['shapeID', 'plannedTripID']].itertuples(index=False)):
+            trip2shape[int(trip)] = (int(row.shapeID), row.plannedTripID)
+        print(str(len(trip2shape)) + " trips mapped to shapes by " + str(mapping_file))
+    else:
+        print("No cached trip2shape mapping; every trip is matched to a shape as it arrives")
+    shp = vc.load_shapes().drop_duplicates('shape_index')
+    store = vc.load_shape_store()
+    for shape, route in zip(shp['shape_index'], shp['route_index']):
+        if shape_store.has_shape(store, shape):
+            shape_vertices[shape] = shape_store.shape_vertices(store, shape, vc.LAT_DIST, vc.LON_DIST)
+        shape_routes[shape] = route
+
+    mt.DEBUG = False
+    mt.gtfsdir = str(vc.GTFS_DIR)
+    mt.shapesfile = os.path.join(str(vc.GTFS_DIR), "shapes.txt")
+    mt.shapesdir = str(vc.SHAPE_STORE_DIR)
+    mt.cadavlfile = str(vc.CAD_AVL_FILE)
+    mt.cachedir = str(crumb_cache.CACHE_DIR)
+    mt.ingest_feed()
+
+
+def get_shape_index(shape) -> shape_index.ShapeIndex:
+    if shape not in shape_indexes:
+        shape_indexes[shape] = shape_index.load_or_build_shape_index(shape_vertices[shape], crumb_cache.CACHE_DIR,
+                                                                     name=vc.index_name(shape))
+    return shape_indexes[shape]
+
+
+def new_trip_state(trip, shape, window: int) -> dict:
+    return {'trip': trip, 'shape': shape, 'index': get_shape_index(shape),
+            'history': deque(maxlen=window),  # projected distances along the shape of readings already emitted
+            'pending': [],  # readings held back by --delay: (fields, x, y, along, received at)
+            'last_seen': time.monotonic()}
+
+
+def emit(state: dict, fields: dict, x: float, y: float, along: float, moved: bool, received: float):
+    if moved:
+        xs, ys = shape_index.interpolate_points(state['index'], [along])
+        x, y = xs[0], ys[0]
+    lon = float(fields['GPS_LONGITUDE'])
+    lat = float(fields['GPS_LATITUDE'])
+    shape = state['shape']
+    record = {'tripID': state['trip'],
+              'timestamp': timestamps.crumb_timestamp(fields['OPD_DATE'], float(fields['ACT_TIME'])),
+              'vehicleID': fields.get('VEHICLE_ID', ''),
+              'origLatitude': lat,
+              'origLongitude': lon,
+              'shapeID': shape,
+              'routeID': shape_routes.get(shape, ''),
+              'plannedTripID': trip2shape[state['trip']][1],
+              'correctedLatitude': y / vc.LAT_DIST,
+              'correctedLongitude': x / vc.LON_DIST,
+              'distance': vc.get_distance2(lon * vc.LON_DIST, lat * vc.LAT_DIST, x, y),
+              'angle': 0}
+    out.write(','.join(str(record[c]) for c in deviation_dataset.OUTPUT_COLUMNS) + '\n')
+    stats['emitted'] += 1
+    stats['latency'] += time.monotonic() - received
+
+
+# Emits held readings of a trip until no more than keep are left
+# Each emitted reading is repaired against the look-back window plus every reading still held behind it
+def release(state: dict, keep: int):
+    while len(state['pending']) > keep:
+        history = list(state['history'])
+        dists = numpy.array(history + [p[3] for p in state['pending']])
+        repaired, moved = crumb_repair.repair_out_of_order(numpy.zeros(len(dists), dtype=int), dists)
+        fields, x, y, along, received = state['pending'].pop(0)
+        n = len(history)
+        emit(state, fields, x, y, repaired[n], moved[n], received)
+        state['history'].append(along)  # the raw distance, so later checks see the same inputs as a batch run
+    out.flush()
+
+
+# Emits a trip's held readings and drops its state, including the shape it was matched to here, if any
+# (a trip that reports again afterwards is matched anew)
+def finish_trip(trip, args):
+    if trip in unresolved:
+        resolve_trip(trip, args)
+    state = trip_states.pop(trip, None)
+    if state is not None:
+        release(state, 0)
+    if matched.pop(trip, None) is not None:
+        trip2shape.pop(trip, None)
+        mt.trip_starts.pop(trip, None)
+
+
+# Starts matching a trip the mapping does not cover, from its first reading
+# A trip with one candidate shape is mapped right away; with none (no CAD/AVL route) it is mapped to None
+def start_matching(trip, fields: dict, received: float):
+    matched[trip] = received
+    candidates = mt.trip2candidates(trip) if trip in mt.trip_routes else None
+    if candidates is None or len(candidates) == 0:
+        trip2shape[trip] = None
+        return
+    date = pd.to_datetime(fields['OPD_DATE'], format=timestamps.OPD_DATE_FORMAT)
+    mt.trip_starts[trip] = (date, float(fields['ACT_TIME']))
+    if len(candidates) == 1:
+        trip2shape[trip] = (int(candidates[0]), mt.shape2plannedtrip(candidates[0], trip))
+        return
+    unresolved[trip] = {'candidates': candidates,
+                        'readings': [],  # readings held until the shape is picked: (fields, x, y, received at)
+                        'last_seen': received}
+
+
+# Picks the shape of a trip being matched from the readings held so far, then processes those readings
+def resolve_trip(trip, args):
+    state = unresolved.pop(trip)
+    readings = state['readings']
+    mt.trip_samples[trip] = (numpy.array([r[1] for r in readings]), numpy.array([r[2] for r in readings]))
+    shape = int(mt.matchShape(state['candidates'], trip)[0])
+    del mt.trip_samples[trip]
+    trip2shape[trip] = (shape, mt.shape2plannedtrip(shape, trip))
+    for fields, x, y, received in readings:
+        add_reading(trip, fields, x, y, received, args)
+
+
+# Projects one reading of a trip whose shape is known and queues it for release
+def add_reading(trip, fields: dict, x: float, y: float, received: float, args):
+    if trip2shape[trip] is None or trip2shape[trip][0] not in shape_vertices:
+        stats['unmapped'] += 1
+        return
+    state = trip_states.get(trip)
+    if state is None:
+        state = trip_states[trip] = new_trip_state(trip, trip2shape[trip][0], args.window)
+    state['last_seen'] = received
+    px, py, along, _ = shape_index.project_points(state['index'], [x], [y])
+    state['pending'].append((fields, px[0], py[0], along[0], received))
+    release(state, args.delay)
+
+
+# Handles one breadcrumb reading; header is the list of column names from the stream's first line
+def handle_line(line: str, header: list, args):
+    received = time.monotonic()
+    fields = dict(zip(header, line.rstrip('\r\n').split('\t')))
+    stats['read'] += 1
+    try:
+        trip = int(float(fields['EVENT_NO_TRIP']))
+        x = float(fields['GPS_LONGITUDE']) * vc.LON_DIST
+        y = float(fields['GPS_LATITUDE']) * vc.LAT_DIST
+    except (KeyError, ValueError, OverflowError):
+        x = y = numpy.nan
+    if numpy.isnan(x) or numpy.isnan(y):
+        stats['skipped'] += 1  # no trip or no GPS fix, the same rows the batch cleanup drops
+        return
+
+    # A vehicle starting a new trip means its previous trip is over
+    vehicle = fields.get('VEHICLE_ID')
+    if vehicle is not None and vehicle_trips.get(vehicle, trip) != trip:
+        finish_trip(vehicle_trips[vehicle], args)
+    vehicle_trips[vehicle] = trip
+
+    if trip not in trip2shape and trip not in unresolved:
+        start_matching(trip, fields, received)
+    if trip in matched:
+        matched[trip] = received
+    if trip in unresolved:
+        state = unresolved[trip]
+        state['readings'].append((fields, x, y, received))
+        state['last_seen'] = received
+        if len(state['readings']) >= args.match_readings:
+            resolve_trip(trip, args)
+        return
+    add_reading(trip, fields, x, y, received, args)
+
+
+async def consume(lines, args):
+    header = None
+    async for line in lines:
+        if not line.strip():
+            continue
+        if header is None:
+            header = line.rstrip('\r\n').split('\t')
+            continue
+        handle_line(line, header, args)
+
+
+async def stdin_lines():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield line.decode()
+
+
+async def follow_lines(fname: str):
+    with open(fname) as fil:
+        while True:
+            line = fil.readline()
+            if line:
+                yield line
+            else:
+                await asyncio.sleep(FOLLOW_POLL)
+
+
+async def socket_lines(reader: asyncio.StreamReader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield line.decode()
+
+
+# Flushes and forgets trips that have gone quiet, so state stays bounded on a feed that never ends
+# Only the trip2shape entries loaded from the cached mapping are kept; the ones of trips matched here go with the trip
+async def evict_idle(args):
+    while True:
+        await asyncio.sleep(min(args.idle_timeout, 10.0))
+        now = time.monotonic()
+        idle = [t for t, s in list(unresolved.items()) + list(trip_states.items())
+                if now - s['last_seen'] > args.idle_timeout]
+        idle += [t for t, seen in matched.items() if now - seen > args.idle_timeout]
+        for trip in set(idle):
+            finish_trip(trip, args)
+
+
+async def run(args):
+    evictor = asyncio.create_task(evict_idle(args))
+    if args.port is not None:
+        async def handle_client(reader, writer):
+            await consume(socket_lines(reader), args)
+            writer.close()
+
+        server = await asyncio.start_server(handle_client, host='127.0.0.1', port=args.port)
+        print("Listening for breadcrumbs on 127.0.0.1:" + str(args.port), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    elif args.follow is not None:
+        await consume(follow_lines(args.follow), args)
+    else:
+        await consume(stdin_lines(), args)
+    evictor.cancel()
+
+
+def main():
+    global out
+    args = initialize()
+    print("Loading trip and shape lookups... Began: " + datetime.datetime.now().strftime("%H:%M:%S"), file=sys.stderr)
+    with contextlib.redirect_stdout(sys.stderr):  # keep the loaders' progress prints out of the corrected records
+        load_lookups()
+    if args.output is not None:
+        out = open(args.output, 'w')
+    out.write(','.join(deviation_dataset.OUTPUT_COLUMNS) + '\n')
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for trip in list(unresolved) + list(trip_states):
+            finish_trip(trip, args)
+        out.flush()
+        mean_latency = stats['latency'] / stats['emitted'] * 1000 if stats['emitted'] else 0.0
+        print(f"read {stats['read']} readings, emitted {stats['emitted']}, skipped {stats['skipped']} without a GPS "
+              f"fix, {stats['unmapped']} unmapped (no shape for their trip), mean latency {mean_latency:.3f} ms",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,8 @@
 from pathlib import Path
-import pandas as pd
 
-new_path = Path().joinpath('.', 'out', 'suspicion_level', 'suspiciously_too_far.csv')
-df = pd.read_csv(new_path)
+import trip_store
 
-trips = df.groupby('tripID').mean()
-trips = trips.reset_index()
+# Trips that deviate some of the time but not all of it, least suspicious first, from the trip store
+new_path = Path().joinpath('.', 'out', 'suspicion_level', trip_store.STORE_FILE.name)
+trips = trip_store.level_range(0, 1, path=new_path)
 trips = trips[['tripID', 'suspicionLevel']]
-
-trips = trips.sort_values('suspicionLevel')
-trips = trips.query('suspicionLevel < 1 & suspicionLevel > 0')
-
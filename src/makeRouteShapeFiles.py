@@ -1,32 +1,23 @@
 from pathlib import Path
 import pandas as pd
-import shutil as st
 
-routes = pd.read_csv(Path().joinpath('data','original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105',
-                                     'routes.txt'))
-shapes = pd.read_csv(Path().joinpath('data','original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105',
-                                     'shapes.txt'))
-trips = pd.read_csv(Path().joinpath('data','original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105',
-                                    'trips.txt'))
+import shape_store
 
-# Explanation: indices get lost in the merge, so we need to dup them
-routes.insert(0, 'route_index', routes['route_id'])
-trips.insert(0, 'shape_index', trips['shape_id'])
-
-# Join
-df = routes.set_index('route_id').join(trips.set_index('route_id'))
-df.drop_duplicates(['route_index', 'shape_index'], inplace=True)
-df = df.set_index('shape_id').join(shapes.set_index('shape_id'))
-df = df[['route_index', 'shape_index', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'route_long_name']]
-
-# Write each shape to its own file under a directory named the value of route_index
-for subdir in Path().joinpath('out', 'shapes').iterdir():
-    st.rmtree(subdir)
-
-for route_id in df['route_index'].unique():
-    Path().joinpath('out', 'shapes', str(route_id)).mkdir(exist_ok=True)
-    subset = df.query('route_index == @route_id')
-    for shape_id in subset['shape_index'].unique():
-        df2 = subset.query('shape_index == @shape_id').sort_values(by='shape_pt_sequence')
-        df2.to_csv(Path().joinpath('out', 'shapes', str(route_id), str(shape_id) + '.csv'))
+# Writes every GTFS shape, and which shapes each route uses, to a binary shape store under out/shapes, one store per
+# shapes file of the feed (shapes.txt, and newshapes.txt when present), with hashes of the files it was built from.
+# matchTripToShape, variance_calculator and tripViz map these stores through shape_store.load_store while they are
+# current, instead of building their own in the cache.
+gtfs_dir = Path().joinpath('data', 'original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105')
+out_dir = Path().joinpath('out', 'shapes')
+trips_file = gtfs_dir.joinpath('trips.txt')
+trips = pd.read_csv(trips_file, usecols=['route_id', 'shape_id'])
 
+for shapes_file in [gtfs_dir.joinpath('shapes.txt'), gtfs_dir.joinpath('newshapes.txt')]:
+    if not shapes_file.is_file():
+        continue
+    # One pass: points are sorted by shape and sequence once and sliced by offsets, routes are grouped the same way
+    store = shape_store.build_arrays(pd.read_csv(shapes_file, low_memory=False), trips)
+    store_dir = shape_store.emitted_dir(out_dir, shapes_file)
+    shape_store.write_store(store, store_dir, shape_store.source_hashes(shapes_file, trips_file))
+    print(f"wrote {len(store.shape_ids)} shapes ({len(store.coords)} points) of {len(store.route_ids)} routes "
+          f"to {store_dir}")
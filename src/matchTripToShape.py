@@ -1,3 +1,5 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import os
@@ -7,170 +9,510 @@ import argparse
 import matplotlib.pyplot as plt
 import sys, traceback
 
+import breadcrumb_reader
+import crumb_cache
+import crumb_store
+import planar_units
+import shape_index
+import shape_store
+import timestamps
+
 #global declarations
 routes_df = pd.DataFrame()
-shapes_df = pd.DataFrame()
+shapes = None	# shape_store.ShapeStore of shapesfile, memory-mapped
 trips_df = pd.DataFrame()
 cadavl_df = pd.DataFrame()
 trip2shape_df = pd.DataFrame()
 breadcrumbfiles = ["bos_2020022428.tsv","bos_20200301620.tsv","bos_2020030206.tsv","bos_2020030913.tsv"]
 bc_df = pd.DataFrame()
+bc_store = None	# bc_df's readings as a crumb_store.CrumbStore, sorted by trip and time
+STORE_COLUMNS = ['date', 'ACT_TIME', 'GPS_LONGITUDE', 'GPS_LATITUDE']	# the columns matching reads per trip
+
+# lookup tables built once at ingest, so each trip's mapping is a few dictionary lookups instead of table scans
+trip_routes = {}	# CAD/AVL trip_number -> route_number (route_short_name)
+route_info = {}		# route_short_name -> (route_id, route_long_name)
+shape_trips = {}	# shape_id -> planned trip_ids using that shape, in the order they appear in trips.txt
+
+# planned trip selection: the planned trip of the matched shape, running that day, that starts nearest the recorded trip
+planned_starts = {}	# (shape_id, service_id) -> (sorted first departure times in seconds, their planned trip_ids)
+shape_services = {}	# shape_id -> service_ids of its planned trips
+calendar_df = pd.DataFrame()	# calendar.txt
+calendar_dates_df = pd.DataFrame()	# calendar_dates.txt, if the feed has one
+active_services = {}	# service date -> set of service_ids running that day, filled as dates come up
+trip_starts = {}	# recorded trip (EVENT_NO_TRIP) -> (service date, seconds after midnight of its first breadcrumb)
+
+# trajectory matching: trips are compared with shapes on a sample of their breadcrumbs, in meters
+trip_samples = {}	# recorded trip (EVENT_NO_TRIP) -> (x, y) arrays of its sampled breadcrumbs
+shape_vertices = {}	# shape_id -> vertex array, in shape_pt_sequence order
+shape_boxes = {}	# shape_id -> bounding box [min x, min y, max x, max y]
+shape_indexes = {}	# shape_id -> shape_index.ShapeIndex, built the first time the shape is scored
+TRAJECTORY_POINTS = 24	# breadcrumbs sampled per trip, evenly spaced from first to last
+SCORE_BLOCK = 8		# sampled points projected between early-exit checks
+AMBIGUOUS_MARGIN = 15.0	# meters; trips whose two best shapes score closer than this are reported
 DEBUG = True
+DEFAULT_WORKERS = 1	# trips are mapped in this process unless --workers says otherwise
 need2translate = False
 
 gtfsdir = "google_transit_20200105"
 cadavlfile = "C-Tran_CAD_AVL_trips_Feb+Mar2020.csv"
 shapesfile = os.path.join(gtfsdir,"shapes.txt")
+shapesdir = "shapes"	# makeRouteShapeFiles' shape stores; one built from shapesfile is mapped instead of caching another
 trip2shape_file = "foo.csv"
+ambiguous_file = "ambiguous_trips.csv"
+cachedir = "cache"  # cleaned breadcrumbs are cached here, keyed by a hash of the breadcrumb files
 
 breadcrumbfiles = ["cases/breadcrumbs_small.tsv"]
 
+def initialize():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-w", "--workers", default=DEFAULT_WORKERS, type=int,
+						help="number of processes mapping routes' trips to shapes in parallel")
+	return parser.parse_args()
+
 def readData(fname, s=',', parsed=[], idf=False):
 	if (DEBUG): print("reading file:", fname)
 	df = pd.read_csv(fname, sep=s, parse_dates=parsed, infer_datetime_format=idf,
 					 low_memory=False)
 	return df
 
-# find the distance score for the input shape (shapeID) and recorded trip (tlis)
-# this is a placeholder until we have a better 
-# trip deviation metric (the measurement of how much a recorded trip deviates from 
-# its planned trip)
-def distanceScore(shapeID, tlis):
-	
-	# find all of the coordinates for the input shape
-	df = shapes_df.loc[shapes_df['shape_id'] == shapeID]
-
-	# calculate Manhattan distance from first point in recorded trip to first point in shape
-	first_trip_coord = tlis[0]
-	first_trip_lat = first_trip_coord[0]
-	first_trip_lon = first_trip_coord[1]
-
-	first_shape_lat = df['shape_pt_lat'].iloc[0]
-	first_shape_lon = df['shape_pt_lon'].iloc[0]
-
-	# calculate the Manhattan distance between the first coords of trip and shape
-	# it would be more accurate to compute the Euclidean distance
-	# but for our purposes Manhattan distance is good enough
-	first_dist = abs(first_trip_lat - first_shape_lat) + abs(first_trip_lon - first_shape_lon)
-
-	# calculate distance from end point of recorded trip to end point of shape
-	last_trip_coord = tlis[-1]
-	last_trip_lat = last_trip_coord[0]
-	last_trip_lon = last_trip_coord[1]
-	last_shape_lat = df['shape_pt_lat'].iloc[-1]
-	last_shape_lon = df['shape_pt_lon'].iloc[-1]
-
-	# compute Manhattan distance for final coordinates of shape and trip
-	last_dist = abs(last_trip_lat - last_shape_lat) + abs(last_trip_lon - last_shape_lon)
-
-	dist = first_dist + last_dist 
-
-	return dist
-
-# of all the trips/shapes that match this trip, which one is best?
-def pickShapeFromList(slis, tripID):
-	nshape = len(slis)
-	if (nshape < 1):
+# sample up to TRAJECTORY_POINTS evenly spaced breadcrumbs of every trip, always including its first and last
+def sample_trips():
+	lons = bc_store.columns['GPS_LONGITUDE']
+	lats = bc_store.columns['GPS_LATITUDE']
+	samples = {}
+	for tid, start, n in zip(bc_store.trip_ids, bc_store.offsets[:-1], crumb_store.trip_lengths(bc_store)):
+		pick = start + np.unique(np.linspace(0, n - 1, min(n, TRAJECTORY_POINTS)).round().astype(np.int64))
+		samples[tid] = (lons[pick] * planar_units.LON_DIST, lats[pick] * planar_units.LAT_DIST)
+	return samples
+
+# every shape's vertices in meters and its bounding box, sliced out of the shape store
+def index_shapes():
+	for sid in shapes.shape_ids.tolist():
+		v = shape_store.shape_vertices(shapes, sid, planar_units.LAT_DIST, planar_units.LON_DIST)
+		shape_vertices[sid] = v
+		shape_boxes[sid] = np.concatenate([v.min(axis=0), v.max(axis=0)])
+
+def get_shape_index(shapeID):
+	if (shapeID not in shape_indexes):
+		shape_indexes[shapeID] = shape_index.load_or_build_shape_index(
+			shape_vertices[shapeID], cachedir, name=os.path.splitext(os.path.basename(shapesfile))[0] + '-' + str(shapeID))
+	return shape_indexes[shapeID]
+
+# distance from each point to a bounding box, which is never more than its distance to the shape inside the box
+def boxDistances(box, xs, ys):
+	dx = np.maximum(np.maximum(box[0] - xs, xs - box[2]), 0.0)
+	dy = np.maximum(np.maximum(box[1] - ys, ys - box[3]), 0.0)
+	return np.hypot(dx, dy)
+
+# find the trajectory score of a recorded trip against a shape:
+# the mean distance in meters from the trip's sampled breadcrumbs to the shape
+# points are projected a block at a time, and scoring stops with inf as soon as the partial sum plus the
+# bounding-box bound of the points not yet projected shows the score cannot come in under limit
+def trajectoryScore(tripID, shapeID, limit=np.inf):
+	xs, ys = trip_samples[tripID]
+	bound = boxDistances(shape_boxes[shapeID], xs, ys)
+	remaining = bound.sum()
+	total = 0.0
+	index = get_shape_index(shapeID)
+	block = SCORE_BLOCK if np.isfinite(limit) else len(xs)	# with nothing to beat, project everything at once
+	for lo in range(0, len(xs), block):
+		hi = lo + block
+		total += shape_index.project_points(index, xs[lo:hi], ys[lo:hi])[3].sum()
+		remaining -= bound[lo:hi].sum()
+		if ((total + remaining) / len(xs) > limit):
+			return np.inf
+	return total / len(xs)
+
+# of all the shapes that match this trip, which one is best?
+# candidates are scored in order of their bounding-box lower bound; once that bound exceeds the second-best score
+# no later candidate can change the result, and each exact score gives up early past the second-best score
+# @Return (best shape, its score, runner-up shape or None, margin in meters between the two; inf with no runner-up)
+def matchShape(slis, tripID):
+	if (len(slis) < 1):
 		print("ERROR: found no matching shape for trip:", tripID)
 		exit()
-	if (nshape == 1):
-		return(slis[0])
-
-	df = bc_df.loc[bc_df['EVENT_NO_TRIP'] == tripID]
 
-	tlis = []
-	for index, row in df.iterrows():
-		lat = row['GPS_LATITUDE']
-		lon = row['GPS_LONGITUDE']
-		coord = [lat, lon]
-		tlis.append(coord)
-
-	# choose the shape with the smallest deviation score
-	retval = min(slis, key=lambda sid:distanceScore(sid, tlis))
-	return(retval)
+	# a shape with no points in shapes.txt never wins
+	known = [sid for sid in slis if sid in shape_vertices]
+	if (len(known) < 1):
+		return slis[0], np.inf, None, np.inf
+
+	xs, ys = trip_samples[tripID]
+	bounds = [boxDistances(shape_boxes[sid], xs, ys).mean() for sid in known]
+	best = (np.inf, -1)		# (score, position in known); ties go to the earliest shape in the list
+	second = (np.inf, -1)
+	for i in sorted(range(len(known)), key=lambda i: (bounds[i], i)):
+		if (bounds[i] > second[0]):
+			break
+		score = trajectoryScore(tripID, known[i], second[0])
+		if ((score, i) < best):
+			best, second = (score, i), best
+		elif ((score, i) < second):
+			second = (score, i)
+
+	runnerUp = known[second[1]] if second[1] >= 0 else None
+	return known[best[1]], best[0], runnerUp, second[0] - best[0]
+
+# mean distance from the sampled breadcrumbs of each (trip, shape) pair to the shape: projected onto the shape with
+# exact, otherwise to its bounding box, which is never more than the exact score
+# the samples of every pair with the same shape are handled in one call, so scoring a batch is one pass per shape
+# @Return the pairs' scores, in the order given
+def pairScores(tripIDs, shapeIDs, exact):
+	scores = np.empty(len(tripIDs))
+	for sid in np.unique(shapeIDs):
+		rows = np.flatnonzero(shapeIDs == sid)
+		xs = np.concatenate([trip_samples[tid][0] for tid in tripIDs[rows]])
+		ys = np.concatenate([trip_samples[tid][1] for tid in tripIDs[rows]])
+		counts = np.array([len(trip_samples[tid][0]) for tid in tripIDs[rows]])
+		if (exact):
+			dist = shape_index.project_points(get_shape_index(sid), xs, ys)[3]
+		else:
+			dist = boxDistances(shape_boxes[sid], xs, ys)
+		scores[rows] = np.add.reduceat(dist, np.cumsum(counts) - counts) / counts
+	return scores
+
+# sort (trip, shape) pairs by trip, then by score and position in the trip's candidate list
+# @Return (pair order, rank of each ordered pair within its trip)
+def rankPairs(groups, scores, positions):
+	order = np.lexsort((positions, scores, groups))
+	starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1]])
+	rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+	return order, rank
+
+# match every trip in candidates (recorded trip ID -> list of candidate shape IDs) in one batch
+# the same choice as matchShape, but each round scores the pairs of every trip at once with pairScores: first each
+# trip's two candidates with the lowest bounding-box bound, then only its candidates whose bound is within the
+# second-best of those scores, since no other candidate can be the best or the runner-up
+# @Return recorded trip ID -> matchShape() result
+def pickShapesFromLists(candidates):
+	results = {}
+	tripIDs, pair_group, pair_shape, pair_pos = [], [], [], []
+	for tid, slis in candidates.items():
+		if (len(slis) < 1):
+			print("ERROR: found no matching shape for trip:", tid)
+			exit()
+
+		# a shape with no points in shapes.txt never wins
+		known = [sid for sid in slis if sid in shape_vertices]
+		if (len(known) < 1):
+			results[tid] = (slis[0], np.inf, None, np.inf)
+			continue
+		pair_group += [len(tripIDs)] * len(known)
+		pair_shape += known
+		pair_pos += range(len(known))
+		tripIDs.append(tid)
+	if (len(tripIDs) < 1):
+		return results
+
+	tripIDs = np.array(tripIDs)
+	pair_group = np.array(pair_group)
+	pair_trip = tripIDs[pair_group]
+	pair_shape = np.array(pair_shape)
+	pair_pos = np.array(pair_pos)
+	bounds = pairScores(pair_trip, pair_shape, False)
+	scores = np.full(len(pair_group), np.inf)
+
+	order, rank = rankPairs(pair_group, bounds, pair_pos)
+	first = order[rank < 2]
+	scores[first] = pairScores(pair_trip[first], pair_shape[first], True)
+
+	order, rank = rankPairs(pair_group, scores, pair_pos)
+	second = np.full(len(tripIDs), np.inf)
+	second[pair_group[order[rank == 1]]] = scores[order[rank == 1]]
+	rest = np.flatnonzero(np.isinf(scores) & (bounds <= second[pair_group]))
+	scores[rest] = pairScores(pair_trip[rest], pair_shape[rest], True)
+
+	order, rank = rankPairs(pair_group, scores, pair_pos)
+	best = order[rank == 0]
+	second = np.full(len(tripIDs), -1)
+	second[pair_group[order[rank == 1]]] = order[rank == 1]
+	for g, b in zip(pair_group[best], best):
+		s = second[g]
+		runnerUp = pair_shape[s] if s >= 0 else None
+		margin = scores[s] - scores[b] if s >= 0 else np.inf
+		results[tripIDs[g]] = (pair_shape[b], scores[b], runnerUp, margin)
+	return results
+
+# choose the shape that most closely matches the recorded trip's geometry
+def pickShapeFromList(slis, tripID):
+	return matchShape(slis, tripID)[0]
+
+# index the CAD/AVL and GTFS tables by the keys trip2route and trip2shape look up
+# wherever a key has several rows the first one wins, as the per-trip table scans used to pick
+def build_lookups():
+	global trip_routes, route_info, shape_trips
+
+	# all cadavl records with the same recorded trip ID should have the same route_number
+	# so we just keep the first one
+	df = cadavl_df.drop_duplicates('trip_number')
+	trip_routes = dict(zip(df['trip_number'], df['route_number']))
+
+	df = routes_df.drop_duplicates('route_short_name')
+	route_info = dict(zip(df['route_short_name'], zip(df['route_id'], df['route_long_name'])))
+
+	shape_trips = {sid: g.tolist() for sid, g in trips_df.groupby('shape_id', sort=False)['trip_id']}
+
+	if (DEBUG): print(f"indexed {len(trip_routes)} CAD/AVL trips, {len(route_info)} routes, {len(shape_trips)} shapes")
+
+# seconds after midnight of GTFS "HH:MM:SS" times; hours past 24 are trips running after midnight
+def gtfsSeconds(times):
+	hms = times.str.strip().str.split(':', expand=True).astype(int)
+	return hms[0] * 3600 + hms[1] * 60 + hms[2]
+
+# index every planned trip's start time (its first stop's departure) by shape and service, sorted for binary search
+def build_start_index():
+	global planned_starts, shape_services
+	st = readData(os.path.join(gtfsdir,"stop_times.txt"))
+	st = st.dropna(subset=['departure_time']).sort_values(['trip_id', 'stop_sequence'], kind='stable')
+	st = st.drop_duplicates('trip_id')
+	starts = pd.DataFrame({'trip_id': st['trip_id'], 'start': gtfsSeconds(st['departure_time'])})
+	starts = starts.merge(trips_df[['trip_id', 'shape_id', 'service_id']], on='trip_id')
+	starts = starts.sort_values(['start', 'trip_id'], kind='stable')
+
+	planned_starts = {key: (g['start'].to_numpy(), g['trip_id'].to_numpy())
+					  for key, g in starts.groupby(['shape_id', 'service_id'], sort=False)}
+	shape_services = {}
+	for sid, svc in planned_starts:
+		shape_services.setdefault(sid, []).append(svc)
+	if (DEBUG): print(f"indexed start times of {len(starts)} planned trips")
+
+# read the service calendar: calendar.txt, plus calendar_dates.txt exceptions when the feed has them
+def read_calendar():
+	global calendar_df, calendar_dates_df
+	calendar_df = readData(os.path.join(gtfsdir,"calendar.txt"))
+	datesfile = os.path.join(gtfsdir,"calendar_dates.txt")
+	if (os.path.exists(datesfile)):
+		calendar_dates_df = readData(datesfile)
+
+# @Return the set of service_ids running on a date (a Timestamp at midnight)
+def services_on(date):
+	if (date not in active_services):
+		ymd = int(date.strftime('%Y%m%d'))
+		day = calendar_df.loc[(calendar_df[date.day_name().lower()] == 1) &
+							  (calendar_df['start_date'] <= ymd) & (calendar_df['end_date'] >= ymd)]
+		services = set(day['service_id'])
+		if (not calendar_dates_df.empty):
+			ex = calendar_dates_df.loc[calendar_dates_df['date'] == ymd]
+			services |= set(ex.loc[ex['exception_type'] == 1, 'service_id'])
+			services -= set(ex.loc[ex['exception_type'] == 2, 'service_id'])
+		active_services[date] = services
+	return active_services[date]
+
+# service date and first breadcrumb time of every recorded trip
+def find_trip_starts():
+	dates = pd.to_datetime(crumb_store.first_values(bc_store, 'date'))
+	seconds = crumb_store.first_values(bc_store, 'ACT_TIME') / np.timedelta64(1, 's')
+	return dict(zip(bc_store.trip_ids, zip(dates, seconds)))
 
 # from the recorded trip ID get the route information
 def trip2route(rtrip):
-	df = cadavl_df.loc[cadavl_df['trip_number'] == rtrip]
-	if (df.empty):
+	if (rtrip not in trip_routes):
 		print("WARNING: trip", rtrip, "does not appear in the CAD/AVL data", cadavlfile)
 		return -1, -1, "ERROR: ROUTE NOT FOUND IN CADAVL DATA"
-
-	# all cadavl records with this recorded_trip ID should have the same route_number
-	# so we just pick the first one
-	routeShortName = df.route_number.iloc[0]
+	routeShortName = trip_routes[rtrip]
 
 	# from the short name we can find the route's internal ID and long name
-	df = routes_df.loc[routes_df['route_short_name'] == routeShortName]
-	routeID = df.route_id.iloc[0]
-	routeLongName = df.route_long_name.iloc[0]
+	routeID, routeLongName = route_info[routeShortName]
 
 	return (routeID, routeShortName, routeLongName)
 
-# from the input trip identifier compute the corresponding shapeID
-def trip2shape(rtrip):
+# from the input trip identifier find the shapes it could follow
+# @Return the candidate shape IDs, or None when the trip's route is unknown
+def trip2candidates(rtrip):
 	# convert trip ID to route number
 	routeID, routeShortName, routeLongName = trip2route(rtrip)
-	if (routeID < 0): return -1, -1
-
-	# find the planned trips for this route_id
-	df = trips_df.loc[(trips_df['route_id'] == routeID)]
+	if (routeID < 0): return None
 
-	# from the list of planned trips find the full list of possible shapes
-	shapeids_df = df['shape_id']
-	shape_ids = df['shape_id'].unique()
+	# the full list of possible shapes, from the planned trips for this route_id, in the order they appear in trips.txt
+	shape_ids = np.array(shape_store.route_shapes(shapes, routeID))
 	if (len(shape_ids) > 1):
 		if (DEBUG): print("\ttrip", rtrip, "corresponds to more than one shape", shape_ids)
+	return shape_ids
+
+# find the planned trip that uses this shape and starts nearest to the recorded trip rtrip
+# only planned trips whose service runs on rtrip's service date are considered, unless the shape has none that day;
+# ties go to the earlier planned trip
+def shape2plannedtrip(shapeID, rtrip):
+	services = shape_services.get(shapeID, [])
+	if (len(services) < 1):
+		# no start times for this shape in stop_times.txt, so fall back to the first planned trip in the list
+		return shape_trips[shapeID][0]
+
+	date, start = trip_starts[rtrip]
+	running = [svc for svc in services if svc in services_on(date)]
+	if (len(running) < 1):
+		if (DEBUG): print("\tWARNING: no planned trip of shape", shapeID, "runs on", date.date(), "for trip", rtrip)
+		running = services
+
+	best = None
+	for svc in running:
+		starts, ptrips = planned_starts[(shapeID, svc)]
+		i = np.searchsorted(starts, start)
+		for j in (i - 1, i):
+			if (0 <= j < len(starts)):
+				cand = (abs(starts[j] - start), starts[j], ptrips[j])
+				if (best is None or cand < best):
+					best = cand
+	return best[2]
+
+# from the input trip identifier compute the corresponding shapeID
+def trip2shape(rtrip):
+	shape_ids = trip2candidates(rtrip)
+	if (shape_ids is None): return -1, -1
 
 	# choose the shape that most closely matches the recorded trip's geometry
 	shapeID = pickShapeFromList(shape_ids, rtrip)
-
-	# find the planned trip that uses this shape
-	# this is a kludge. 
-	# instead of this we should find the planned trip with the start time nearest to rtrip
-	tdf = trips_df.loc[trips_df['shape_id'] == shapeID]
-	ptlist = tdf['trip_id'].tolist()
-	plannedTripID = ptlist[0]  # take the first one in the list
+	plannedTripID = shape2plannedtrip(shapeID, rtrip)
 
 	if (DEBUG): print(f"\tshapeID {shapeID} plannedTripID {plannedTripID}")
 	return shapeID, plannedTripID
 
-def output_all_trip2shape():
+# split the trips to map by route, each shard carrying just the breadcrumb samples, shapes, planned trip start
+# times and service days its trips need, so a worker process needs nothing else
+# largest shards go first so that one busy route does not leave the other workers idle at the end
+def route_shards(candidates):
+	by_route = {}
+	for tid, slis in candidates.items():
+		routeID = route_info[trip_routes[tid]][0]
+		by_route.setdefault(routeID, []).append(tid)
+
+	shards = []
+	for routeID, tids in by_route.items():
+		shape_ids = set(sid for tid in tids for sid in candidates[tid])
+		known = [sid for sid in shape_ids if sid in shape_vertices]
+		dates = set(trip_starts[tid][0] for tid in tids)
+		shards.append({'route': routeID,
+					   'candidates': {tid: candidates[tid] for tid in tids},
+					   'samples': {tid: trip_samples[tid] for tid in tids},
+					   'starts': {tid: trip_starts[tid] for tid in tids},
+					   'vertices': {sid: shape_vertices[sid] for sid in known},
+					   'boxes': {sid: shape_boxes[sid] for sid in known},
+					   # indexes are built here, so workers never write the same cache file at once
+					   'indexes': {sid: get_shape_index(sid) for sid in known},
+					   'shape_trips': {sid: shape_trips[sid] for sid in shape_ids},
+					   'shape_services': {sid: shape_services[sid] for sid in shape_ids if sid in shape_services},
+					   'planned_starts': {key: val for key, val in planned_starts.items() if key[0] in shape_ids},
+					   'services': {date: services_on(date) for date in dates}})
+	shards.sort(key=lambda shard: len(shard['candidates']), reverse=True)
+	return shards
+
+# map one route shard's trips to their shapes and planned trips, in this process or a worker
+# @Return recorded trip ID -> (shapeID, score, runner-up shape, margin, plannedTripID)
+def map_shard(shard):
+	trip_samples.update(shard['samples'])
+	trip_starts.update(shard['starts'])
+	shape_vertices.update(shard['vertices'])
+	shape_boxes.update(shard['boxes'])
+	shape_indexes.update(shard['indexes'])
+	shape_trips.update(shard['shape_trips'])
+	shape_services.update(shard['shape_services'])
+	planned_starts.update(shard['planned_starts'])
+	active_services.update(shard['services'])
+
+	results = {}
+	for tid, match in pickShapesFromLists(shard['candidates']).items():
+		results[tid] = match + (shape2plannedtrip(match[0], tid),)
+	return results
+
+# map every recorded trip in bc_df to its shape and planned trip
+# @Return a list of (tripID, shapeID, plannedTripID, score, runner-up shape, margin), in breadcrumb order
+def map_all_trips(workers=DEFAULT_WORKERS):
+	trip_ids = bc_df['EVENT_NO_TRIP'].unique()
+	candidates = {}
+	for tid in trip_ids:
+		if (DEBUG): print(f"Processing tripID {tid}")
+		shape_ids = trip2candidates(tid)
+		if (shape_ids is not None):
+			candidates[tid] = shape_ids
+
+	shards = route_shards(candidates)
+	if (DEBUG): print(f"mapping {len(candidates)} trips in {len(shards)} route shards on {workers} workers")
+	matches = {}
+	if (workers > 1):
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			for results in pool.map(map_shard, shards):
+				matches.update(results)
+	else:
+		for shard in shards:
+			matches.update(map_shard(shard))
+
+	# listed in breadcrumb order whatever order the shards finished in
+	rows = []
+	for tid in trip_ids:
+		if (tid in matches):
+			shape_id, score, runner_up, margin, ptrip = matches[tid]
+			rows.append((tid, shape_id, ptrip, score, runner_up, margin))
+	return rows
+
+def output_all_trip2shape(workers=DEFAULT_WORKERS):
+	rows = map_all_trips(workers)
+
 	if (DEBUG): print(f"opened file {trip2shape_file}")
 	fil = open(trip2shape_file,"w+")
 	fil.write("tripID,shapeID,plannedTripID\n")
 
-	trip_ids = bc_df['EVENT_NO_TRIP'].unique()
-	for tid in trip_ids:
-		if (DEBUG): print(f"Processing tripID {tid}")
-		shape_id, ptrip = trip2shape(tid)
-		if (shape_id >= 0):
-			fil.write(f"{tid},{shape_id},{ptrip}\n")
+	# trips with two nearly equally good shapes are listed separately, so they can be checked by hand
+	afil = open(ambiguous_file,"w+")
+	afil.write("tripID,shapeID,score,runnerUpShapeID,margin\n")
+	for tid, shape_id, ptrip, score, runner_up, margin in rows:
+		if (DEBUG): print(f"\ttrip {tid} shapeID {shape_id} plannedTripID {ptrip} score {score:.1f} margin {margin:.1f}")
+		fil.write(f"{tid},{shape_id},{ptrip}\n")
+		if (margin < AMBIGUOUS_MARGIN):
+			afil.write(f"{tid},{shape_id},{score:.2f},{runner_up},{margin:.2f}\n")
+	afil.close()
 	fil.close()
-	if (DEBUG): print(f"finished writing mapping data to {trip2shape_file}")
+	if (DEBUG): print(f"finished writing mapping data to {trip2shape_file} and {ambiguous_file}")
+
+# read the GTFS feed and CAD/AVL trips, and index them for matching
+def ingest_feed():
+	global routes_df, shapes, trips_df, cadavl_df
+	routes_df = readData(os.path.join(gtfsdir,"routes.txt"))
+	trips_df = readData(os.path.join(gtfsdir,"trips.txt"))
+	cadavl_df = readData(cadavlfile)
+	shapes = shape_store.load_store(shapesfile, os.path.join(gtfsdir,"trips.txt"), shapesdir, cache_dir=cachedir)
+
+	if (DEBUG): print("data cleaning")
+	routes_df['route_short_name'] = routes_df['route_short_name'].astype(int)
+	trips_df['route_id'] = trips_df['route_id'].astype(int)
+
+	if (DEBUG): print("indexing lookup tables")
+	build_lookups()
+	index_shapes()
+	build_start_index()
+	read_calendar()
+
+# read the breadcrumbfiles and sample their trips for matching
+# with cache, the cleaned breadcrumbs are kept in cachedir and reused by later runs on the same files
+def ingest_breadcrumbs(cache=True):
+	global bc_df, bc_store, trip_samples, trip_starts
+	if (DEBUG): print("reading breadcrumb files:", breadcrumbfiles)
+	if (cache):
+		# stream every file through the shared reader once and reuse the cleaned result on later runs
+		bc_df = crumb_cache.cached_frame('breadcrumbs', breadcrumbfiles,
+										 lambda: breadcrumb_reader.read_breadcrumbs(breadcrumbfiles), cache_dir=cachedir)
+	else:
+		bc_df = breadcrumb_reader.read_breadcrumbs(breadcrumbfiles)
+	bc_df['OPD_DATE'] = timestamps.parse_opd_dates(bc_df['OPD_DATE'])
+
+	bc_df.rename(columns={'OPD_DATE': 'date'}, inplace=True)
+	bc_df["ACT_TIME"] = pd.to_timedelta(bc_df["ACT_TIME"], "s")
+	bc_df['TIMESTAMP'] = bc_df['date'] + bc_df['ACT_TIME']
+
+	# index the readings by trip once; every per-trip step below slices this instead of filtering bc_df
+	if (cache):
+		bc_store = crumb_store.cached_store('breadcrumb-trips', breadcrumbfiles, lambda: bc_df, 'EVENT_NO_TRIP',
+										   'TIMESTAMP', STORE_COLUMNS, cache_dir=cachedir)
+	else:
+		bc_store = crumb_store.build_store(bc_df, 'EVENT_NO_TRIP', 'TIMESTAMP', STORE_COLUMNS)
+	trip_samples = sample_trips()
+	trip_starts = find_trip_starts()
 
 # read in all of the data and compute teh shapeID if needed
 def ingest_data():
-	global routes_df, shapes_df, trips_df, cadavl_df, tts_df, bc_df, shapeID
 	try:
 		if (DEBUG): print("Ingesting the Data...")
- 
-		routes_df = readData(os.path.join(gtfsdir,"routes.txt"))
-		trips_df = readData(os.path.join(gtfsdir,"trips.txt"))
-		cadavl_df = readData(cadavlfile)
-		shapes_df = readData(shapesfile)
-
-		for fname in breadcrumbfiles:
-			df = readData(fname, s='\t', parsed=[1], idf=True)
-			bc_df = bc_df.append(df)
-
-		if (DEBUG): print("data cleaning")
-		routes_df['route_short_name'] = routes_df['route_short_name'].astype(int)
-		trips_df['route_id'] = trips_df['route_id'].astype(int)
-		bc_df.rename(columns={'OPD_DATE': 'date'}, inplace=True)
-		bc_df["ACT_TIME"] = pd.to_timedelta(bc_df["ACT_TIME"], "s")
-		bc_df['TIMESTAMP'] = bc_df['date'] + bc_df['ACT_TIME']
-
+		ingest_feed()
+		ingest_breadcrumbs()
 		if (DEBUG): print("finished ingesting data files")
 
 	except Exception as e:
@@ -179,9 +521,7 @@ def ingest_data():
 		traceback.print_exc(file=sys.stdout)
 		exit(-1)
 
-ingest_data()
-output_all_trip2shape()
-
-
-
-
+if __name__ == '__main__':
+	args = initialize()
+	ingest_data()
+	output_all_trip2shape(args.workers)
@@ -0,0 +1,5 @@
+# Degrees -> meters scale factors that put GPS coordinates in the planar units the projection code works in
+# Kept free of imports so that the matcher and the live corrector can share them without loading the batch pipeline
+
+LAT_DIST = 111.2 * 1000  # m per degree latitude at 45.63 degrees latitude (approximate)
+LON_DIST = 77.76 * 1000  # m per degree longitude at 45.63 degrees latitude (approximate)
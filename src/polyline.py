@@ -0,0 +1,97 @@
+import math
+
+import numpy
+
+# Encoded polylines and line simplification for compact map output
+# Encoding is Google's polyline algorithm: every coordinate is rounded to `precision` decimals, delta-encoded against
+# the previous point and written as printable ASCII in 5-bit chunks, so a point usually takes 6 to 8 characters
+# instead of the ~40 of a "[lat, lon]," JavaScript literal. Leaflet has no built-in decoder; DECODE_JS is one.
+
+DEFAULT_PRECISION = 5  # 1e-5 degrees, about 1 m
+EARTH_RADIUS = 6371000.0  # meters
+
+DECODE_JS = """
+function decodePolyline(str, precision) {
+    var coords = [], lat = 0, lon = 0, i = 0, factor = Math.pow(10, precision);
+    while (i < str.length) {
+        var deltas = [];
+        for (var k = 0; k < 2; k++) {
+            var shift = 0, result = 0, b;
+            do {
+                b = str.charCodeAt(i++) - 63;
+                result |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            deltas.push((result & 1) ? ~(result >> 1) : (result >> 1));
+        }
+        lat += deltas[0];
+        lon += deltas[1];
+        coords.push([lat / factor, lon / factor]);
+    }
+    return coords;
+}
+"""
+
+
+def encode(lats, lons, precision: int = DEFAULT_PRECISION) -> str:
+    factor = 10 ** precision
+    coords = numpy.round(numpy.column_stack([lats, lons]) * factor).astype(numpy.int64)
+    deltas = numpy.diff(coords, axis=0, prepend=[[0, 0]]).ravel()
+    chunks = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+# @Return list of [lat, lon], the inverse of encode() up to its rounding
+def decode(text: str, precision: int = DEFAULT_PRECISION) -> list:
+    factor = 10 ** precision
+    values = []
+    result = shift = 0
+    for char in text:
+        b = ord(char) - 63
+        result |= (b & 0x1f) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            result = shift = 0
+    coords = numpy.cumsum(numpy.array(values, dtype=numpy.int64).reshape(-1, 2), axis=0) / factor
+    return coords.tolist()
+
+
+# Douglas-Peucker simplification: drops points until every dropped point is within tolerance meters of the line kept
+# Distances use a local flat projection around the line's mean latitude, which is plenty at the scale of a route
+# @Return the indexes of the points kept, always including the first and last
+def simplify(lats, lons, tolerance: float) -> numpy.ndarray:
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    n = len(lats)
+    if n < 3 or tolerance <= 0:
+        return numpy.arange(n)
+    x = numpy.radians(lons) * math.cos(math.radians(lats.mean())) * EARTH_RADIUS
+    y = numpy.radians(lats) * EARTH_RADIUS
+
+    keep = numpy.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        dx = x[hi] - x[lo]
+        dy = y[hi] - y[lo]
+        px = x[lo + 1:hi] - x[lo]
+        py = y[lo + 1:hi] - y[lo]
+        len_sq = dx * dx + dy * dy
+        t = numpy.clip((px * dx + py * dy) / len_sq, 0.0, 1.0) if len_sq > 0 else 0.0
+        dist = numpy.hypot(px - t * dx, py - t * dy)
+        i = int(numpy.argmax(dist))
+        if dist[i] > tolerance:
+            mid = lo + 1 + i
+            keep[mid] = True
+            stack += [(lo, mid), (mid, hi)]
+    return numpy.flatnonzero(keep)
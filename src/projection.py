@@ -0,0 +1,79 @@
+import numpy
+
+# Batch projection of breadcrumbs onto a route shape
+# Replaces the per-row shapely nearest_points()/project() calls with one NumPy pass per block of crumbs.
+# All coordinates are expected in the same planar units (meters, see planar_units.py)
+
+BLOCK_CELLS = 4000000  # Max number of (crumb, segment) pairs evaluated at once; bounds the memory of one block
+
+
+# Splits a shape's vertex array into segment start points, segment vectors and cumulative length at each vertex
+# @Return (starts, vectors, squared lengths, cumulative distance along the shape at each vertex)
+def shape_segments(vertices: numpy.ndarray):
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    starts = vertices[:-1]
+    vectors = vertices[1:] - starts
+    len_sq = (vectors ** 2).sum(axis=1)
+    cum_dist = numpy.concatenate(([0.0], numpy.cumsum(numpy.sqrt(len_sq))))
+    return starts, vectors, len_sq, cum_dist
+
+
+# Projects each (x, y) onto the polyline described by vertices
+# Ties are broken toward the earliest segment, the same way shapely's project() does
+# @Return (projected x, projected y, distance along the shape, perpendicular distance to the shape)
+def project_points(vertices: numpy.ndarray, xs, ys):
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    n = len(xs)
+    proj_x = numpy.empty(n)
+    proj_y = numpy.empty(n)
+    along = numpy.empty(n)
+    perp = numpy.empty(n)
+    if n == 0:
+        return proj_x, proj_y, along, perp
+    if len(vertices) == 1:  # Degenerate shape: everything projects onto the single vertex
+        proj_x[:] = vertices[0, 0]
+        proj_y[:] = vertices[0, 1]
+        along[:] = 0.0
+        perp[:] = numpy.hypot(xs - proj_x, ys - proj_y)
+        return proj_x, proj_y, along, perp
+
+    starts, vectors, len_sq, cum_dist = shape_segments(vertices)
+    safe_len_sq = numpy.where(len_sq > 0, len_sq, 1.0)  # Zero-length segments project onto their start point
+    block = max(1, BLOCK_CELLS // len(starts))
+    for lo in range(0, n, block):
+        hi = min(n, lo + block)
+        dx = xs[lo:hi, None] - starts[None, :, 0]
+        dy = ys[lo:hi, None] - starts[None, :, 1]
+        t = (dx * vectors[None, :, 0] + dy * vectors[None, :, 1]) / safe_len_sq[None, :]
+        numpy.clip(t, 0.0, 1.0, out=t)
+        ex = dx - t * vectors[None, :, 0]
+        ey = dy - t * vectors[None, :, 1]
+        dist_sq = ex ** 2 + ey ** 2
+        seg = numpy.argmin(dist_sq, axis=1)
+        rows = numpy.arange(hi - lo)
+        t_best = t[rows, seg]
+        proj_x[lo:hi] = starts[seg, 0] + t_best * vectors[seg, 0]
+        proj_y[lo:hi] = starts[seg, 1] + t_best * vectors[seg, 1]
+        along[lo:hi] = cum_dist[seg] + t_best * numpy.sqrt(len_sq[seg])
+        perp[lo:hi] = numpy.sqrt(dist_sq[rows, seg])
+    return proj_x, proj_y, along, perp
+
+
+# Batched equivalent of shapely's interpolate(): the point at each distance along the shape
+# Distances are clamped to [0, shape length] like shapely does
+# @Return (x, y)
+def interpolate_points(vertices: numpy.ndarray, distances):
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    distances = numpy.asarray(distances, dtype=numpy.float64)
+    if len(vertices) == 1:
+        return numpy.full(len(distances), vertices[0, 0]), numpy.full(len(distances), vertices[0, 1])
+    starts, vectors, len_sq, cum_dist = shape_segments(vertices)
+    distances = numpy.clip(distances, 0.0, cum_dist[-1])
+    seg = numpy.searchsorted(cum_dist, distances, side='right') - 1
+    seg = numpy.clip(seg, 0, len(starts) - 1)
+    seg_len = numpy.sqrt(len_sq[seg])
+    t = numpy.divide(distances - cum_dist[seg], seg_len, out=numpy.zeros_like(distances), where=seg_len > 0)
+    return starts[seg, 0] + t * vectors[seg, 0], starts[seg, 1] + t * vectors[seg, 1]
+
@@ -0,0 +1,106 @@
+from pathlib import Path
+
+import argparse
+import asyncio
+import sys
+import time
+
+import breadcrumb_reader
+
+# replay_breadcrumbs.py: replay recorded breadcrumb files as a live feed
+#
+# Sends the rows of cyclic_data_* TSV files (one header line, then every reading in file order) to stdout or to a
+# local TCP port at a fixed rate, for exercising live_corrector.py without a real feed.
+#
+# examples:
+#   python replay_breadcrumbs.py -r 500 ../data/original/cyclic_data_20200224_0320_wkd | python live_corrector.py
+#   python replay_breadcrumbs.py -r 2000 -p 9000 ../data/original/cyclic_data_20200224_0320_wkd
+
+DEFAULT_RATE = 100.0  # messages per second
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs='+', help="breadcrumb TSV files or directories of them")
+    parser.add_argument("-r", "--rate", default=DEFAULT_RATE, type=float,
+                        help="readings sent per second; 0 sends as fast as possible")
+    parser.add_argument("-p", "--port", default=None, type=int,
+                        help="send to this localhost TCP port instead of stdout")
+    return parser.parse_args()
+
+
+# @Return the header line, then every data line of the files in order; later files' headers are skipped
+def breadcrumb_lines(sources: list):
+    files = []
+    for source in sources:
+        files += breadcrumb_reader.breadcrumb_files(Path(source))
+    header_sent = False
+    for fname in files:
+        with open(fname) as fil:
+            header = fil.readline()
+            if not header_sent:
+                header_sent = True
+                yield header
+            for line in fil:
+                if line.strip():
+                    yield line
+
+
+# @Return (readings sent, seconds taken); the header line is sent first but is not a reading, so it is not counted
+async def replay(args, writer):
+    start = time.monotonic()
+    sent = 0
+    lines = breadcrumb_lines(args.sources)
+    for header in lines:
+        writer.write(header.encode())
+        break
+    for line in lines:
+        writer.write(line.encode())
+        sent += 1
+        if args.rate > 0:
+            # Paced against the start time rather than the previous send, so slow writes do not lower the rate
+            wait = start + sent / args.rate - time.monotonic()
+            if wait > 0:
+                await writer.drain()
+                await asyncio.sleep(wait)
+        if sent % 1000 == 0:
+            await writer.drain()
+    await writer.drain()
+    return sent, time.monotonic() - start
+
+
+# Minimal writer over stdout with the write()/drain() interface of asyncio.StreamWriter
+class StdoutWriter:
+    def write(self, data: bytes):
+        sys.stdout.buffer.write(data)
+
+    async def drain(self):
+        sys.stdout.buffer.flush()
+
+    def close(self):
+        sys.stdout.buffer.flush()
+
+
+async def run(args):
+    if args.port is not None:
+        _, writer = await asyncio.open_connection('127.0.0.1', args.port)
+    else:
+        writer = StdoutWriter()
+    try:
+        sent, elapsed = await replay(args, writer)
+    finally:
+        writer.close()
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    print(f"sent {sent} readings in {elapsed:.1f} s ({rate:.0f}/s)", file=sys.stderr)
+
+
+def main():
+    args = initialize()
+    try:
+        asyncio.run(run(args))
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+from collections import namedtuple
+from pathlib import Path
+
+import hashlib
+import os
+import numpy
+
+import projection
+
+# Segment-level grid index over one shape's geometry
+# Each grid cell lists the segments whose bounding box touches it, so projecting a crumb only tests the segments in
+# the few cells around it instead of every segment of the shape. Cumulative distances are kept per vertex, so the
+# distance along the route of a projection is an index lookup plus one partial segment.
+# An index is built once per shape and can be saved next to the other cached inputs to be reused by later runs.
+
+DEFAULT_CELL_SIZE = 100.0  # meters; most crumbs are well within one cell of their route
+MAX_CELLS = 1000000  # cells are made larger for huge shapes so the grid stays small
+RINGS = [1, 2, 4]  # search radii, in cells, tried before falling back to testing every segment
+BLOCK_POINTS = 100000  # crumbs looked up at once; bounds the size of the candidate arrays
+HASH_LENGTH = 16  # hex digits of the key in a cached index's file name
+
+ShapeIndex = namedtuple('ShapeIndex', ['vertices', 'starts', 'vectors', 'len_sq', 'cum_dist', 'origin', 'cell_size',
+                                       'ncols', 'nrows', 'cell_offsets', 'cell_segments'])
+
+
+# Builds the index for a shape's vertex array
+# cum_dist, if given, replaces the geometric cumulative length at each vertex (e.g. GTFS shape_dist_traveled);
+# it must be non-decreasing and have one entry per vertex, otherwise the geometric lengths are used
+def build_shape_index(vertices, cum_dist=None, cell_size: float = DEFAULT_CELL_SIZE) -> ShapeIndex:
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    if len(vertices) == 1:
+        vertices = numpy.vstack([vertices, vertices])  # one zero-length segment keeps the math uniform
+    starts, vectors, len_sq, geo_dist = projection.shape_segments(vertices)
+    if cum_dist is not None:
+        cum_dist = numpy.asarray(cum_dist, dtype=numpy.float64)
+        if len(cum_dist) != len(vertices) or numpy.isnan(cum_dist).any() or (numpy.diff(cum_dist) < 0).any():
+            cum_dist = None
+    if cum_dist is None:
+        cum_dist = geo_dist
+
+    origin = vertices.min(axis=0)
+    extent = vertices.max(axis=0) - origin
+    while (extent[0] // cell_size + 1) * (extent[1] // cell_size + 1) > MAX_CELLS:
+        cell_size *= 2
+    ncols = int(extent[0] // cell_size) + 1
+    nrows = int(extent[1] // cell_size) + 1
+
+    # Every segment goes into each cell of its bounding box
+    ends = starts + vectors
+    lo = numpy.floor((numpy.minimum(starts, ends) - origin) / cell_size).astype(numpy.int64)
+    hi = numpy.floor((numpy.maximum(starts, ends) - origin) / cell_size).astype(numpy.int64)
+    lo = numpy.clip(lo, 0, [ncols - 1, nrows - 1])
+    hi = numpy.clip(hi, 0, [ncols - 1, nrows - 1])
+    width = hi[:, 0] - lo[:, 0] + 1
+    counts = width * (hi[:, 1] - lo[:, 1] + 1)
+    seg = numpy.repeat(numpy.arange(len(starts)), counts)
+    local = numpy.arange(len(seg)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    cols = lo[seg, 0] + local % width[seg]
+    rows = lo[seg, 1] + local // width[seg]
+    cells = rows * ncols + cols
+
+    order = numpy.argsort(cells, kind='stable')
+    cell_offsets = numpy.zeros(ncols * nrows + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(cells, minlength=ncols * nrows), out=cell_offsets[1:])
+    return ShapeIndex(vertices, starts, vectors, len_sq, cum_dist, origin, float(cell_size), ncols, nrows,
+                      cell_offsets, seg[order])
+
+
+# @Return (projected x, projected y, distance along the shape, perpendicular distance), like projection.project_points
+# Ties between segments go to the earliest segment, as in shapely
+def project_points(index: ShapeIndex, xs, ys):
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    seg = numpy.empty(len(xs), dtype=numpy.int64)
+    for lo in range(0, len(xs), BLOCK_POINTS):
+        hi = min(len(xs), lo + BLOCK_POINTS)
+        seg[lo:hi] = _nearest_segments(index, xs[lo:hi], ys[lo:hi])
+
+    t = _segment_param(index, seg, xs, ys)
+    proj_x = index.starts[seg, 0] + t * index.vectors[seg, 0]
+    proj_y = index.starts[seg, 1] + t * index.vectors[seg, 1]
+    along = index.cum_dist[seg] + t * (index.cum_dist[seg + 1] - index.cum_dist[seg])
+    return proj_x, proj_y, along, numpy.hypot(xs - proj_x, ys - proj_y)
+
+
+# Batched shapely interpolate() over the index's cumulative distances
+# @Return (x, y)
+def interpolate_points(index: ShapeIndex, distances):
+    distances = numpy.clip(numpy.asarray(distances, dtype=numpy.float64), 0.0, index.cum_dist[-1])
+    seg = numpy.clip(numpy.searchsorted(index.cum_dist, distances, side='right') - 1, 0, len(index.starts) - 1)
+    seg_len = index.cum_dist[seg + 1] - index.cum_dist[seg]
+    t = numpy.divide(distances - index.cum_dist[seg], seg_len, out=numpy.zeros_like(distances), where=seg_len > 0)
+    return index.starts[seg, 0] + t * index.vectors[seg, 0], index.starts[seg, 1] + t * index.vectors[seg, 1]
+
+
+def _segment_param(index: ShapeIndex, seg, xs, ys):
+    dx = xs - index.starts[seg, 0]
+    dy = ys - index.starts[seg, 1]
+    len_sq = index.len_sq[seg]
+    t = numpy.divide(dx * index.vectors[seg, 0] + dy * index.vectors[seg, 1], len_sq,
+                     out=numpy.zeros_like(dx), where=len_sq > 0)
+    return numpy.clip(t, 0.0, 1.0)
+
+
+# Finds the nearest segment of each point by searching growing rings of cells around it
+# A ring of radius k cells contains every segment closer than k * cell_size, so a hit within that distance is exact;
+# points with no such hit after the last ring are settled by testing every segment
+def _nearest_segments(index: ShapeIndex, xs, ys):
+    result = numpy.full(len(xs), -1, dtype=numpy.int64)
+    col = numpy.floor((xs - index.origin[0]) / index.cell_size).astype(numpy.int64)
+    row = numpy.floor((ys - index.origin[1]) / index.cell_size).astype(numpy.int64)
+    todo = numpy.arange(len(xs))
+    for k in RINGS:
+        if len(todo) == 0:
+            break
+        span = numpy.arange(-k, k + 1)
+        cell_cols = (col[todo, None, None] + span[None, None, :]).repeat(len(span), axis=1)
+        cell_rows = (row[todo, None, None] + span[None, :, None]).repeat(len(span), axis=2)
+        inside = (cell_cols >= 0) & (cell_cols < index.ncols) & (cell_rows >= 0) & (cell_rows < index.nrows)
+        cells = numpy.where(inside, cell_rows * index.ncols + cell_cols, 0).reshape(len(todo), -1)
+        counts = numpy.where(inside.reshape(len(todo), -1),
+                             index.cell_offsets[cells + 1] - index.cell_offsets[cells], 0).ravel()
+
+        # One (point, segment) pair per segment listed in any searched cell, grouped by point
+        flat = numpy.repeat(numpy.arange(len(counts)), counts)
+        pos = index.cell_offsets[cells.ravel()[flat]] + numpy.arange(len(flat)) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts)
+        pair_seg = index.cell_segments[pos]
+        pair_point = flat // cells.shape[1]
+        if len(pair_point) == 0:
+            continue
+
+        px = xs[todo][pair_point]
+        py = ys[todo][pair_point]
+        t = _segment_param(index, pair_seg, px, py)
+        dist_sq = ((px - index.starts[pair_seg, 0] - t * index.vectors[pair_seg, 0]) ** 2 +
+                   (py - index.starts[pair_seg, 1] - t * index.vectors[pair_seg, 1]) ** 2)
+
+        found, first = numpy.unique(pair_point, return_index=True)
+        best = numpy.minimum.reduceat(dist_sq, first)
+        is_best = dist_sq == numpy.repeat(best, numpy.diff(numpy.append(first, len(pair_point))))
+        best_seg = numpy.minimum.reduceat(numpy.where(is_best, pair_seg, len(index.starts)), first)
+        exact = best <= (k * index.cell_size) ** 2
+        result[todo[found[exact]]] = best_seg[exact]
+        todo = todo[result[todo] < 0]
+
+    if len(todo):
+        result[todo] = _brute_force_segments(index, xs[todo], ys[todo])
+    return result
+
+
+def _brute_force_segments(index: ShapeIndex, xs, ys):
+    block = max(1, projection.BLOCK_CELLS // len(index.starts))
+    result = numpy.empty(len(xs), dtype=numpy.int64)
+    for lo in range(0, len(xs), block):
+        hi = min(len(xs), lo + block)
+        dx = xs[lo:hi, None] - index.starts[None, :, 0]
+        dy = ys[lo:hi, None] - index.starts[None, :, 1]
+        safe_len_sq = numpy.where(index.len_sq > 0, index.len_sq, 1.0)
+        t = numpy.clip((dx * index.vectors[:, 0] + dy * index.vectors[:, 1]) / safe_len_sq, 0.0, 1.0)
+        result[lo:hi] = numpy.argmin((dx - t * index.vectors[:, 0]) ** 2 + (dy - t * index.vectors[:, 1]) ** 2, axis=1)
+    return result
+
+
+# @Return the index for these vertices, loaded from cache_dir when a run has already built it, else built and saved
+# The file is named after name (the shape it indexes) and a hash of everything the grid depends on; when it is
+# written, older indexes of the same name are removed
+def load_or_build_shape_index(vertices, cache_dir: Path, cum_dist=None, name: str = 'shape',
+                              cell_size: float = DEFAULT_CELL_SIZE) -> ShapeIndex:
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    digest = hashlib.sha1(vertices.tobytes())
+    if cum_dist is not None:
+        digest.update(numpy.asarray(cum_dist, dtype=numpy.float64).tobytes())
+    digest.update(repr((float(cell_size), MAX_CELLS)).encode())
+    prefix = 'shape_index-' + str(name) + '-'
+    path = Path(cache_dir).joinpath(prefix + digest.hexdigest()[:HASH_LENGTH] + '.npz')
+    if path.is_file():
+        with numpy.load(path) as data:
+            fields = {name: data[name] for name in data.files}
+        for name in ['cell_size']:
+            fields[name] = float(fields[name])
+        for name in ['ncols', 'nrows']:
+            fields[name] = int(fields[name])
+        return ShapeIndex(**fields)
+
+    index = build_shape_index(vertices, cum_dist, cell_size)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    # written aside and renamed, so a process loading the same index never sees a partial file
+    tmp = path.with_suffix('.' + str(os.getpid()) + '.tmp')
+    with open(tmp, 'wb') as fil:
+        numpy.savez(fil, **index._asdict())
+    os.replace(tmp, path)
+    for stale in Path(cache_dir).glob(prefix + '[0-9a-f]' * HASH_LENGTH + '.npz'):
+        if stale != path:
+            try:
+                stale.unlink()
+            except OSError:
+                pass  # already removed by another process, or still open on Windows
+    return index
@@ -0,0 +1,150 @@
+from collections import namedtuple
+from pathlib import Path
+
+import json
+import os
+import shutil
+import numpy
+import pandas as pd
+
+import crumb_cache
+
+# Binary, memory-mappable store of GTFS shapes
+# A store is a directory of .npy arrays: every shape's points back to back in one coordinate array, ordered by shape_id
+# and shape_pt_sequence, with per-shape offsets into it, the shape_dist_traveled of each point, and a route -> shapes
+# table laid out the same way. Opening a store maps the arrays instead of reading them, so getting a shape's points is
+# a binary search and a slice, with no CSV parsing or frame filtering.
+
+STORE_ARRAYS = ['shape_ids', 'offsets', 'coords', 'cum_dist', 'route_ids', 'route_offsets', 'route_shapes']
+SOURCES_FILE = 'sources.json'  # hashes of the files an emitted store was built from, written by makeRouteShapeFiles
+
+# shape_ids: sorted shape_id of every shape; its points are coords[offsets[i]:offsets[i + 1]]
+# coords: [shape_pt_lat, shape_pt_lon] per point; cum_dist: shape_dist_traveled per point (NaN where the feed has none)
+# route_ids: sorted route_id of every route; its shapes are route_shapes[route_offsets[i]:route_offsets[i + 1]], in the
+# order their first trip appears in trips.txt
+ShapeStore = namedtuple('ShapeStore', STORE_ARRAYS)
+
+
+# Builds the store's arrays from a GTFS shapes frame and, for the route table, a trips frame, in one sort of each
+def build_arrays(shapes: pd.DataFrame, trips: pd.DataFrame = None) -> ShapeStore:
+    ids = shapes['shape_id'].to_numpy(dtype=numpy.int64)
+    order = numpy.lexsort((shapes['shape_pt_sequence'].to_numpy(), ids))
+    ids = ids[order]
+    shape_ids, starts = numpy.unique(ids, return_index=True)
+    coords = numpy.column_stack([shapes['shape_pt_lat'].to_numpy(dtype=numpy.float64)[order],
+                                 shapes['shape_pt_lon'].to_numpy(dtype=numpy.float64)[order]])
+    if 'shape_dist_traveled' in shapes.columns:
+        cum_dist = shapes['shape_dist_traveled'].to_numpy(dtype=numpy.float64)[order]
+    else:
+        cum_dist = numpy.full(len(ids), numpy.nan)
+
+    if trips is None:
+        pairs = pd.DataFrame({'route_id': numpy.zeros(0, dtype=numpy.int64),
+                              'shape_id': numpy.zeros(0, dtype=numpy.int64)})
+    else:
+        pairs = trips[['route_id', 'shape_id']].dropna().astype('int64').drop_duplicates()
+        pairs = pairs.sort_values('route_id', kind='stable')
+    route_ids, route_starts = numpy.unique(pairs['route_id'].to_numpy(), return_index=True)
+    return ShapeStore(shape_ids, numpy.append(starts, len(ids)).astype(numpy.int64), coords, cum_dist,
+                      route_ids.astype(numpy.int64), numpy.append(route_starts, len(pairs)).astype(numpy.int64),
+                      pairs['shape_id'].to_numpy(dtype=numpy.int64))
+
+
+# Writes a store's arrays to store_dir, replacing whatever store was there
+# sources (see source_hashes) is recorded alongside, so load_store can tell whether the store is still current
+def write_store(store: ShapeStore, store_dir: Path, sources: dict = None):
+    store_dir = Path(store_dir)
+    tmp = store_dir.with_name(store_dir.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name in STORE_ARRAYS:
+        numpy.save(tmp.joinpath(name + '.npy'), getattr(store, name))
+    if sources is not None:
+        with open(tmp.joinpath(SOURCES_FILE), 'w') as fil:
+            json.dump(sources, fil)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp, store_dir)
+
+
+# Maps a store written by write_store; the arrays are read-only views of the files
+def open_store(store_dir: Path) -> ShapeStore:
+    return ShapeStore(*[numpy.load(Path(store_dir).joinpath(name + '.npy'), mmap_mode='r') for name in STORE_ARRAYS])
+
+
+# @Return the store of a shapes file (and trips file, for the route table) from cache_dir, building it on a miss
+# The store directory is named after both files and a hash of them, so callers with and without a trips file keep
+# their own stores; older stores of the same files are removed unless another process has them mapped
+def cached_store(shapes_file: Path, trips_file: Path = None, cache_dir: Path = crumb_cache.CACHE_DIR,
+                 rebuild: bool = False) -> ShapeStore:
+    sources = [Path(shapes_file)] + ([Path(trips_file)] if trips_file is not None else [])
+    name = '+'.join(source.stem for source in sources) + '-store'
+    store_dir = Path(cache_dir).joinpath(name + '-' + crumb_cache.source_hash(sources))
+    if rebuild or not all(store_dir.joinpath(a + '.npy').is_file() for a in STORE_ARRAYS):
+        trips = pd.read_csv(trips_file, usecols=['route_id', 'shape_id']) if trips_file is not None else None
+        store = build_arrays(pd.read_csv(shapes_file, low_memory=False), trips)
+        write_store(store, store_dir)
+        print("Cached shape store of " + str(shapes_file) + " to " + str(store_dir))
+    crumb_cache.remove_stale_stores(cache_dir, name, store_dir)
+    crumb_cache.hold_store(store_dir)
+    return open_store(store_dir)
+
+
+# @Return {'shapes': hash, 'trips': hash} of the files a store is built from; no 'trips' entry without a trips file
+def source_hashes(shapes_file: Path, trips_file: Path = None) -> dict:
+    hashes = {'shapes': crumb_cache.source_hash([shapes_file])}
+    if trips_file is not None:
+        hashes['trips'] = crumb_cache.source_hash([trips_file])
+    return hashes
+
+
+# @Return directory under out_dir that makeRouteShapeFiles writes the store of shapes_file to
+def emitted_dir(out_dir: Path, shapes_file: Path) -> Path:
+    return Path(out_dir).joinpath(Path(shapes_file).stem + '-store')
+
+
+# @Return the store of a shapes file (and trips file, for the route table)
+# The store makeRouteShapeFiles emitted under out_dir is used when it was built from these same files; an emitted store
+# always has the route table, so it also serves callers without a trips file. Otherwise falls back to cached_store.
+def load_store(shapes_file: Path, trips_file: Path = None, out_dir: Path = None,
+               cache_dir: Path = crumb_cache.CACHE_DIR, rebuild: bool = False) -> ShapeStore:
+    if out_dir is not None and not rebuild:
+        store_dir = emitted_dir(out_dir, shapes_file)
+        if store_dir.joinpath(SOURCES_FILE).is_file():
+            with open(store_dir.joinpath(SOURCES_FILE)) as fil:
+                recorded = json.load(fil)
+            if all(recorded.get(k) == v for k, v in source_hashes(shapes_file, trips_file).items()):
+                return open_store(store_dir)
+    return cached_store(shapes_file, trips_file, cache_dir=cache_dir, rebuild=rebuild)
+
+
+# @Return position of shape_id in the store, or -1 when the store does not have it
+def shape_position(store: ShapeStore, shape_id) -> int:
+    i = int(numpy.searchsorted(store.shape_ids, shape_id))
+    return i if i < len(store.shape_ids) and store.shape_ids[i] == shape_id else -1
+
+
+def has_shape(store: ShapeStore, shape_id) -> bool:
+    return shape_position(store, shape_id) >= 0
+
+
+# @Return (coords, cum_dist) of a shape's points, slices of the mapped arrays; KeyError for an unknown shape
+def shape_points(store: ShapeStore, shape_id):
+    i = shape_position(store, shape_id)
+    if i < 0:
+        raise KeyError(shape_id)
+    lo, hi = store.offsets[i], store.offsets[i + 1]
+    return store.coords[lo:hi], store.cum_dist[lo:hi]
+
+
+# @Return a shape's vertices in meters as [lon * lon_dist, lat * lat_dist], the layout the projection code uses
+def shape_vertices(store: ShapeStore, shape_id, lat_dist: float, lon_dist: float) -> numpy.ndarray:
+    coords = shape_points(store, shape_id)[0]
+    return numpy.column_stack([coords[:, 1] * lon_dist, coords[:, 0] * lat_dist])
+
+
+# @Return the shape_ids of a route's planned trips, empty for an unknown route
+def route_shapes(store: ShapeStore, route_id) -> numpy.ndarray:
+    i = int(numpy.searchsorted(store.route_ids, route_id))
+    if i == len(store.route_ids) or store.route_ids[i] != route_id:
+        return store.route_shapes[0:0]
+    return store.route_shapes[store.route_offsets[i]:store.route_offsets[i + 1]]
@@ -1,57 +1,99 @@
 from pathlib import Path
 
+import numpy
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import datetime
+import shutil
 
-# Constants
-DISTANCE_THRESHOLD = 60  # Portland city blocks are about 60 m wide
-SUSPICIOUSLY_TOO_FAR = 1000  # If the trip average deviation is above this amount, put in 'bad' folder
+import deviation_dataset
+import trip_store
+import trip_summary
+
+# Constants, shared with the other scripts; suspicion_sweep.py tries other values on the saved trip summary
+DISTANCE_THRESHOLD = trip_summary.DISTANCE_THRESHOLD  # Portland city blocks are about 60 m wide
+SUSPICIOUSLY_TOO_FAR = trip_summary.SUSPICIOUSLY_TOO_FAR  # trips averaging at least this far go in the 'bad' folder
+SPOOL_ROWS = 2000000  # about this many rows of an output file are sorted in memory at a time
+SPOOL_DIR = Path().joinpath('..', 'out', 'suspicion_level')  # spools go in spool-<name> directories here
 
-print("Computing suspicion levels! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
-print("Loading data from files. Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
 
-# Load the data
-path = Path().joinpath('..', 'out', 'deviations')
-files = path.glob("*.csv")
-li = []
+# Spool of the rows of one output file, which lists the given trips in order
+# The dataset is read one file at a time, so rows are spooled to Parquet by bucket of consecutive trips (about
+# SPOOL_ROWS rows per bucket, going by rows_per_trip), and each bucket is sorted on its own when the file is written
+def open_spool(name: str, trip_order: pd.Index, rows_per_trip: pd.Series) -> dict:
+    rows = rows_per_trip.reindex(trip_order).fillna(0).to_numpy()
+    buckets = (numpy.cumsum(rows) - rows) // SPOOL_ROWS
+    spool_dir = SPOOL_DIR.joinpath('spool-' + name)
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    spool_dir.mkdir(parents=True)
+    return {'dir': spool_dir, 'rank': pd.Series(numpy.arange(len(trip_order)), index=trip_order),
+            'bucket': pd.Series(buckets.astype('int64'), index=trip_order), 'writers': {}}
 
-for filename in files:
-    li.append(pd.read_csv(filename, header=0))
 
-crumbs = pd.concat(li, axis=0, ignore_index=True)
-del li, filename, files, path
+# Adds a frame of rows to the spool; rows of a trip keep the order they are added in
+# Integer columns become nullable Int64, so every file's rows have one schema and print the same in the CSV
+def spool_rows(spool: dict, rows: pd.DataFrame):
+    rows = rows.astype({c: 'Int64' for c in deviation_dataset.INTEGER_COLUMNS if c in rows.columns})
+    rows = rows.assign(rank=rows['tripID'].map(spool['rank']))
+    for bucket, part in rows.groupby(rows['tripID'].map(spool['bucket']), sort=False):
+        table = pa.Table.from_pandas(part, preserve_index=False)
+        if bucket not in spool['writers']:
+            spool['writers'][bucket] = pq.ParquetWriter(spool['dir'].joinpath(str(bucket) + '.parquet'), table.schema)
+        spool['writers'][bucket].write_table(table)
 
-# Quick cleanup - remove this if your dataset doesn't have an unwanted two columns on left side
-crumbs = crumbs.iloc[:, 2:]
 
-# First filter out trips above the SUSPICIOUSLY_TOO_FAR threshold
+# Writes the spooled rows to a CSV, one sorted bucket at a time, and removes the spool
+def write_spool(spool: dict, path: Path, columns: list):
+    pd.DataFrame(columns=columns).to_csv(path, index=False)
+    for bucket in sorted(spool['writers']):
+        spool['writers'][bucket].close()
+        rows = pd.read_parquet(spool['dir'].joinpath(str(bucket) + '.parquet'))
+        rows.sort_values('rank', kind='stable')[columns].to_csv(path, mode='a', header=False, index=False)
+    shutil.rmtree(spool['dir'])
+
+print("Computing suspicion levels! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+
+# Score every trip from per-file partial aggregates: mean distance, crumb count and count above DISTANCE_THRESHOLD
+print("Aggregating deviations per trip. Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+files = deviation_dataset.partition_files()
+summary = trip_summary.dataset_summary(DISTANCE_THRESHOLD, files)
+trip_summary.save_summary(summary)
+trips = trip_summary.finalize(summary)
+
+# Split the crumbs in one filtered scan: trips above the SUSPICIOUSLY_TOO_FAR threshold go to the 'bad' file,
+# the others get their suspicion level (the % of crumbs above DISTANCE_THRESHOLD). Trips without any distance go to
+# neither file. Each file's rows are spooled as they are read; the 'bad' file lists trips by tripID and the other by
+# suspicion level (then tripID), a trip's rows in dataset order.
 print("Filtering out trips that are suspiciously too far from assigned routes. Began: " +
       datetime.datetime.now().strftime("%H:%M:%S"))
-dist = crumbs.groupby(['tripID']).mean()[['distance']]
-bad_trips = dist.query('distance >= @SUSPICIOUSLY_TOO_FAR').reset_index()
-savable = pd.merge_ordered(crumbs, bad_trips, how='inner', on=['tripID'])  # select ... where ... in
-savable = savable.iloc[:, 0:-1]  # drop rightmost column, which is the mean()
-savable = savable.rename(columns={"distance_x": "distance"})
-savable.to_csv(Path().joinpath('..', 'out', 'suspicion_level', 'bad',
-                               'suspiciously_too_far.csv'), index=False)
-good_trips = dist.query('distance < @SUSPICIOUSLY_TOO_FAR').reset_index()
-crumbs = pd.merge_ordered(crumbs, good_trips, how='inner', on=['tripID'])
-crumbs = crumbs.iloc[:, 0:-1]  # drop rightmost column, which is the mean()
-crumbs = crumbs.rename(columns={"distance_x": "distance"})
-del bad_trips, dist, savable, good_trips
-
-# Populate the suspicion level field with the % of crumbs above DISTANCE_THRESHOLD
-print("Calculating the % of deviations above threshold for recorded trips.")
-num = crumbs.query('distance > @DISTANCE_THRESHOLD').groupby(['tripID']).count()[['distance']]
-denom = crumbs.groupby(['tripID']).count()[['distance']]
-new_val = num['distance'] / denom['distance']
-crumbs = pd.merge_ordered(crumbs, new_val, how='inner', on=['tripID']).fillna(0)
-crumbs = crumbs.rename(columns={"distance_y": "suspicionLevel"})
-crumbs = crumbs.rename(columns={"distance_x": "distance"})
-crumbs = crumbs.sort_values('suspicionLevel')
-del num, denom, new_val
+too_far = trips['meanDistance'] >= SUSPICIOUSLY_TOO_FAR
+bad_spool = open_spool('bad', trips.index[too_far].sort_values(), trips['count'])
+good = trips[trips['meanDistance'] < SUSPICIOUSLY_TOO_FAR].reset_index()
+good_spool = open_spool('good', pd.Index(good.sort_values(['suspicionLevel', 'tripID'])['tripID']), trips['count'])
+trip_parts = []  # each trip's service day, route, vehicle and shape, for the trip store
+for f in files:
+    part = deviation_dataset.read_partition_file(f, columns=deviation_dataset.OUTPUT_COLUMNS + ['serviceDay'])
+    trip_parts.append(part.groupby('tripID')[['serviceDay', 'routeID', 'vehicleID', 'shapeID']].first())
+    part = part[deviation_dataset.OUTPUT_COLUMNS]
+    mean = part['tripID'].map(trips['meanDistance'])
+    spool_rows(bad_spool, part[mean >= SUSPICIOUSLY_TOO_FAR])
+    part = part[mean < SUSPICIOUSLY_TOO_FAR]
+    spool_rows(good_spool, part.assign(suspicionLevel=part['tripID'].map(trips['suspicionLevel'])).fillna(0))
+
+# Save the trip-level results to the store that loadWorkingData.py and others query
+print("Writing trip store... Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+trip_info = pd.concat(trip_parts)
+trip_info = trip_info[~trip_info.index.duplicated(keep='first')]  # a trip spanning service days keeps its first
+scored = trips[trips['count'] > 0]
+scored = scored.assign(crumbs=scored['count'], tooFar=scored['meanDistance'] >= SUSPICIOUSLY_TOO_FAR)
+trip_store.write_store(scored.join(trip_info).reset_index())
+del trip_parts, trips, summary, trip_info, scored, good
 
 # Save the results
 print("Saving results to csv...")
-crumbs.to_csv(Path().joinpath('..', 'out', 'suspicion_level', 'suspiciously_too_far.csv'), index=False)
+write_spool(bad_spool, Path().joinpath('..', 'out', 'suspicion_level', 'bad', 'suspiciously_too_far.csv'),
+            deviation_dataset.OUTPUT_COLUMNS)
+write_spool(good_spool, Path().joinpath('..', 'out', 'suspicion_level', 'suspiciously_too_far.csv'),
+            deviation_dataset.OUTPUT_COLUMNS + ['suspicionLevel'])
 print("Operations complete!")
@@ -0,0 +1,79 @@
+import argparse
+import datetime
+import pandas as pd
+
+import trip_summary
+
+# Threshold sweep over the per-trip summary saved by sort_by_suspicion_level.py
+# For every combination of deviation threshold and too-far threshold, prints how many trips would be set aside as
+# 'bad' and how the suspicion levels of the others are distributed. Nothing is read but the summary, so trying other
+# thresholds takes seconds instead of a rerun over the crumbs. Thresholds that are not histogram bin edges are
+# evaluated at the edge just below them (trip_summary.histogram_edge), with a warning; the table shows the edge used.
+#
+# usage: python suspicion_sweep.py -t 10,30,60,100 -f 500,1000 [-o levels.csv]
+#   -o writes every trip's suspicion level for each deviation threshold (at the first too-far threshold)
+
+
+def thresholds(text: str) -> list:
+    return [float(t) for t in text.split(',') if t.strip()]
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--thresholds", default=str(trip_summary.DISTANCE_THRESHOLD), type=thresholds,
+                        help="deviation thresholds in meters, separated by commas; one that is not a histogram bin "
+                             "edge (trip_summary.HISTOGRAM_EDGES) is rounded down to the edge below it")
+    parser.add_argument("-f", "--toofar", default=str(trip_summary.SUSPICIOUSLY_TOO_FAR), type=thresholds,
+                        help="mean deviations in meters above which a trip is set aside as bad, separated by commas")
+    parser.add_argument("-s", "--summary", default=trip_summary.SUMMARY_FILE,
+                        help="trip summary written by sort_by_suspicion_level.py")
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="write tripID plus one suspicionLevel column per deviation threshold to this csv")
+    return parser.parse_args()
+
+
+# @Return one row per (threshold, too-far threshold) pair with the trip counts and suspicion level quantiles
+def sweep(summary: pd.DataFrame, deviation_thresholds: list, too_far_thresholds: list) -> pd.DataFrame:
+    rows = []
+    for threshold in deviation_thresholds:
+        for too_far in too_far_thresholds:
+            scores = trip_summary.rescore(summary, threshold, too_far)
+            levels = scores.loc[~scores['tooFar'], 'suspicionLevel']
+            rows.append({'threshold': threshold, 'edge': trip_summary.histogram_edge(threshold), 'tooFar': too_far,
+                         'badTrips': int(scores['tooFar'].sum()), 'scoredTrips': len(levels),
+                         'meanLevel': levels.mean(), 'medianLevel': levels.median(),
+                         'p90Level': levels.quantile(0.9), 'tripsAbove50pct': int((levels > 0.5).sum())})
+    return pd.DataFrame(rows)
+
+
+# Warns about the thresholds the summary cannot count exactly, naming the edges around them
+def check_thresholds(deviation_thresholds: list):
+    for threshold in deviation_thresholds:
+        edge = trip_summary.histogram_edge(threshold)
+        if edge != threshold:
+            above = trip_summary.HISTOGRAM_EDGES[trip_summary.HISTOGRAM_EDGES > threshold]
+            hint = " (next edge up: " + format(above[0], 'g') + " m)" if edge < threshold and len(above) else ""
+            print("Warning: threshold " + format(threshold, 'g') + " m is not a histogram bin edge; it is evaluated at "
+                  + format(edge, 'g') + " m" + hint)
+
+
+def main():
+    args = initialize()
+    print("Sweeping suspicion thresholds! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+    check_thresholds(args.thresholds)
+    summary = trip_summary.load_summary(args.summary)
+    print(str(len(summary)) + " trips in " + str(args.summary))
+    print(sweep(summary, args.thresholds, args.toofar).to_string(index=False, float_format='{:.3f}'.format))
+
+    if args.outfile is not None:
+        scored = trip_summary.rescore(summary, too_far=args.toofar[0])
+        scored = scored[~scored['tooFar']]
+        levels = pd.DataFrame({'suspicionLevel_' + format(t, 'g'):
+                               trip_summary.count_over(summary.loc[scored.index], t) / summary.loc[scored.index, 'count']
+                               for t in args.thresholds})
+        levels.to_csv(args.outfile)
+        print("wrote suspicion levels of " + str(len(levels)) + " trips to " + args.outfile)
+
+
+if __name__ == '__main__':
+    main()
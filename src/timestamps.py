@@ -0,0 +1,51 @@
+import datetime
+
+import numpy
+import pandas as pd
+
+# Vectorized breadcrumb timestamps
+# A reading's moment is OPD_DATE (e.g. '24-FEB-20') plus ACT_TIME seconds. The scripts used to build it one row at a
+# time with strptime() + timedelta() and datetime.timestamp(); here each distinct date is parsed once and ACT_TIME
+# is added as one timedelta column.
+
+OPD_DATE_FORMAT = '%d-%b-%y'
+EPOCH = pd.Timestamp(0)
+ONE_SECOND = pd.Timedelta(seconds=1)
+
+
+# @Return datetime64 Series of midnight on each OPD_DATE, parsing every distinct date string only once
+def parse_opd_dates(opd_dates) -> pd.Series:
+    opd_dates = pd.Series(opd_dates)
+    codes, uniques = pd.factorize(opd_dates.astype(str))
+    parsed = pd.to_datetime(pd.Series(uniques), format=OPD_DATE_FORMAT)
+    return pd.Series(parsed.to_numpy()[codes], index=opd_dates.index)
+
+
+# @Return naive datetime64 Series of OPD_DATE + ACT_TIME seconds
+def crumb_datetimes(opd_dates, act_times) -> pd.Series:
+    dates = parse_opd_dates(opd_dates)
+    act_times = numpy.asarray(act_times, dtype='float64')
+    return dates + pd.to_timedelta(act_times, unit='s')
+
+
+# @Return float epoch seconds for naive datetimes read as local time, the same value datetime.timestamp() gives
+# Local UTC offsets only change on the hour, so the offset is looked up once per distinct hour
+def local_epoch_seconds(datetimes: pd.Series) -> pd.Series:
+    naive_seconds = (datetimes - EPOCH) / ONE_SECOND
+    hours = datetimes.dt.floor('h')
+    offsets = {hour: hour.to_pydatetime().timestamp() - (hour - EPOCH) / ONE_SECOND
+               for hour in pd.DatetimeIndex(hours.unique())}
+    return naive_seconds + hours.map(offsets)
+
+
+# @Return (epoch seconds, datetime64) for each breadcrumb
+# The epoch seconds match what the output CSVs' timestamp column has always held
+def crumb_timestamps(opd_dates, act_times):
+    datetimes = crumb_datetimes(opd_dates, act_times)
+    return local_epoch_seconds(datetimes), datetimes
+
+
+# Row-at-a-time reference version, kept for spot checks against the vectorized path
+def crumb_timestamp(opd_date: str, act_time) -> float:
+    ts = datetime.datetime.strptime(opd_date, OPD_DATE_FORMAT) + datetime.timedelta(seconds=act_time)
+    return ts.timestamp()
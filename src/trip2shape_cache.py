@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import datetime
+import os
+import pandas as pd
+
+import breadcrumb_reader
+import crumb_cache
+import deviation_manifest
+import matchTripToShape
+
+# Cache of the trip -> shape mapping (the trip2shape file variance_calculator.py reads)
+# The mapping is computed on demand with matchTripToShape.py and kept per breadcrumb file ("partition"), under a
+# directory named after a hash of the GTFS feed, the CAD/AVL trip list and the matching constants. A rerun reads the
+# cached mappings back; adding a breadcrumb file maps only that file's trips, and a new feed starts a fresh directory.
+
+MAPPING_DIR = crumb_cache.CACHE_DIR.joinpath('trip2shape')
+FEED_FILES = ['routes.txt', 'trips.txt', 'shapes.txt', 'stop_times.txt', 'calendar.txt', 'calendar_dates.txt']
+MAPPING_COLUMNS = ['tripID', 'shapeID', 'plannedTripID']
+
+
+# @Return the cache key of a GTFS feed plus CAD/AVL file, which changes whenever any of them or the matcher does
+def feed_key(gtfs_dir: Path, cad_avl_file: Path) -> str:
+    sources = [Path(gtfs_dir).joinpath(name) for name in FEED_FILES if Path(gtfs_dir).joinpath(name).is_file()]
+    constants = {'trajectory_points': matchTripToShape.TRAJECTORY_POINTS}
+    return crumb_cache.source_hash(sources + [Path(cad_avl_file)]) + '-' + deviation_manifest.value_hash(constants)
+
+
+# Maps one partition's trips and writes them to path (through a temporary file, so a crash leaves no partial mapping)
+def map_partition(breadcrumb_file: Path, path: Path, workers: int):
+    print("Mapping trips of " + Path(breadcrumb_file).name + " to shapes... Began: " +
+          datetime.datetime.now().strftime("%H:%M:%S"))
+    matchTripToShape.breadcrumbfiles = [breadcrumb_file]
+    matchTripToShape.ingest_breadcrumbs(cache=False)
+    rows = matchTripToShape.map_all_trips(workers)
+    mapping = pd.DataFrame([row[:3] for row in rows], columns=MAPPING_COLUMNS)
+    tmp = path.with_suffix('.tmp')
+    mapping.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+# @Return the merged mapping last written for this feed, or None when there is none; nothing is mapped or hashed
+# beyond the feed itself, for readers that want whatever trips are already mapped without starting a mapping run
+def latest_mapping_file(gtfs_dir: Path, cad_avl_file: Path) -> Path:
+    merged = sorted(MAPPING_DIR.joinpath(feed_key(gtfs_dir, cad_avl_file)).glob('trip2shape-*.csv'),
+                    key=lambda path: path.stat().st_mtime)
+    return merged[-1] if merged else None
+
+
+# @Return the path of a tripID,shapeID,plannedTripID file covering every trip of the breadcrumb source
+# Partitions without a cached mapping for this feed are mapped first (all of them with rebuild); a trip whose crumbs
+# span two files keeps the mapping of the first file it appears in; shape_store_dir is where makeRouteShapeFiles wrote
+# the feed's shape stores, if anywhere
+def mapping_file(breadcrumb_source, gtfs_dir: Path, cad_avl_file: Path, workers: int = 1,
+                 rebuild: bool = False, shape_store_dir: Path = None) -> Path:
+    feed_dir = MAPPING_DIR.joinpath(feed_key(gtfs_dir, cad_avl_file))
+    parts = [(f, feed_dir.joinpath(f.stem + '-' + crumb_cache.source_hash([f]) + '.csv'))
+             for f in breadcrumb_reader.breadcrumb_files(breadcrumb_source)]
+    pending = [(f, path) for f, path in parts if rebuild or not path.is_file()]
+    print(str(len(pending)) + " of " + str(len(parts)) + " breadcrumb partitions need a trip2shape mapping")
+
+    if pending:
+        feed_dir.mkdir(parents=True, exist_ok=True)
+        matchTripToShape.DEBUG = False
+        matchTripToShape.gtfsdir = str(gtfs_dir)
+        matchTripToShape.shapesfile = os.path.join(str(gtfs_dir), "shapes.txt")
+        matchTripToShape.shapesdir = shape_store_dir
+        matchTripToShape.cadavlfile = str(cad_avl_file)
+        matchTripToShape.cachedir = str(crumb_cache.CACHE_DIR)
+        matchTripToShape.ingest_feed()
+        for f, path in pending:
+            map_partition(f, path, workers)
+
+    # One merged file per set of partitions, so readers and crumb_cache keys see a single source
+    merged = feed_dir.joinpath('trip2shape-' + deviation_manifest.value_hash([path.name for _, path in parts]) +
+                               '.csv')
+    if pending or not merged.is_file():
+        for stale in feed_dir.glob('trip2shape-*.csv'):
+            stale.unlink()
+        mapping = pd.concat([pd.read_csv(path) for _, path in parts], ignore_index=True)
+        mapping = mapping.drop_duplicates('tripID', keep='first')
+        tmp = merged.with_suffix('.tmp')
+        mapping.to_csv(tmp, index=False)
+        os.replace(tmp, merged)
+    return merged
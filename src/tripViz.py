@@ -1,7 +1,17 @@
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
 import pandas as pd
 import argparse
+import json
+import math
 import sys, traceback
-from pathlib import Path
+
+import crumb_store
+import deviation_thresholds
+import polyline
+import shape_store
 
 # tripviz.py: visualize C-Tran recorded trips along with the corresponding planned trip
 #     with highlights for recorded trip locations that deviate from the planned trip.
@@ -24,15 +34,29 @@ from pathlib import Path
 #  yellow line segments for each breadcrumb reading that deviates more than
 #  deviation_threshold from the planned trip.
 #
+#  batch mode: to review many trips, give a list of trips with --trips (IDs separated by commas, or a file
+#  with one ID per line) or ask for the --top N trips by suspicionLevel. Both input files are read once
+#  and one tripviz_<tripID>.html per trip is written to --outdir, on --workers processes if asked.
+#     e.g. python tripviz.py --top 500 -w 4 --outdir maps
+#
+#  use --compact for much smaller HTML files: the geometry is written as one JSON payload of encoded
+#  polylines, the deviations are drawn as a single layer, and --simplify <meters> thins out the shape.
+#
+#  server mode: "python tripviz.py --serve 8000" reads the inputs once and serves a trip viewer page at
+#  http://localhost:8000/ that loads each trip's geometry on demand. --leafletdir serves leaflet.js/.css
+#  from a local copy instead of unpkg.com, and --notiles leaves out the mapbox tile layer, so the viewer
+#  can run without any outside service. --heatmap adds a checkbox for the fleet-wide deviation heatmap
+#  written by deviation_heatmap.py (../out/heatmap/heatmap.json).
+#
 
 DEBUG = False
 
 DEFAULT_TRIPID = -1
 tripID = DEFAULT_TRIPID  # the trip to be analyzed. user must specify tripID on command line
 
-corr_df = pd.DataFrame()  # corrected recorded trip data
-shapes_df = pd.DataFrame()  # GTFS shapes data
-trip_df = pd.DataFrame()  # subset of corr_df corresponding to tripID
+crumbs = None  # corrected recorded trip data, as a memory-mapped crumb_store.CrumbStore indexed by trip
+shapes = None  # GTFS shapes data, as a memory-mapped shape_store.ShapeStore
+trip_df = pd.DataFrame()  # readings of crumbs corresponding to tripID
 
 DEFAULT_CORRECTIONS_FILE = "suspiciously_too_far.csv"
 corrections_file = DEFAULT_CORRECTIONS_FILE  # file containing corrected trip data
@@ -40,11 +64,36 @@ corrections_file = DEFAULT_CORRECTIONS_FILE  # file containing corrected trip da
 DEFAULT_SHAPES_FILE = "shapes.txt"
 shapes_file = DEFAULT_SHAPES_FILE  # file containing GTFS shapes data
 
+DEFAULT_SHAPES_DIR = "../out/shapes"  # variance_calculator.SHAPE_STORE_DIR, from src/
+shapes_dir = DEFAULT_SHAPES_DIR  # makeRouteShapeFiles' shape stores, mapped instead of building one when current
+
+DEFAULT_CACHE_DIR = "cache"
+cache_dir = DEFAULT_CACHE_DIR  # the binary stores of the corrections and shapes files are built here on first use
+
 DEFAULT_OUTPUT_HTML_FILE = "tripviz.html"
 outhtml = DEFAULT_OUTPUT_HTML_FILE  # output file
 
-DEFAULT_DEVIATION_THRESHOLD = 10.0
-deviation_theshold = 60  # in meters
+DEFAULT_DEVIATION_THRESHOLD = float(deviation_thresholds.DISTANCE_THRESHOLD)
+deviation_threshold = DEFAULT_DEVIATION_THRESHOLD  # in meters
+
+# batch mode
+batch_trips = None  # trip IDs to render, from --trips
+top_n = None  # or render this many trips with the highest suspicionLevel
+DEFAULT_OUTDIR = "tripviz"
+outdir = DEFAULT_OUTDIR  # batch mode output directory
+DEFAULT_WORKERS = 1
+workers = DEFAULT_WORKERS  # processes rendering maps in parallel
+compact = False  # write the geometry as encoded polylines in one JSON payload
+simplify_tolerance = 0.0  # meters; shape points closer than this to the simplified line are dropped (0 keeps all)
+
+# server mode
+serve_port = None  # port to serve the trip viewer on, from --serve
+leaflet_dir = None  # local directory with leaflet.js and leaflet.css, from --leafletdir
+tiles = True  # draw the mapbox tile layer under the trips
+trip_list_json = b"[]"  # the /trips response, built once at startup
+heatmap_file = None  # deviation_heatmap.py output served at /heatmap, from --heatmap
+CORRECTIONS_COLUMNS = ['tripID', 'timestamp', 'vehicleID', 'origLatitude', 'origLongitude', 'shapeID', 'routeID',
+                       'correctedLatitude', 'correctedLongitude', 'distance', 'suspicionLevel']
 
 ts_lis = []
 olat_lis = []
@@ -59,14 +108,20 @@ slon_lis = []
 
 
 def initialize():
-    global tripID, DEBUG, outhtml, corrections_file, shapes_file
+    global tripID, DEBUG, outhtml, corrections_file, shapes_file, shapes_dir, cache_dir
     global sample_file, numsamples, deviation_threshold
+    global batch_trips, top_n, outdir, workers, compact, simplify_tolerance
+    global serve_port, leaflet_dir, tiles, heatmap_file
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--correctionsfile", default=DEFAULT_CORRECTIONS_FILE,
                         help="file containing corrected breadcrumb coordinates")
     parser.add_argument("-s", "--shapesfile", default=DEFAULT_SHAPES_FILE,
                         help="gtfs data file containing geometric shapes for routes")
+    parser.add_argument("--shapesdir", default=DEFAULT_SHAPES_DIR,
+                        help="directory of the shape stores written by makeRouteShapeFiles")
+    parser.add_argument("--cachedir", default=DEFAULT_CACHE_DIR,
+                        help="directory for the binary stores built from the corrections and shapes files")
     parser.add_argument("-d", "--debug", default=False,
                         help="debugging switch", action="store_true")
     parser.add_argument("-o", "--outhtml", default=DEFAULT_OUTPUT_HTML_FILE,
@@ -75,57 +130,111 @@ def initialize():
                         help="ID of trip to be analyzed")
     parser.add_argument("--deviation_threshold", default=DEFAULT_DEVIATION_THRESHOLD,
                         help="breadcrumb readings greater than this value (in meters) will be highlighted")
+    parser.add_argument("--trips", default=None,
+                        help="batch mode: trip IDs separated by commas, or a file with one trip ID per line")
+    parser.add_argument("--top", default=None, type=int,
+                        help="batch mode: render this many trips with the highest suspicionLevel")
+    parser.add_argument("--outdir", default=DEFAULT_OUTDIR,
+                        help="batch mode: directory for the tripviz_<tripID>.html files")
+    parser.add_argument("-w", "--workers", default=DEFAULT_WORKERS, type=int,
+                        help="batch mode: number of processes rendering maps in parallel")
+    parser.add_argument("--compact", default=False, action="store_true",
+                        help="write the trip as encoded polylines in one JSON payload instead of coordinate lists")
+    parser.add_argument("--simplify", default=0.0, type=float,
+                        help="with --compact, simplify the shape to within this many meters (Douglas-Peucker)")
+    parser.add_argument("--serve", default=None, type=int,
+                        help="server mode: serve the trip viewer on this localhost port")
+    parser.add_argument("--leafletdir", default=None,
+                        help="server mode: directory holding leaflet.js and leaflet.css, instead of unpkg.com")
+    parser.add_argument("--notiles", default=False, action="store_true",
+                        help="server mode: no mapbox tile layer, just the trips")
+    parser.add_argument("--heatmap", default=None,
+                        help="server mode: heatmap.json from deviation_heatmap.py, drawn as an optional layer")
     args = parser.parse_args()
 
     outhtml = args.outhtml
     DEBUG = args.debug
     corrections_file = args.correctionsfile
     shapes_file = args.shapesfile
+    shapes_dir = args.shapesdir
+    cache_dir = args.cachedir
     tripID = int(args.tripID)
     deviation_threshold = float(args.deviation_threshold)
-
-
-def readCSVfile(fname, parsed=[], idf=False):
+    outdir = args.outdir
+    compact = args.compact
+    simplify_tolerance = args.simplify
+    serve_port = args.serve
+    leaflet_dir = args.leafletdir
+    tiles = not args.notiles
+    heatmap_file = args.heatmap
+    workers = args.workers
+    top_n = args.top
+    if (args.trips is not None):
+        if (Path(args.trips).is_file()):
+            batch_trips = [int(line) for line in Path(args.trips).read_text().split()]
+        else:
+            batch_trips = [int(t) for t in args.trips.split(',') if t.strip()]
+
+
+def readCSVfile(fname, parsed=[], idf=False, usecols=None):
     if (DEBUG): print(f"\treading data file: {fname}")
     df = pd.read_csv(fname, parse_dates=parsed, infer_datetime_format=idf,
-                     low_memory=False)
+                     usecols=None if usecols is None else lambda c: c in usecols, low_memory=False)
     return df
 
 
-# read in all of the data and compute teh shapeID if needed
-def ingest_data():
-    global shapes_df, corr_df, shapeID, trip_df
+# map the stores of both input files, building them on the first run over these files
+def load_inputs():
+    global shapes, crumbs
+
+    crumbs = crumb_store.cached_store(Path(corrections_file).stem + '-crumbs', [corrections_file],
+                                      lambda: readCSVfile(corrections_file, usecols=CORRECTIONS_COLUMNS),
+                                      'tripID', 'timestamp', cache_dir=cache_dir)
+    if (DEBUG): print(f"\tmapped crumb store of: {corrections_file}")
+    shapes = shape_store.load_store(shapes_file, out_dir=shapes_dir, cache_dir=cache_dir)
+    if (DEBUG): print(f"\tmapped shape store of: {shapes_file}")
+
+
+# make tid the trip to be drawn: fill in the per-trip globals from the indexed inputs
+# @Return False, after printing why, when the trip or its shape cannot be found
+def select_trip(tid):
+    global tripID, shapeID, trip_df
     global ts_lis, olat_lis, vehicleID, olat_lis, olon_lis, routeID, clat_lis, clon_lis
     global dist_lis, slat_lis, slon_lis
 
-    try:
-        if (DEBUG): print("BEGIN ingesting data")
-
-        corr_df = readCSVfile(corrections_file)
+    tripID = tid
+    if (not crumb_store.has_trip(crumbs, tid)):
+        print(f"ERROR: trip {tid} not found in corrections file {corrections_file}")
+        return False
+    trip_df = crumb_store.trip_frame(crumbs, tid)
+
+    shapeID = trip_df['shapeID'].iloc[0]  # assume: all shapeIDs for a given tripID identical
+    ts_lis = trip_df['timestamp'].tolist()
+    vehicleID = trip_df['vehicleID'].iloc[0]  # assume: all shapeIDs for a given tripID identical
+    olat_lis = trip_df['origLatitude'].tolist()
+    olon_lis = trip_df['origLongitude'].tolist()
+    routeID = trip_df['routeID'].iloc[0]  # assume: all routeIDs for a given tripID identical
+    clat_lis = trip_df['correctedLatitude'].tolist()
+    clon_lis = trip_df['correctedLongitude'].tolist()
+    dist_lis = trip_df['distance'].tolist()
+    if (not shape_store.has_shape(shapes, shapeID)):
+        print(
+            f"ERROR: shape {shapeID} listed in {corrections_file} for trip {tid} is not found in shapes file {shapes_file}")
+        return False
+    coords = shape_store.shape_points(shapes, shapeID)[0]
+    slat_lis = coords[:, 0].tolist()
+    slon_lis = coords[:, 1].tolist()
+    return True
 
-        shapes_df = readCSVfile(shapes_file)
 
-        trip_df = corr_df.loc[corr_df["tripID"] == tripID]
-        if (trip_df.empty):
-            print(f"ERROR: trip {tripID} not found in corrections file {corrections_file}")
-            exit(-1)
+# read in all of the data and compute teh shapeID if needed
+def ingest_data():
+    try:
+        if (DEBUG): print("BEGIN ingesting data")
 
-        shapeID = trip_df['shapeID'].iloc[0]  # assume: all shapeIDs for a given tripID identical
-        ts_lis = trip_df['timestamp'].tolist()
-        vehicleID = trip_df['vehicleID'].iloc[0]  # assume: all shapeIDs for a given tripID identical
-        olat_lis = trip_df['origLatitude'].tolist()
-        olon_lis = trip_df['origLongitude'].tolist()
-        routeID = trip_df['routeID'].iloc[0]  # assume: all routeIDs for a given tripID identical
-        clat_lis = trip_df['correctedLatitude'].tolist()
-        clon_lis = trip_df['correctedLongitude'].tolist()
-        dist_lis = trip_df['distance'].tolist()
-        shapes_df = shapes_df.loc[shapes_df["shape_id"] == shapeID]
-        if (shapes_df.empty):
-            print(
-                f"ERROR: shape {shapeID} listed in {corrections_file} for trip {tripID} is not found in shapes file {shapes_file}")
+        load_inputs()
+        if (not select_trip(tripID)):
             exit(-1)
-        slat_lis = shapes_df['shape_pt_lat'].tolist()
-        slon_lis = shapes_df['shape_pt_lon'].tolist()
 
         if (DEBUG): print("END ingesting data")
 
@@ -136,13 +245,97 @@ def ingest_data():
         exit(-1)
 
 
-# output html+CSS+javascript showing both trips on a map
-# requires you to have an app key from http://mapbox.com
-# if you don't have one then go get one and update the appkey variable accordingly
-#
-def output_html():
-    global bc_df
+# the trips to render in batch mode: the --trips list, or the --top N by suspicionLevel
+def select_batch_trips():
+    if (batch_trips is not None):
+        return batch_trips
+    if ('suspicionLevel' not in crumbs.columns):
+        print(f"ERROR: {corrections_file} has no suspicionLevel column to pick the top {top_n} trips by")
+        exit(-1)
+    levels = pd.DataFrame({'tripID': crumbs.trip_ids,
+                           'suspicionLevel': crumb_store.first_values(crumbs, 'suspicionLevel')})
+    levels = levels.sort_values(['suspicionLevel', 'tripID'], ascending=[False, True], kind='stable')
+    return levels['tripID'].head(top_n).tolist()
+
+
+# everything output_html() needs to draw one trip, small enough to hand to a worker process
+def trip_job(tid):
+    return {'tripID': tid, 'shapeID': shapeID, 'ts_lis': ts_lis, 'vehicleID': vehicleID, 'routeID': routeID,
+            'olat_lis': olat_lis, 'olon_lis': olon_lis, 'clat_lis': clat_lis, 'clon_lis': clon_lis,
+            'dist_lis': dist_lis, 'slat_lis': slat_lis, 'slon_lis': slon_lis,
+            'outhtml': str(Path(outdir).joinpath(f"tripviz_{tid}.html")),
+            'deviation_threshold': deviation_threshold, 'DEBUG': DEBUG,
+            'compact': compact, 'simplify_tolerance': simplify_tolerance}
+
+
+def render_job(job):
+    globals().update(job)
+    output_html()
+    return job['outhtml']
+
+
+# batch mode: render every selected trip's map from the inputs loaded once
+def output_batch():
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    jobs = [trip_job(tid) for tid in select_batch_trips() if select_trip(tid)]
+    if (workers > 1):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            files = list(pool.map(render_job, jobs, chunksize=8))
+    else:
+        files = [render_job(job) for job in jobs]
+    print(f"wrote {len(files)} trip maps to {outdir}")
+
+
+# the selected trip's geometry as one JSON-ready dict of encoded polylines (see polyline.py)
+# deviations holds two points per deviating breadcrumb: its original and its corrected position
+def trip_payload():
+    keep = polyline.simplify(slat_lis, slon_lis, simplify_tolerance)
+    devs = [i for i in range(len(dist_lis)) if dist_lis[i] > deviation_threshold]
+    dev_lats = [lat for i in devs for lat in (olat_lis[i], clat_lis[i])]
+    dev_lons = [lon for i in devs for lon in (olon_lis[i], clon_lis[i])]
+    return {'tripID': json_scalar(tripID), 'shapeID': json_scalar(shapeID),
+            'vehicleID': json_scalar(vehicleID), 'routeID': json_scalar(routeID),
+            'start': json_scalar(ts_lis[0]), 'end': json_scalar(ts_lis[-1]),
+            'readings': len(dist_lis), 'deviations': len(devs), 'threshold': deviation_threshold,
+            'precision': polyline.DEFAULT_PRECISION,
+            'recorded': polyline.encode(olat_lis, olon_lis),
+            'shape': polyline.encode([slat_lis[i] for i in keep], [slon_lis[i] for i in keep]),
+            'deviationSegments': polyline.encode(dev_lats, dev_lons)}
+
+
+# draws a trip_payload() on mymap the way the verbose output does: red recorded trip, blue shape, yellow deviations
+DRAW_TRIP_JS = """
+function drawTrip(mymap, trip) {
+    var olatlons = decodePolyline(trip.recorded, trip.precision);
+    var slatlons = decodePolyline(trip.shape, trip.precision);
+    var devpoints = decodePolyline(trip.deviationSegments, trip.precision);
+    var devlines = [];
+    for (var i = 0; i + 1 < devpoints.length; i += 2) {
+        devlines.push([devpoints[i], devpoints[i + 1]]);
+    }
+    var layers = L.layerGroup([
+        L.marker(olatlons[0]).bindPopup("begin orig RECORDED trip"),
+        L.polyline(olatlons, {color: 'red'}),
+        L.marker(slatlons[0]).bindPopup("begin PLANNED trip"),
+        L.polyline(slatlons, {color: 'blue'}),
+        L.polyline(devlines, {color: 'yellow'})
+    ]).addTo(mymap);
+    return {layers: layers, opolyline: layers.getLayers()[1]};
+}
+"""
+
+
+# plain Python value for JSON: numpy scalars unwrapped, NaN (e.g. a trip with no vehicle) as null
+def json_scalar(value):
+    if (hasattr(value, 'item')):
+        value = value.item()
+    if (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
 
+# the mapbox satellite tile layer, as javascript adding it to mymap
+def tile_layer_js():
     DEFAULT_MAPBOX_TOKEN = "sk.eyJ1IjoiZGRzdGV2ZW5zb24iLCJhIjoiY2tkcWtneDVsMDQ5bDJ3cWw1ejR3NG9oNyJ9.BTpAwpX7u2D1Pz4y_lLZqg"
     # before running this script, go to mapbox.com, create an account and get an access token
     # then insert your token into the following line in place of DEFAULT_MAPBOX_TOKEN
@@ -154,6 +347,27 @@ def output_html():
             "ERROR: go to mapbox.com, create a free account, get an access token, and insert into source code before using this program")
         exit(-1)
 
+    tokenLine = "L.tileLayer('https://api.mapbox.com/styles/v1/{id}/tiles/{z}/{x}/{y}?access_token=" + mapbox_token + "', {"
+    nextHTML = """
+    		attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/">OpenStreetMap</a> contributors, <a href="https://creativecommons.org/licenses/by-sa/2.0/">CC-BY-SA</a>, Imagery © <a href="https://www.mapbox.com/">Mapbox</a>',
+    		id: 'mapbox/satellite-streets-v11',
+    		tileSize: 512,
+    		maxZoom: 33,
+    		zoomOffset: -1,
+    		accessToken: 'your.mapbox.access.token'
+		}).addTo(mymap);
+
+	"""
+    return tokenLine + nextHTML
+
+
+# output html+CSS+javascript showing both trips on a map
+# requires you to have an app key from http://mapbox.com
+# if you don't have one then go get one and update the appkey variable accordingly
+#
+def output_html():
+    global bc_df
+
     beginHTML = """
 <!DOCTYPE html>
 <html>
@@ -174,77 +388,74 @@ def output_html():
 	<script>
 		var mymap = L.map('map').setView([45.722279,-122.688873], 10);
 """
-    tokenLine = "L.tileLayer('https://api.mapbox.com/styles/v1/{id}/tiles/{z}/{x}/{y}?access_token=" + mapbox_token + "', {"
-    nextHTML = """
-    		attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/">OpenStreetMap</a> contributors, <a href="https://creativecommons.org/licenses/by-sa/2.0/">CC-BY-SA</a>, Imagery © <a href="https://www.mapbox.com/">Mapbox</a>',
-    		id: 'mapbox/satellite-streets-v11',
-    		tileSize: 512,
-    		maxZoom: 33,
-    		zoomOffset: -1,
-    		accessToken: 'your.mapbox.access.token'
-		}).addTo(mymap);
-
-	"""
-
     fil = open(outhtml, "w+")
     fil.write(beginHTML)
-    fil.write(tokenLine)
-    fil.write(nextHTML)
-
-    # create a marker for the first lat/lon pair for the recorded trip
-    lat = str(olat_lis[0])
-    lon = str(olon_lis[0])
-
-    fil.write("\t\tvar omarker = L.marker([" + lat + ',' + lon + "]).addTo(mymap);\n")
-    fil.write("\t\tomarker.bindPopup(" + '"' + "begin orig RECORDED trip" + '"' + ")\n")
-
-    # write all of the lat/lon pairs for the recorded trip
-    fil.write("\n\n\t\tvar olatlons = [\n")
-
-    for i in range(len(olat_lis)):
-        lat = str(olat_lis[i])
-        lon = str(olon_lis[i])
-        fil.write("\t\t\t[" + lat + "," + lon + "],\n")
-    fil.write("\t\t];\n")
-
-    fil.write("\n\n")
-
-    fil.write("var opolyline = L.polyline(olatlons, {color: 'red'}).addTo(mymap);\n")
-
-    # get first lat/lon pair for the corresponding shape
-    lat = str(slat_lis[0])
-    lon = str(slon_lis[0])
-
-    fil.write("\t\tvar smarker = L.marker([" + lat + ',' + lon + "]).addTo(mymap);\n")
-    fil.write("\t\tsmarker.bindPopup(" + '"' + "begin PLANNED trip" + '"' + ")\n")
-
-    # draw blue polyline for the shape (the planned trip)
-    fil.write("\n\n\t\tvar slatlons = [\n")
-
-    for i in range(len(slat_lis)):
-        lat = str(slat_lis[i])
-        lon = str(slon_lis[i])
-        fil.write("\t\t\t[" + lat + "," + lon + "],\n")
-    fil.write("\t\t];\n")
-
-    fil.write("var spolyline = L.polyline(slatlons, {color: 'blue'}).addTo(mymap);\n")
-
-    # create yellow line segments for all breadcrumbs that are far off the planned route
-    num_devs = 0
-    num_readings = len(dist_lis)
-    for i in range(num_readings):
-        dist = dist_lis[i]
-        if (dist > deviation_threshold):
-            olat = olat_lis[i]
-            olon = olon_lis[i]
-            clat = clat_lis[i]
-            clon = clon_lis[i]
-            num_devs += 1
-
-            fil.write(f"\tvar latlons_{i} = [[{olat}, {olon}], [{clat}, {clon}]];\n")
-            fil.write(f"\tvar deviationLine_{i} = L.polyline(latlons_{i}, {{color: 'yellow'}}).addTo(mymap);\n")
-
-    fil.write("\n")
+    fil.write(tile_layer_js())
+
+    if (compact):
+        # one payload of encoded polylines, decoded and drawn in the browser
+        payload = trip_payload()
+        num_devs = payload['deviations']
+        num_readings = payload['readings']
+        fil.write(polyline.DECODE_JS)
+        fil.write(DRAW_TRIP_JS)
+        fil.write("\tvar trip = " + json.dumps(payload) + ";\n")
+        fil.write("\tvar opolyline = drawTrip(mymap, trip).opolyline;\n")
+    else:
+        # create a marker for the first lat/lon pair for the recorded trip
+        lat = str(olat_lis[0])
+        lon = str(olon_lis[0])
+
+        fil.write("\t\tvar omarker = L.marker([" + lat + ',' + lon + "]).addTo(mymap);\n")
+        fil.write("\t\tomarker.bindPopup(" + '"' + "begin orig RECORDED trip" + '"' + ")\n")
+
+        # write all of the lat/lon pairs for the recorded trip
+        fil.write("\n\n\t\tvar olatlons = [\n")
+
+        for i in range(len(olat_lis)):
+            lat = str(olat_lis[i])
+            lon = str(olon_lis[i])
+            fil.write("\t\t\t[" + lat + "," + lon + "],\n")
+        fil.write("\t\t];\n")
+
+        fil.write("\n\n")
+
+        fil.write("var opolyline = L.polyline(olatlons, {color: 'red'}).addTo(mymap);\n")
+
+        # get first lat/lon pair for the corresponding shape
+        lat = str(slat_lis[0])
+        lon = str(slon_lis[0])
+
+        fil.write("\t\tvar smarker = L.marker([" + lat + ',' + lon + "]).addTo(mymap);\n")
+        fil.write("\t\tsmarker.bindPopup(" + '"' + "begin PLANNED trip" + '"' + ")\n")
+
+        # draw blue polyline for the shape (the planned trip)
+        fil.write("\n\n\t\tvar slatlons = [\n")
+
+        for i in range(len(slat_lis)):
+            lat = str(slat_lis[i])
+            lon = str(slon_lis[i])
+            fil.write("\t\t\t[" + lat + "," + lon + "],\n")
+        fil.write("\t\t];\n")
+
+        fil.write("var spolyline = L.polyline(slatlons, {color: 'blue'}).addTo(mymap);\n")
+
+        # create yellow line segments for all breadcrumbs that are far off the planned route
+        num_devs = 0
+        num_readings = len(dist_lis)
+        for i in range(num_readings):
+            dist = dist_lis[i]
+            if (dist > deviation_threshold):
+                olat = olat_lis[i]
+                olon = olon_lis[i]
+                clat = clat_lis[i]
+                clon = clon_lis[i]
+                num_devs += 1
+
+                fil.write(f"\tvar latlons_{i} = [[{olat}, {olon}], [{clat}, {clon}]];\n")
+                fil.write(f"\tvar deviationLine_{i} = L.polyline(latlons_{i}, {{color: 'yellow'}}).addTo(mymap);\n")
+
+        fil.write("\n")
 
     endHTML = """
 	mymap.fitBounds(opolyline.getBounds());
@@ -273,6 +484,166 @@ def output_html():
         print(f"open {outhtml} in web browser to visualize the deviations for trip {tripID}")
 
 
-initialize()
-ingest_data()
-output_html()
\ No newline at end of file
+# the trip viewer page served in server mode; trips are fetched from /trips and /trip/<tripID> as JSON
+SERVER_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+	<title>Breadcrumb Trip Viewer</title>
+	<link rel="stylesheet" href="%(leaflet_css)s"/>
+	<script src="%(leaflet_js)s"></script>
+  <style>
+  #map {position: absolute; top: 0; bottom: 0; left: 0; right: 280px;}
+  #panel {position: absolute; top: 0; bottom: 0; right: 0; width: 270px; padding: 5px; font-family: sans-serif; font-size: 13px;}
+  #trips {width: 100%%; height: 70%%;}
+  </style>
+</head>
+<body>
+	<div id="map"></div>
+	<div id="panel">
+		<input id="tripid" placeholder="trip ID" size="12"/> <button onclick="showTrip(document.getElementById('tripid').value)">show</button>
+		<select id="trips" size="20" onchange="showTrip(this.value)"></select>
+		<label id="heatmapbox" style="display: none"><input type="checkbox" onchange="toggleHeatmap(this.checked)"/> fleet deviation heatmap</label>
+		<p id="info"></p>
+	</div>
+	<script>
+		var mymap = L.map('map').setView([45.722279,-122.688873], 10);
+%(tiles)s
+%(decode)s
+%(draw)s
+	var current = null;
+	function showTrip(id) {
+		fetch('/trip/' + encodeURIComponent(id)).then(function (response) {
+			if (!response.ok) throw new Error('trip ' + id + ' not found');
+			return response.json();
+		}).then(function (trip) {
+			if (current) current.layers.remove();
+			current = drawTrip(mymap, trip);
+			mymap.fitBounds(current.opolyline.getBounds());
+			document.getElementById('info').textContent = 'trip ' + trip.tripID + ', shape ' + trip.shapeID +
+				', vehicle ' + trip.vehicleID + ', route ' + trip.routeID + ': ' + trip.deviations + ' of ' +
+				trip.readings + ' breadcrumb readings deviate by more than ' + trip.threshold + ' meters';
+		}).catch(function (error) {
+			document.getElementById('info').textContent = error.message;
+		});
+	}
+	// the heatmap is one canvas-rendered layer of grid cells, colored by mean deviation against the threshold
+	var heatmap = null;
+	function toggleHeatmap(show) {
+		if (!show) {
+			if (heatmap) heatmap.remove();
+			return;
+		}
+		if (heatmap) {
+			heatmap.addTo(mymap);
+			return;
+		}
+		fetch('/heatmap').then(function (response) { return response.json(); }).then(function (grid) {
+			var renderer = L.canvas(), dlat = grid.cellDegrees[0], dlon = grid.cellDegrees[1];
+			heatmap = L.layerGroup(grid.cells.map(function (cell) {
+				var hue = 120 * (1 - Math.min(cell[3] / grid.threshold, 1));
+				var color = 'hsl(' + hue + ', 90%%, 45%%)';
+				return L.rectangle([[cell[0] * dlat, cell[1] * dlon], [(cell[0] + 1) * dlat, (cell[1] + 1) * dlon]],
+					{renderer: renderer, stroke: false, fillColor: color, fillOpacity: 0.5})
+					.bindTooltip(cell[2] + ' readings, mean ' + cell[3] + ' m, max ' + cell[4] + ' m, ' + cell[5] +
+						' over ' + grid.threshold + ' m');
+			})).addTo(mymap);
+		});
+	}
+	if (%(heatmap)s) document.getElementById('heatmapbox').style.display = '';
+	fetch('/trips').then(function (response) { return response.json(); }).then(function (trips) {
+		var select = document.getElementById('trips');
+		trips.forEach(function (trip) {
+			var option = document.createElement('option');
+			option.value = trip.tripID;
+			option.textContent = trip.tripID + (trip.suspicionLevel == null ? '' : ' (' + trip.suspicionLevel.toFixed(3) + ')');
+			select.appendChild(option);
+		});
+		if (trips.length > 0) showTrip(trips[0].tripID);
+	});
+	</script>
+</body>
+</html>
+"""
+LEAFLET_CDN = "https://unpkg.com/leaflet@1.6.0/dist/"
+LEAFLET_FILES = {'leaflet.js': 'application/javascript', 'leaflet.css': 'text/css'}
+
+
+# the /trips response: every trip with its reading count, most suspicious first when the file has suspicionLevel
+def build_trip_list():
+    global trip_list_json
+    trips = pd.DataFrame({'tripID': crumbs.trip_ids, 'readings': crumb_store.trip_lengths(crumbs)})
+    if ('suspicionLevel' in crumbs.columns):
+        trips['suspicionLevel'] = crumb_store.first_values(crumbs, 'suspicionLevel')
+        trips = trips.sort_values(['suspicionLevel', 'tripID'], ascending=[False, True], kind='stable')
+    records = [{key: json_scalar(value) for key, value in row.items()} for row in trips.to_dict('records')]
+    trip_list_json = json.dumps(records).encode()
+
+
+def server_page():
+    leaflet = "/leaflet/" if leaflet_dir is not None else LEAFLET_CDN
+    return (SERVER_PAGE % {'leaflet_css': leaflet + 'leaflet.css', 'leaflet_js': leaflet + 'leaflet.js',
+                           'tiles': tile_layer_js() if tiles else '',
+                           'heatmap': 'true' if heatmap_file is not None else 'false',
+                           'decode': polyline.DECODE_JS, 'draw': DRAW_TRIP_JS}).encode()
+
+
+# answers the viewer page's requests from the in-memory trip index
+# requests are handled one at a time (HTTPServer), since select_trip() works through the module's globals
+class TripRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if (path == '/'):
+            self.reply(200, 'text/html', server_page())
+        elif (path == '/trips'):
+            self.reply(200, 'application/json', trip_list_json)
+        elif (path == '/heatmap' and heatmap_file is not None):
+            self.reply(200, 'application/json', Path(heatmap_file).read_bytes())
+        elif (path.startswith('/trip/')):
+            try:
+                tid = int(path[len('/trip/'):])
+            except ValueError:
+                tid = None
+            if (tid is None or not crumb_store.has_trip(crumbs, tid) or not select_trip(tid)):
+                self.reply(404, 'application/json', json.dumps({'error': 'trip not found'}).encode())
+            else:
+                self.reply(200, 'application/json', json.dumps(trip_payload()).encode())
+        elif (leaflet_dir is not None and path.startswith('/leaflet/') and path[len('/leaflet/'):] in LEAFLET_FILES):
+            name = path[len('/leaflet/'):]
+            self.reply(200, LEAFLET_FILES[name], Path(leaflet_dir).joinpath(name).read_bytes())
+        else:
+            self.reply(404, 'text/plain', b"not found")
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if (DEBUG): super().log_message(format, *args)
+
+
+# server mode: serve the trip viewer on localhost until interrupted
+def serve_trips():
+    build_trip_list()
+    server = HTTPServer(('127.0.0.1', serve_port), TripRequestHandler)
+    print(f"serving {len(crumbs.trip_ids)} trips at http://localhost:{serve_port}/ (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    initialize()
+    if (serve_port is not None):
+        load_inputs()
+        serve_trips()
+    elif (batch_trips is not None or top_n is not None):
+        load_inputs()
+        output_batch()
+    else:
+        ingest_data()
+        output_html()
@@ -0,0 +1,102 @@
+from pathlib import Path
+
+import os
+import sqlite3
+import pandas as pd
+
+import trip_summary
+
+# Trip-level results store
+# One SQLite table with a row per scored trip (service day, route, vehicle, shape, crumb count, mean deviation,
+# suspicion level and whether it was set aside as too far), written by sort_by_suspicion_level.py. The table is
+# indexed on suspicionLevel and on routeID, vehicleID and serviceDay (each followed by suspicionLevel), so range and
+# top-N queries are answered from the indexes without reading any crumb-level data.
+
+STORE_FILE = trip_summary.SUMMARY_FILE.with_name('trips.sqlite')
+STORE_COLUMNS = ['tripID', 'serviceDay', 'routeID', 'vehicleID', 'shapeID', 'crumbs', 'meanDistance',
+                 'suspicionLevel', 'tooFar']
+SCHEMA = """
+CREATE TABLE trips (
+    tripID INTEGER PRIMARY KEY,
+    serviceDay INTEGER,
+    routeID INTEGER,
+    vehicleID INTEGER,
+    shapeID INTEGER,
+    crumbs INTEGER,
+    meanDistance REAL,
+    suspicionLevel REAL,
+    tooFar INTEGER
+);
+CREATE INDEX trips_level ON trips (suspicionLevel);
+CREATE INDEX trips_route ON trips (routeID, suspicionLevel);
+CREATE INDEX trips_vehicle ON trips (vehicleID, suspicionLevel);
+CREATE INDEX trips_day ON trips (serviceDay, suspicionLevel);
+"""
+OPERATORS = ['=', '!=', '<', '<=', '>', '>=']  # comparisons query() accepts in filters
+DIRECTIONS = ['ASC', 'DESC']
+
+
+# Replaces the store with the given trips (a frame with STORE_COLUMNS); readers never see a half-written store
+def write_store(trips: pd.DataFrame, path: Path = STORE_FILE):
+    tmp = Path(path).with_suffix('.tmp')
+    tmp.unlink(missing_ok=True)
+    with sqlite3.connect(tmp) as con:
+        con.executescript(SCHEMA)
+        trips[STORE_COLUMNS].to_sql('trips', con, if_exists='append', index=False)
+    con.close()
+    os.replace(tmp, path)
+
+
+def _check_column(column: str):
+    if column not in STORE_COLUMNS:
+        raise ValueError("unknown trip store column " + repr(column))
+
+
+# @Return the trips matching every filter, in pyarrow's form, e.g. query([('routeID', '=', 4)])
+# order_by lists (column, 'ASC' or 'DESC') pairs. Columns, operators and directions are checked against STORE_COLUMNS,
+# OPERATORS and DIRECTIONS, and values are bound as parameters, so no caller-supplied text ends up in the SQL
+def query(filters: list = (), order_by: list = (('suspicionLevel', 'ASC'), ('tripID', 'ASC')), limit: int = None,
+          path: Path = STORE_FILE) -> pd.DataFrame:
+    if not Path(path).is_file():
+        raise FileNotFoundError(str(path) + " not found; run sort_by_suspicion_level.py first")
+    conditions = []
+    params = []
+    for column, op, value in filters:
+        _check_column(column)
+        if op not in OPERATORS:
+            raise ValueError("unsupported trip store comparison " + repr(op))
+        conditions.append(column + " " + op + " ?")
+        params.append(value)
+    terms = []
+    for column, direction in order_by:
+        _check_column(column)
+        if direction.upper() not in DIRECTIONS:
+            raise ValueError("unsupported sort direction " + repr(direction))
+        terms.append(column + " " + direction.upper())
+    sql = "SELECT * FROM trips WHERE " + (" AND ".join(conditions) or "1")
+    if terms:
+        sql += " ORDER BY " + ", ".join(terms)
+    if limit is not None:
+        sql += " LIMIT " + str(int(limit))
+    with sqlite3.connect(path) as con:
+        trips = pd.read_sql_query(sql, con, params=tuple(params))
+    con.close()
+    return trips
+
+
+# @Return the trips with low < suspicionLevel < high, least suspicious first; too-far trips only if asked for
+def level_range(low: float, high: float, include_too_far: bool = False, path: Path = STORE_FILE) -> pd.DataFrame:
+    filters = [('suspicionLevel', '>', low), ('suspicionLevel', '<', high)]
+    if not include_too_far:
+        filters.append(('tooFar', '=', 0))
+    return query(filters, path=path)
+
+
+# @Return the n most suspicious trips that were not set aside as too far, optionally of one route, vehicle or day
+def top_suspicious(n: int, route: int = None, vehicle: int = None, service_day: int = None,
+                   path: Path = STORE_FILE) -> pd.DataFrame:
+    filters = [('tooFar', '=', 0)]
+    for column, value in [('routeID', route), ('vehicleID', vehicle), ('serviceDay', service_day)]:
+        if value is not None:
+            filters.append((column, '=', int(value)))
+    return query(filters, order_by=[('suspicionLevel', 'DESC'), ('tripID', 'ASC')], limit=n, path=path)
@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import os
+import numpy
+import pandas as pd
+
+import deviation_dataset
+import deviation_thresholds
+
+# Per-trip deviation aggregates
+# A trip's summary is the sum of its crumbs' deviation distances, how many crumbs have a distance and how many of
+# those are above the deviation threshold. These add up, so summaries of separate pieces of the dataset (one file at a
+# time, say) merge into the summary of the whole, and the mean distance and suspicion level follow from the sums.
+# Each summary also holds a histogram of the trip's distances over fixed log-spaced bins, from which the suspicion level
+# for any other threshold (or a sweep of thresholds) is computed without reading the crumbs again.
+
+# Deviation thresholds, in meters (see deviation_thresholds.py)
+DISTANCE_THRESHOLD = deviation_thresholds.DISTANCE_THRESHOLD
+SUSPICIOUSLY_TOO_FAR = deviation_thresholds.SUSPICIOUSLY_TOO_FAR
+
+# Histogram bin edges: 10 per decade from 1 m to 100 km, plus the thresholds above so they are counted exactly
+# Bins are closed on the right: column le<edge> counts distances from the previous edge up to and including this one
+# (le1 everything up to 1 m) and gt100000 everything beyond, so "distance > edge" is a sum of whole bins
+HISTOGRAM_EDGES = numpy.unique(numpy.concatenate([numpy.round(numpy.logspace(0, 5, 51), 3),
+                                                  [DISTANCE_THRESHOLD, SUSPICIOUSLY_TOO_FAR]]))
+HISTOGRAM_COLUMNS = ['le' + format(edge, 'g') for edge in HISTOGRAM_EDGES] + ['gt' + format(HISTOGRAM_EDGES[-1], 'g')]
+SUMMARY_COLUMNS = ['total', 'count', 'over'] + HISTOGRAM_COLUMNS
+READ_COLUMNS = ['tripID', 'distance']
+SUMMARY_FILE = Path().joinpath('..', 'out', 'suspicion_level', 'trip_summary.parquet')
+
+
+# One pass over a frame of crumbs (tripID, distance)
+# @Return frame indexed by tripID with SUMMARY_COLUMNS
+def aggregate(crumbs: pd.DataFrame, threshold: float) -> pd.DataFrame:
+    crumbs = crumbs[READ_COLUMNS].assign(over=crumbs['distance'] > threshold)
+    summary = crumbs.groupby('tripID').agg(total=('distance', 'sum'), count=('distance', 'count'),
+                                           over=('over', 'sum'))
+    measured = crumbs[crumbs['distance'].notna()]
+    bins = numpy.searchsorted(HISTOGRAM_EDGES, measured['distance'].to_numpy(), side='left')
+    hist = measured.groupby([measured['tripID'], bins]).size().unstack(fill_value=0)
+    hist = hist.reindex(index=summary.index, columns=range(len(HISTOGRAM_COLUMNS)), fill_value=0)
+    hist.columns = HISTOGRAM_COLUMNS
+    return summary.join(hist.astype('int32'))
+
+
+# @Return the summary of all crumbs in the given summaries, which must come from disjoint sets of crumbs
+def merge(summaries) -> pd.DataFrame:
+    summaries = list(summaries)
+    if not summaries:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS, index=pd.Index([], name='tripID'))
+    return pd.concat(summaries).groupby(level='tripID').sum()[SUMMARY_COLUMNS]
+
+
+# Aggregates the dataset one file at a time, reading only tripID and distance, so memory is bounded by one file
+def dataset_summary(threshold: float, files: list = None) -> pd.DataFrame:
+    if files is None:
+        files = deviation_dataset.partition_files()
+    return merge(aggregate(deviation_dataset.read_partition_file(f, columns=READ_COLUMNS), threshold) for f in files)
+
+
+# Adds meanDistance and suspicionLevel (share of crumbs above the threshold); trips with no distance get NaN for both
+def finalize(summary: pd.DataFrame) -> pd.DataFrame:
+    count = summary['count'].where(summary['count'] > 0)
+    return summary.assign(meanDistance=summary['total'] / count, suspicionLevel=summary['over'] / count)
+
+
+# @Return the bin edge a threshold is evaluated at: itself when it is an edge, otherwise the nearest edge below it
+# (so distances between that edge and the threshold count as above it); thresholds under 1 m are evaluated at 1 m
+def histogram_edge(threshold: float) -> float:
+    i = numpy.searchsorted(HISTOGRAM_EDGES, threshold, side='right') - 1
+    return float(HISTOGRAM_EDGES[max(i, 0)])
+
+
+# @Return per trip, how many crumbs are farther than threshold (as rounded by histogram_edge) from their shape
+def count_over(summary: pd.DataFrame, threshold: float) -> pd.Series:
+    first = int(numpy.searchsorted(HISTOGRAM_EDGES, histogram_edge(threshold))) + 1
+    return summary[HISTOGRAM_COLUMNS[first:]].sum(axis=1)
+
+
+# Suspicion level and too-far classification of every trip for one pair of thresholds, from the summary alone
+# @Return frame indexed by tripID with meanDistance, suspicionLevel and tooFar; trips with no distance are dropped
+def rescore(summary: pd.DataFrame, threshold: float = DISTANCE_THRESHOLD,
+            too_far: float = SUSPICIOUSLY_TOO_FAR) -> pd.DataFrame:
+    summary = summary[summary['count'] > 0]
+    mean = summary['total'] / summary['count']
+    return pd.DataFrame({'meanDistance': mean, 'suspicionLevel': count_over(summary, threshold) / summary['count'],
+                         'tooFar': mean >= too_far})
+
+
+def save_summary(summary: pd.DataFrame, path: Path = SUMMARY_FILE):
+    tmp = Path(path).with_suffix('.tmp')
+    summary[SUMMARY_COLUMNS].to_parquet(tmp)
+    os.replace(tmp, path)
+
+
+def load_summary(path: Path = SUMMARY_FILE) -> pd.DataFrame:
+    summary = pd.read_parquet(path)
+    if list(summary.columns) != SUMMARY_COLUMNS:
+        raise ValueError(str(path) + " was written with other histogram bins; rerun sort_by_suspicion_level.py")
+    return summary
@@ -1,291 +1,206 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import os.path as os
-import geopandas as gp
+import argparse
+import shutil
 import pandas as pd
-import shapely.geometry as geo
-import shapely.ops as ops
 import datetime
 import numpy
 
-# constants
-UP = -1
-DOWN = 1
-TOLERANCE = -0.0000001  # Floats within this amount of one another are considered equal
-MAX_LOOK_FORWARD = 30  # This number should be more than the highest number of places a crumb is out of order by
-LAT_DIST = 111.2 * 1000  # m per degree latitude at 45.63 degrees latitude (approximate)
-LON_DIST = 77.76 * 1000  # m per degree longitude at 45.63 degrees latitude (approximate)
-
-
-# Extracts the xy coordinates from the gdf's geometry field
-def extract_xy(df: gp.GeoDataFrame):
-    return df.geometry.coords[0][0], df.geometry.coords[0][1]
-
-
-# @Return False if SHAPE_DEVIATION_DIST[x] < SHAPE_DEVIATION_DIST[x - how_far] or
-#   trip_id[x] == trip_id[x + how_far); True otherwise
-def is_less_than_n_ahead(df: gp.GeoDataFrame, how_far: int = 1) -> bool:
-    dist_traveled = df['SHAPE_DEVIATION_DIST'] - df['SHAPE_DEVIATION_DIST'].shift(DOWN * how_far, fill_value=0)
-    is_diff_trip = (df['trip_id'] != df['trip_id'].shift(DOWN * how_far, fill_value=0))
-    return ~((TOLERANCE < dist_traveled) | is_diff_trip)
-
-
-# These functions assume that df['processing_distance'] is filled with the look-behind distance
-# @Return True if element belongs exactly n places behind; false otherwise
-def is_exactly_n_ahead(df: gp.GeoDataFrame) -> bool:
-    how_far = df['processing_distance'][0]
-    return ~is_less_than_n_ahead(df, how_far) & is_less_than_n_ahead(df, how_far + 1)
-
+import breadcrumb_reader
+import crumb_cache
+import crumb_repair
+import deviation_dataset
+import deviation_manifest
+import planar_units
+import shape_index
+import shape_store
+import timestamps
+import trip2shape_cache
 
-# @Return True if element belongs exactly n places behind AND has no n - 1 to check; false otherwise
-def is_exactly_n_ahead_and_terminal(df: gp.GeoDataFrame) -> bool:
-    how_far = df['processing_distance'][0]
-    is_terminal = (df['trip_id'] != df['trip_id'].shift(DOWN * how_far, fill_value=0))
-    return is_exactly_n_ahead(df) & is_terminal
-
-
-def update_to_n_behind(df: gp.GeoDataFrame) -> gp.GeoDataFrame:
-    how_far = df['processing_distance'][0]
-    return df.shift(DOWN * how_far)
-
-
-# @Return False if SHAPE_DEVIATION_DIST[x] > SHAPE_DEVIATION_DIST[x + how_far] or
-#   trip_id[x] == trip_id[x + how_far); True otherwise
-def is_less_than_n_behind(df: gp.GeoDataFrame, how_far: int = 1) -> bool:
-    dist_traveled = df['SHAPE_DEVIATION_DIST'].shift(UP * how_far, fill_value=0) - df['SHAPE_DEVIATION_DIST']
-    is_diff_trip = (df['trip_id'] != df['trip_id'].shift(UP * how_far, fill_value=0))
-    return ~((TOLERANCE < dist_traveled) | is_diff_trip)
-
-
-# These functions assume that df['processing_distance'] is filled with the look-ahead distance
-# @Return True if element belongs exactly n places ahead; false otherwise
-def is_exactly_n_behind(df: gp.GeoDataFrame) -> bool:
-    how_far = df['processing_distance'][0]
-    return ~is_less_than_n_behind(df, how_far) & is_less_than_n_behind(df, how_far + 1)
+# constants
+LAT_DIST = planar_units.LAT_DIST  # m per degree latitude (see planar_units.py)
+LON_DIST = planar_units.LON_DIST  # m per degree longitude
+DEFAULT_WORKERS = 1  # Shapes are processed one after another unless --workers says otherwise
+BREADCRUMB_DIR = Path().joinpath('..', 'data', 'original', 'cyclic_data_20200224_0320_wkd')
+GTFS_DIR = Path().joinpath('..', 'data', 'original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105')
+CAD_AVL_FILE = Path().joinpath('..', 'data', 'original', 'C-Tran_CAD_AVL_trips_Feb+Mar2020',
+                               'C-Tran_CAD_AVL_trips_Feb+Mar2020.csv')
+SHAPE_STORE_DIR = Path().joinpath('..', 'out', 'shapes')  # makeRouteShapeFiles writes the feed's shape stores here
+ALGORITHM_VERSION = 2  # Bump when the correction logic changes, so every output partition gets recomputed
 
 
-# @Return True if element belongs exactly n places ahead AND has no n + 1 to check; false otherwise
-def is_exactly_n_behind_and_terminal(df: gp.GeoDataFrame) -> bool:
-    how_far = df['processing_distance'][0]
-    is_terminal = (df['trip_id'] != df['trip_id'].shift(UP * how_far, fill_value=0))
-    return is_exactly_n_behind(df) & is_terminal
+def get_distance2(x1, y1, x2, y2):
+    return numpy.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
 
 
-def update_to_n_ahead(df: gp.GeoDataFrame) -> gp.GeoDataFrame:
-    how_far = df['processing_distance'][0]
-    return df.shift(UP * how_far)
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", default=DEFAULT_WORKERS, type=int,
+                        help="number of processes computing shapes in parallel")
+    parser.add_argument("--rebuild-cache", default=False, action="store_true",
+                        help="ignore the cached cleaned inputs in data/cache and rebuild them from the source files")
+    parser.add_argument("--force", default=False, action="store_true",
+                        help="recompute every shape and service day, even those whose inputs did not change")
+    parser.add_argument("--trip2shape", default=None,
+                        help="use this trip2shape CSV (e.g. ../data/modified/trip2shape.csv) instead of the mapping "
+                             "computed from the GTFS feed and cached in data/cache/trip2shape")
+    parser.add_argument("--chunked", default=False, action="store_true",
+                        help="stream the breadcrumbs a chunk of whole trips at a time to bound memory use")
+    return parser.parse_args()
 
 
-def get_distance(row: gp.GeoDataFrame) -> float:
-    return row.projected_point.distance(row.geometry)
+# Loads the GTFS routes, trips and shapes joined into one frame of shape points, from the cache when it is current
+def load_shapes(rebuild: bool = False) -> pd.DataFrame:
+    sources = [GTFS_DIR.joinpath(name) for name in ['routes.txt', 'newshapes.txt', 'trips.txt']]
+    return crumb_cache.cached_frame('shapes', sources, build_shapes, rebuild=rebuild)
+
+
+# Maps the binary store of the GTFS shapes (see shape_store.py): the one makeRouteShapeFiles wrote while it is
+# current, else one built in the cache
+def load_shape_store(rebuild: bool = False) -> shape_store.ShapeStore:
+    return shape_store.load_store(GTFS_DIR.joinpath('newshapes.txt'), GTFS_DIR.joinpath('trips.txt'),
+                                  out_dir=SHAPE_STORE_DIR, rebuild=rebuild)
+
+
+# @Return the name the cached grid index of a shape of newshapes.txt is kept under (see shape_index.py)
+def index_name(shape) -> str:
+    return 'newshapes-' + str(shape)
+
+
+# Parses and joins the GTFS routes, trips and shapes
+def build_shapes() -> pd.DataFrame:
+    routes = pd.read_csv(GTFS_DIR.joinpath('routes.txt'))
+    shapes = pd.read_csv(GTFS_DIR.joinpath('newshapes.txt'))
+    trips = pd.read_csv(GTFS_DIR.joinpath('trips.txt'))
+
+    # Explanation: indices get lost in the merge, so we need to dup them
+    routes.insert(0, 'route_index', routes['route_id'])
+    trips.insert(0, 'shape_index', trips['shape_id'])
+
+    # Clean up this field for upcoming merge with breadcrumb data
+    routes['route_short_name'].replace(to_replace='Vine', value=50, inplace=True)
+    routes['route_short_name'] = pd.to_numeric(routes['route_short_name'])
+
+    # Join routes to trips to shapes
+    shp = routes.set_index('route_id').join(trips.set_index('route_id'))
+    shp.drop_duplicates(['route_index', 'shape_index'], inplace=True)
+    shp = shp.set_index('shape_id').join(shapes.set_index('shape_id'))
+    shp = shp[['route_index', 'shape_index', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon',
+               'shape_dist_traveled', 'route_short_name', 'route_long_name']]
+    shp['route_short_name'].replace(to_replace='Vine', value=50, inplace=True)
+    shp.sort_values(['route_index', 'shape_index', 'shape_pt_sequence'])
+
+    # Convert coordinates based on constants above
+    shp.insert(len(shp.columns), 'lat', shp['shape_pt_lat'] * LAT_DIST, allow_duplicates=True)
+    shp.insert(len(shp.columns), 'lon', shp['shape_pt_lon'] * LON_DIST, allow_duplicates=True)
+    return shp
+
+
+# Loads the small per-trip lookup tables that get joined onto the breadcrumbs
+# mapping_file defaults to the cached mapping for the current feed and breadcrumbs (see trip2shape_cache.py)
+def load_trip_lookups(mapping_file: Path = None):
+    if mapping_file is None:
+        mapping_file = trip2shape_file()
+    tripToShape = pd.read_csv(mapping_file)
+    tripToShape.set_index('tripID', inplace=True)
+
+    cad_avl = pd.read_csv(CAD_AVL_FILE)
+    cad_avl = cad_avl[['vehicle_number', 'trip_id', 'route_number']]
+    cad_avl = cad_avl.drop_duplicates(['vehicle_number', 'trip_id', 'route_number'])
+    cad_avl.set_index('trip_id', inplace=True)
+    return tripToShape, cad_avl
+
+
+# Joins cleaned breadcrumbs with their shape, vehicle and route
+# Works the same on the whole month or on one trip-complete chunk from breadcrumb_reader
+def join_crumbs(crumbs: pd.DataFrame, tripToShape: pd.DataFrame, cad_avl: pd.DataFrame) -> pd.DataFrame:
+    # Add shape id to crumbs data - note, about 550 trips in crumbs have no associated cad_avl data
+    # Left join: trips in trip2shape.csv with no crumbs would only be dropped again for lacking coordinates
+    crumbs.insert(0, 'trip_id', crumbs['EVENT_NO_TRIP'])
+    crumbs.set_index('EVENT_NO_TRIP', inplace=True)
+    crumbs = crumbs.join(tripToShape, how='left')
+
+    # Add vehicle_number and route_id to crumbs
+    crumbs = crumbs.join(cad_avl)
+
+    # Reduce dataset size for testing
+    # crumbs = crumbs.query('shapeID == 49')
+
+    # Convert coordinates based on constants above
+    crumbs.insert(len(crumbs.columns), 'lat', crumbs['GPS_LATITUDE'] * LAT_DIST, allow_duplicates=True)
+    crumbs.insert(len(crumbs.columns), 'lon', crumbs['GPS_LONGITUDE'] * LON_DIST, allow_duplicates=True)
+    return crumbs
+
+
+# @Return the trip2shape mapping for BREADCRUMB_DIR and the GTFS feed, computing it for any new breadcrumb files
+def trip2shape_file(workers: int = DEFAULT_WORKERS, rebuild: bool = False) -> Path:
+    return trip2shape_cache.mapping_file(BREADCRUMB_DIR, GTFS_DIR, CAD_AVL_FILE, workers=workers, rebuild=rebuild,
+                                         shape_store_dir=SHAPE_STORE_DIR)
+
+
+# Loads the whole month of breadcrumbs joined with their shape, vehicle and route, from the cache when it is current
+def load_crumbs(mapping_file: Path, rebuild: bool = False) -> pd.DataFrame:
+    sources = breadcrumb_reader.breadcrumb_files(BREADCRUMB_DIR) + [mapping_file, CAD_AVL_FILE]
+    return crumb_cache.cached_frame('crumbs', sources, lambda: build_crumbs(mapping_file), rebuild=rebuild)
 
 
-def get_distance2(x1, y1, x2, y2):
-    return numpy.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+def build_crumbs(mapping_file: Path) -> pd.DataFrame:
+    crumbs = breadcrumb_reader.read_breadcrumbs(BREADCRUMB_DIR)
+    return join_crumbs(crumbs, *load_trip_lookups(mapping_file))
 
 
-# compares geometry field to shape_line
-def get_projection(row: gp.GeoDataFrame) -> (float, float):
-    x = ops.nearest_points(row.geometry, row.shape_line)
-    return x[1].coords[0][0], x[1].coords[0][1]
-
-
-def get_route_distance(row: gp.GeoDataFrame) -> float:
-    return row.shape_line.project(row.geometry)  # Confusingly, the lib's distance method is called "project()"
-
-
-def get_interpolations(row: gp.GeoDataFrame):
-    # Interpolate() gets the point at n distance along the calling shape
-    return row.shape_line.interpolate(row['scalar'])
-
-
-print("Computing route deviations! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
-
-new_path = Path().joinpath('..', 'data', 'original', 'C-Tran_GTFSfiles_20200105', 'google_transit_20200105')
-routes = pd.read_csv(new_path.joinpath('routes.txt'))
-shapes = pd.read_csv(new_path.joinpath('newshapes.txt'))
-trips = pd.read_csv(new_path.joinpath('trips.txt'))
-
-# Explanation: indices get lost in the merge, so we need to dup them
-routes.insert(0, 'route_index', routes['route_id'])
-trips.insert(0, 'shape_index', trips['shape_id'])
-
-# Clean up this field for upcoming merge with breadcrumb data
-routes['route_short_name'].replace(to_replace='Vine', value=50, inplace=True)
-routes['route_short_name'] = pd.to_numeric(routes['route_short_name'])
-
-# Join routes to trips to shapes
-shp = routes.set_index('route_id').join(trips.set_index('route_id'))
-shp.drop_duplicates(['route_index', 'shape_index'], inplace=True)
-shp = shp.set_index('shape_id').join(shapes.set_index('shape_id'))
-shp = shp[['route_index', 'shape_index', 'shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled',
-           'route_short_name', 'route_long_name']]
-shp['route_short_name'].replace(to_replace='Vine', value=50, inplace=True)
-shp.sort_values(['route_index', 'shape_index', 'shape_pt_sequence'])
-del routes, shapes, new_path, trips
-
-# Now grab breadcrumb data
-path = Path().joinpath('..', 'data', 'original', 'cyclic_data_20200224_0320_wkd')
-files = path.glob("*.tsv")
-li = []
-
-for filename in files:
-    li.append(pd.read_csv(filename, sep='\t', header=0))
-
-crumbs = pd.concat(li, axis=0, ignore_index=True)
-del li, filename, files, path
-
-# Clean up data - note, about 550 trips in crumbs have no associated cad_avl data
-crumbs.dropna(subset=['GPS_LONGITUDE', 'GPS_LATITUDE', 'EVENT_NO_TRIP'], inplace=True)
-
-# Add shape id to crumbs data
-tripToShape = pd.read_csv(Path().joinpath('..', 'data', 'modified', 'trip2shape.csv'))
-crumbs.insert(0, 'trip_id', crumbs['EVENT_NO_TRIP'])
-crumbs.set_index('EVENT_NO_TRIP', inplace=True)
-tripToShape.set_index('tripID', inplace=True)
-crumbs = crumbs.join(tripToShape, how='outer')
-del tripToShape
-
-# Add vehicle_number and route_id to crumbs
-cad_avl = pd.read_csv(
-    Path().joinpath('..', 'data', 'original', 'C-Tran_CAD_AVL_trips_Feb+Mar2020', 'C-Tran_CAD_AVL_trips_Feb'
-                                                                                  '+Mar2020.csv'))
-cad_avl = cad_avl[['vehicle_number', 'trip_id', 'route_number']]
-cad_avl = cad_avl.drop_duplicates(['vehicle_number', 'trip_id', 'route_number'])
-cad_avl.set_index('trip_id', inplace=True)
-crumbs = crumbs.join(cad_avl)
-del cad_avl
-
-# Reduce dataset size for testing
-# crumbs = crumbs.query('shapeID == 49')
-
-# Convert coordinates based on constants above
-crumbs.insert(len(crumbs.columns), 'lat', crumbs['GPS_LATITUDE'] * LAT_DIST, allow_duplicates=True)
-crumbs.insert(len(crumbs.columns), 'lon', crumbs['GPS_LONGITUDE'] * LON_DIST, allow_duplicates=True)
-shp.insert(len(shp.columns), 'lat', shp['shape_pt_lat'] * LAT_DIST, allow_duplicates=True)
-shp.insert(len(shp.columns), 'lon', shp['shape_pt_lon'] * LON_DIST, allow_duplicates=True)
-
-# Init the for loop
-# Added this loop to keep pipeline unclogged at the adjustment calculations,
-# as I was not getting good time efficiency in final for loop due to the innermost iterrows()
-total_set = crumbs
-shapes = shp['shape_index'].unique().tolist()
-for shape in shapes:
-    crumbs = total_set.query('shapeID == @shape')
-    if len(crumbs) == 0 or os.isfile('/Projects/ExplorationsInDataScienceProject/out/shapes/' +
-                                     'deviation_breadcrumbs' + str(shape) + '.csv'):
-        continue
-    else:
-        print('***********************************')
-        print('***********************************')
-        print("Computing route deviations for shape: " + str(shape) + " Began: " + datetime.datetime.now().strftime(
-            "%H:%M:%S"))
+# Computes the corrected positions for every crumb assigned to one shape
+# and writes one partition of the deviation dataset per service day (see deviation_dataset.py)
+# Only this shape's crumbs, segment index and route rows are passed in, so a worker never sees the full data set
+# Partitions listed in append_keys get another part file next to those of an earlier chunk instead of replacing them
+# @Return (shape, {partition key: files written})
+def compute_shape_deviations(shape, crumbs: pd.DataFrame, index: shape_index.ShapeIndex, joiner: pd.DataFrame,
+                             append_keys: set = frozenset(), part_name: str = 'part-0'):
+    print('***********************************')
+    print('***********************************')
+    print("Computing route deviations for shape: " + str(shape) + " Began: " + datetime.datetime.now().strftime(
+        "%H:%M:%S"))
 
-    # At this point, we have shp = the route shapes, and crumbs = the breadcrumb data
+    # At this point, we have index = the route shape, and crumbs = the breadcrumb data
     # Now it's time to find the "naive" projections onto the shape
-    # First, we'll create a breadcrumbs gdf w/ correct shape geometry assigned
     crumbs = crumbs.dropna(subset=['lon', 'lat'])
     crumbs.insert(len(crumbs.columns), 'key', range(len(crumbs)))
-    print("Writing point objects to breadcrumbs...")
-    crumbs = gp.GeoDataFrame(crumbs, geometry=gp.points_from_xy(crumbs.lon, crumbs.lat))
-    crumbsLines = gp.GeoDataFrame(crumbs[['key', 'shapeID', 'geometry']])
     crumbs.set_index('key', inplace=True)
-    crumbsLines.set_index('key', inplace=True)
-
-    # Route shape objects
-    print("Writing route shape objects to breadcrumbs...")
-    cur_shape = shp.query('shape_index == @shape')
-    cur_ls = geo.LineString(list(cur_shape[['lon', 'lat']].to_records(index=False)))
-    crumbsLines.geometry.loc[crumbsLines['shapeID'] == shape] = cur_ls
-
-    crumbs.insert(len(crumbs.columns), 'SHAPE_GPS_LONGITUDE', 0, allow_duplicates=True)
-    crumbs.insert(len(crumbs.columns), 'SHAPE_GPS_LATITUDE', 0, allow_duplicates=True)
-    crumbs.insert(len(crumbs.columns), 'SHAPE_DEVIATION_DIST', 0, allow_duplicates=True)
-    crumbs.insert(len(crumbs.columns), 'shape_line', crumbsLines['geometry'])
-    del crumbsLines, cur_ls, cur_shape
 
-    # Now naive projections onto crumbs
+    # Now naive projections onto crumbs, along with the distance of each projection along the shape
+    # Done as one vectorized pass over the whole block of crumbs, testing only nearby segments (see shape_index.py)
     print(
         "Writing naive route projections onto breadcrumbs... Began: " + datetime.datetime.now().strftime(
             "%H:%M:%S"))
-    projections = crumbs.apply(get_projection, axis=1)
-    crumbs[['SHAPE_GPS_LONGITUDE', 'SHAPE_GPS_LATITUDE']] = pd.DataFrame(projections)[0].to_list()
-    crumbs = gp.GeoDataFrame(crumbs, geometry=gp.points_from_xy(crumbs.SHAPE_GPS_LONGITUDE, crumbs.SHAPE_GPS_LATITUDE))
-    del projections
+    proj_x, proj_y, along, _ = shape_index.project_points(index, crumbs['lon'], crumbs['lat'])
 
-    # Also we need the distance of each naive projection along the shape
-    print(
-        "Writing distance of naive projections along route onto breadcrumbs... Began: " + datetime.datetime.now().strftime(
-            "%H:%M:%S"))
-    projections = crumbs.apply(get_route_distance, axis=1)
-    crumbs['SHAPE_DEVIATION_DIST'] = pd.DataFrame(projections)
-    del projections
-
-    # Final step is to find out-of-order crumbs by comparing each to its next neighbor
+    # Final step is to find out-of-order crumbs and move them between their in-order neighbors (see crumb_repair.py)
     print(
         "Matching out-of-order projections with their probable locations... Began: " + datetime.datetime.now().strftime(
             "%H:%M:%S"))
-    crumbs.insert(len(crumbs.columns), 'processing_distance', 0)
-    crumbs.insert(len(crumbs.columns), 'scalar', 0)
-    for n in range(1, MAX_LOOK_FORWARD):
-        crumbs['processing_distance'] = n
-        # Handle the edge case where an out-of-order point goes to the end of the recorded trip
-        crumbs['geometry'] = crumbs.mask(is_exactly_n_behind_and_terminal, update_to_n_ahead)['geometry']
-
-        # Find the correct place ahead halfway between two new crumbs
-        updates = crumbs.where(is_exactly_n_behind).dropna()
-        p1 = updates['SHAPE_DEVIATION_DIST'].shift(UP * n, fill_value=0)
-        p2 = updates['SHAPE_DEVIATION_DIST'].shift(UP * (n + 1), fill_value=0)
-        updates['scalar'] = (p1 + p2) / 2  # Distance traveled along route of the new median points
-        updates['geometry'] = gp.GeoDataFrame(updates.apply(get_interpolations, axis=1))
-        updates['SHAPE_DEVIATION_DIST'] = updates['scalar']
-        # Didn't want to have to manually loop through these, but luckily not too many...
-        for index, row in updates.iterrows():
-            crumbs.loc[index] = row
-
-        crumbs['processing_distance'] = -n
-        # Handle the edge case where an out-of-order point goes to the beginning the recorded trip
-        crumbs['geometry'] = crumbs.mask(is_exactly_n_ahead_and_terminal, update_to_n_behind)['geometry']
-
-        # Find the correct place behind halfway between two new crumb
-        updates = crumbs.where(is_exactly_n_ahead).dropna()
-        p1 = updates['SHAPE_DEVIATION_DIST'].shift(DOWN * n, fill_value=0)
-        p2 = updates['SHAPE_DEVIATION_DIST'].shift(DOWN * (n + 1), fill_value=0)
-        updates['scalar'] = (p1 + p2) / 2  # Distance traveled along route of the new median points
-        updates['geometry'] = gp.GeoDataFrame(updates.apply(get_interpolations, axis=1))
-        updates['SHAPE_DEVIATION_DIST'] = updates['scalar']
-        for index, row in updates.iterrows():
-            crumbs.loc[index] = row
-
-    xy_vals = crumbs.apply(extract_xy, axis=1)
-    crumbs[['SHAPE_GPS_LONGITUDE', 'SHAPE_GPS_LATITUDE']] = pd.DataFrame(xy_vals)[0].to_list()
-    crumbs.insert(len(crumbs.columns), 'projected_point', crumbs['geometry'])
-    crumbs = gp.GeoDataFrame(crumbs, geometry=gp.points_from_xy(crumbs.GPS_LONGITUDE, crumbs.GPS_LATITUDE))
-    # crumbs['SHAPE_DEVIATION_DIST'] = crumbs.apply(get_distance, axis=1)*1000
-    crumbs['SHAPE_DEVIATION_DIST'] = get_distance2(crumbs['lon'], crumbs['lat'],
-                                                   crumbs['SHAPE_GPS_LONGITUDE'], crumbs['SHAPE_GPS_LATITUDE'])
+    along, moved = crumb_repair.repair_out_of_order(crumbs['trip_id'].to_numpy(), along)
+    proj_x[moved], proj_y[moved] = shape_index.interpolate_points(index, along[moved])
+
+    crumbs.insert(len(crumbs.columns), 'SHAPE_GPS_LONGITUDE', proj_x, allow_duplicates=True)
+    crumbs.insert(len(crumbs.columns), 'SHAPE_GPS_LATITUDE', proj_y, allow_duplicates=True)
+    crumbs.insert(len(crumbs.columns), 'SHAPE_DEVIATION_DIST', get_distance2(crumbs['lon'], crumbs['lat'],
+                                                                             proj_x, proj_y), allow_duplicates=True)
+    print("Out-of-order crumbs moved: " + str(moved.sum()))
     print("Crumbs more than 5 meters off course: " +
           str(crumbs.query('SHAPE_DEVIATION_DIST > 5')['SHAPE_DEVIATION_DIST'].count()))
-    del p1, p2, n, updates, xy_vals
+    del proj_x, proj_y, along, moved
 
     # Add datetime column to crumbs table
-    # This code is slow, but I don't want to bother with changing it
     print("Encoding timestamps... ")
-    crumbs.insert(len(crumbs.columns), 'timestamp', float)
-    for index, row in crumbs.iterrows():
-        ts = datetime.datetime
-        ts = ts.strptime(row['OPD_DATE'], '%d-%b-%y') + datetime.timedelta(seconds=row['ACT_TIME'])
-        crumbs.at[index, 'timestamp'] = ts.timestamp()
-
-    del ts, index, row
+    epoch_seconds, _ = timestamps.crumb_timestamps(crumbs['OPD_DATE'], crumbs['ACT_TIME'])
+    crumbs.insert(len(crumbs.columns), 'timestamp', epoch_seconds)
 
     # Add crumbs column for route_index, which will be emitted at the end
     crumbs.set_index('shapeID', inplace=True)
-    joiner = shp.drop_duplicates(['route_index', 'shape_index'])[['route_index', 'shape_index']]
     crumbs = crumbs.join(joiner)
-    del joiner
 
-    # Save calculated data to csv file
+    # Save calculated data to the partitioned dataset
     # @SpecNotes Spec says ...
     # tripID - the ID of the recorded trip
     # timestamp - the moment at which the reading was taken
@@ -300,7 +215,7 @@ for shape in shapes:
     # correctedLongitude - the corrected vehicle position
     # distance - the Euclidean distance (in meters) from the original sensor reading and the corrected vehicle position
     # angle - this value is not implemented.
-    print("Saving file to csv...")
+    print("Saving partitions...")
     crumbs['SHAPE_GPS_LATITUDE'] = crumbs['SHAPE_GPS_LATITUDE'] / LAT_DIST
     crumbs['SHAPE_GPS_LONGITUDE'] = crumbs['SHAPE_GPS_LONGITUDE'] / LON_DIST
     crumbs.insert(len(crumbs.columns), 'angle', 0)
@@ -314,23 +229,132 @@ for shape in shapes:
                                     "route_id": "routeID",
                                     "shape_index": "shapeID",
                                     "SHAPE_DEVIATION_DIST": "distance"})
-    crumbs[['tripID', 'timestamp', 'vehicleID',
-            'origLatitude', 'origLongitude', 'shapeID',
-            'routeID', 'plannedTripID', 'correctedLatitude',
-            'correctedLongitude', 'distance', 'angle']].to_csv(
-        Path().joinpath('..', 'out', 'shapes', 'deviation_breadcrumbs' + str(shape) + '.csv'), index=False)
-    print("File successfully written!")
-
-# Finish up
-print("Consolidating output ... Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
-path = Path().joinpath('.', 'out', 'shapes')
-files = path.glob("*.csv")
-li = []
-
-for filename in files:
-    li.append(pd.read_csv(filename, header=0))
-
-crumbs = pd.concat(li, axis=0, ignore_index=True)
-del li, filename, files, path
-crumbs.to_csv(Path().joinpath('.', 'out', 'deviations', 'deviation_breadcrumbs.csv'), index=False)
-print("Deviation computations complete! Ended at: " + datetime.datetime.now().strftime("%H:%M:%S"))
+    written = {}
+    for service_day, part in crumbs.groupby('serviceDay', sort=True):
+        key = deviation_manifest.partition_key(shape, service_day)
+        if key not in append_keys:
+            deviation_dataset.remove_partition(service_day, shape)
+        written[key] = deviation_dataset.write_partition(part, service_day, shape, part_name)
+    print("Partitions successfully written!")
+    return shape, written
+
+
+# Partitions the crumbs by shape, so each shape's job only carries its own crumbs
+# Largest shapes go first so that one big route does not leave the other workers idle at the end
+# With a manifest, only the service days whose inputs changed are kept; their new fingerprints are returned in pending
+# @Return (jobs, pending manifest entries by partition key, keys of every partition that still has crumbs)
+def shape_jobs(total_set: pd.DataFrame, shp: pd.DataFrame, joiner: pd.DataFrame, store: shape_store.ShapeStore,
+               manifest: dict = None, written: set = frozenset(), part_name: str = 'part-0'):
+    total_set['serviceDay'] = timestamps.parse_opd_dates(total_set['OPD_DATE']).dt.strftime('%Y%m%d').to_numpy()
+    constants_hash = deviation_manifest.value_hash({'LAT_DIST': LAT_DIST, 'LON_DIST': LON_DIST,
+                                                    'TOLERANCE': crumb_repair.TOLERANCE,
+                                                    'ALGORITHM_VERSION': ALGORITHM_VERSION})
+    partitions = {shape: crumbs for shape, crumbs in total_set.groupby('shapeID', sort=False)}
+    work = []
+    pending = {}
+    keys = set()
+    for shape in shp['shape_index'].unique().tolist():
+        crumbs = partitions.pop(shape, None)
+        if crumbs is None or len(crumbs) == 0:
+            continue
+        if not shape_store.has_shape(store, shape):
+            print("Shape " + str(shape) + " is not in the shapes file, skipping its " + str(len(crumbs)) + " crumbs")
+            continue
+        shape_vertices = shape_store.shape_vertices(store, shape, LAT_DIST, LON_DIST)
+        route_rows = joiner.loc[joiner['shape_index'] == shape]
+        keys.update(deviation_manifest.partition_key(shape, day) for day in crumbs['serviceDay'].unique())
+
+        if manifest is not None:
+            shape_hash = deviation_manifest.value_hash([shape_vertices.tolist(), route_rows.to_numpy().tolist()])
+            stale_days = []
+            for service_day, part in crumbs.groupby('serviceDay', sort=False):
+                key = deviation_manifest.partition_key(shape, service_day)
+                fingerprint = deviation_manifest.partition_fingerprint(part, shape_hash, constants_hash)
+                if deviation_manifest.is_stale(manifest, key, fingerprint):
+                    stale_days.append(service_day)
+                    pending[key] = {'inputs': fingerprint}
+            if len(stale_days) == 0:
+                continue
+            crumbs = crumbs[crumbs['serviceDay'].isin(stale_days)]
+
+        index = shape_index.load_or_build_shape_index(shape_vertices, crumb_cache.CACHE_DIR, name=index_name(shape))
+        work.append((shape, crumbs, index, route_rows, written, part_name))
+    work.sort(key=lambda job: len(job[1]), reverse=True)
+    return work, pending, keys
+
+
+# Removes the partitions whose crumbs are gone, e.g. after a breadcrumb file was dropped or a trip moved to another
+# shape, along with their manifest entries; keys are the partitions that still have crumbs (from shape_jobs)
+# @Return number of partitions removed
+def remove_orphans(manifest: dict, keys: set, dataset_dir: Path = deviation_dataset.DATASET_DIR) -> int:
+    on_disk = {deviation_manifest.partition_key(shape, day) for day, shape in deviation_dataset.partitions(dataset_dir)}
+    orphans = (set(manifest) | on_disk) - keys
+    for key in sorted(orphans):
+        shape, service_day = deviation_manifest.split_key(key)
+        deviation_dataset.remove_partition(service_day, shape, dataset_dir)
+        manifest.pop(key, None)
+    return len(orphans)
+
+
+# Runs the jobs in this process, or on the pool when one is given
+# @Return iterator of (shape, {partition key: files written}) as each job finishes
+def run_jobs(work: list, pool: ProcessPoolExecutor = None):
+    if pool is None:
+        for job in work:
+            yield compute_shape_deviations(*job)
+        return
+    futures = [pool.submit(compute_shape_deviations, *job) for job in work]
+    for future in as_completed(futures):
+        shape, written = future.result()
+        print("Shape " + str(shape) + " finished at: " + datetime.datetime.now().strftime("%H:%M:%S"))
+        yield shape, written
+
+
+def main():
+    args = initialize()
+    print("Computing route deviations! Began: " + datetime.datetime.now().strftime("%H:%M:%S"))
+    shp = load_shapes(args.rebuild_cache)
+    joiner = shp.drop_duplicates(['route_index', 'shape_index'])[['route_index', 'shape_index']]
+    store = load_shape_store(args.rebuild_cache)
+    mapping_file = args.trip2shape
+    if mapping_file is None:
+        mapping_file = trip2shape_file(args.workers, args.rebuild_cache)
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+
+    dataset_dir = deviation_dataset.DATASET_DIR
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    if args.chunked:
+        # Trips are complete within a chunk, so each chunk can be corrected on its own and added as its own part file
+        # A partition's crumbs can span chunks, so this mode always recomputes everything: the dataset is cleared
+        # and the manifest reset, so no partition of an earlier run is left behind
+        shutil.rmtree(dataset_dir)
+        dataset_dir.mkdir(parents=True)
+        deviation_manifest.save_manifest(dataset_dir, {})
+        tripToShape, cad_avl = load_trip_lookups(mapping_file)
+        written = set()
+        for n, chunk in enumerate(breadcrumb_reader.iter_breadcrumb_chunks(BREADCRUMB_DIR)):
+            work, _, _ = shape_jobs(join_crumbs(chunk, tripToShape, cad_avl), shp, joiner, store, written=written,
+                                    part_name='part-' + str(n))
+            for shape, files in run_jobs(work, pool):
+                written.update(files)
+        del tripToShape, cad_avl, written
+    else:
+        # Incremental: only recompute the shape/service-day partitions whose inputs changed since the last run
+        manifest = {} if args.force else deviation_manifest.load_manifest(dataset_dir)
+        work, pending, keys = shape_jobs(load_crumbs(mapping_file, args.rebuild_cache), shp, joiner, store, manifest)
+        print(str(remove_orphans(manifest, keys, dataset_dir)) + " shape/service-day partitions without crumbs removed")
+        deviation_manifest.save_manifest(dataset_dir, manifest)
+        print(str(len(pending)) + " shape/service-day partitions to compute")
+        for shape, files in run_jobs(work, pool):
+            manifest.update({key: dict(pending[key], files=files[key]) for key in files})
+            deviation_manifest.save_manifest(dataset_dir, manifest)
+        del work, pending, keys
+    if pool is not None:
+        pool.shutdown()
+
+    # Finish up - the dataset is complete as written, there is nothing to consolidate
+    print("Deviation computations complete! Dataset in " + str(dataset_dir) + ". Ended at: " +
+          datetime.datetime.now().strftime("%H:%M:%S"))
+
+if __name__ == '__main__':
+    main()